@@ -0,0 +1,714 @@
+"""抽卡核心逻辑：概率/保底计算与外观生成。
+
+不依赖数据库，供 server.py 与离线模拟器 gacha_sim.py 共用。
+"""
+from __future__ import annotations
+from typing import Optional, List, Dict, Any, Tuple
+import re, json, secrets
+
+from pydantic import BaseModel
+
+from season_data import SEASON_DEFINITIONS
+
+
+WEAPON_NAME_ALIASES = {
+    "沙漠之鹰手枪": "deserteagle",
+    "腾龙突击步枪": "tenglong",
+    "莫辛纳甘步枪": "mosin",
+}
+
+
+def _slug_weapon_name(name: str) -> str:
+    if not name:
+        return ""
+    name = name.strip()
+    if not name:
+        return ""
+    alias = WEAPON_NAME_ALIASES.get(name)
+    if alias:
+        return alias
+    lowered = name.lower()
+    slug = re.sub(r"[^a-z0-9]+", "_", lowered).strip("_")
+    slug = re.sub(r"_+", "_", slug)
+    return slug
+
+
+def _resolve_model_key(provided: str, skin: Any) -> str:
+    if skin and skin.weapon:
+        slug = _slug_weapon_name(skin.weapon)
+        if slug:
+            return slug
+    normalized = (provided or "").strip().lower()
+    return normalized
+
+
+# ---- Labels ----
+TEMPLATE_LABEL_LOOKUP: Dict[str, str] = {
+    "brick_normal": "标准模板",
+    "brick_white_diamond": "白钻切面",
+    "brick_yellow_diamond": "黄钻切面",
+    "brick_pink_diamond": "粉钻切面",
+    "brick_brushed_metal": "金属拉丝",
+    "brick_laser_gradient": "镭射渐变",
+    "brick_prism_spectrum": "棱镜光谱",
+    "brick_medusa_relic": "蛇神遗痕",
+    "brick_arcade_crystal": "水晶贪吃蛇",
+    "brick_arcade_serpent": "像素贪吃蛇",
+    "brick_arcade_blackhawk": "街机黑鹰",
+    "brick_arcade_champion": "拳王",
+    "brick_arcade_default": "电玩标准",
+    "brick_blade_royal": "王牌镶嵌",
+    "brick_fate_blueberry": "蓝莓玉",
+    "brick_fate_brass": "黄铜",
+    "brick_fate_default": "命运经典",
+    "brick_fate_gold": "黄金",
+    "brick_fate_goldenberry": "金莓",
+    "brick_fate_gradient": "命运渐变",
+    "brick_fate_jade": "翡翠绿",
+    "brick_fate_metal": "金属拉丝",
+    "brick_fate_strawberry": "草莓金",
+    "brick_fate_whitepeach": "白桃",
+    "brick_prism2_flux": "棱镜攻势2",
+    "brick_weather_clathrate": "可燃冰",
+    "brick_weather_default": "气象标准",
+    "brick_weather_gradient": "气象渐变",
+    "brick_weather_gundam": "高达气象",
+    "brick_weather_purplebolt": "紫电",
+    "brick_weather_redbolt": "红电",
+    "prism_flux": "棱镜流光",
+    "ember_strata": "余烬分层",
+    "ion_tessellate": "离子镶嵌",
+    "diamond_veil": "钻石面纱",
+    "aurora_matrix": "极光矩阵",
+    "nebula_glass": "星云玻璃",
+    "ion_glaze": "离子釉彩",
+    "vapor_trace": "雾态轨迹",
+    "phase_shift": "相位位移",
+    "urban_mesh": "都市网格",
+    "fiber_wave": "纤维波纹",
+    "midnight_line": "午夜线条",
+    "field_classic": "野战经典",
+    "steel_ridge": "钢脊纹",
+    "matte_guard": "哨卫磨砂",
+}
+
+
+EFFECT_LABEL_LOOKUP: Dict[str, str] = {
+    "glow": "辉光涌动",
+    "pulse": "能量脉冲",
+    "sheen": "流光泛映",
+    "sparkle": "星火闪烁",
+    "trail": "残影拖尾",
+    "refraction": "晶体折射",
+    "flux": "相位流动",
+    "prism_flux": "棱镜流光",
+    "bold_tracer": "显眼曳光",
+    "kill_counter": "击杀计数",
+    "arcade_core": "街机核心",
+    "arcade_glass": "街机玻璃",
+    "arcade_glow": "街机辉光",
+    "arcade_pulse": "街机脉冲",
+    "arcade_trail": "街机拖尾",
+    "blade_glow": "王牌辉光",
+    "chromatic_flame": "彩焰",
+    "fate_glow": "命运辉光",
+    "fate_gradient": "命运渐变",
+    "medusa_glare": "美杜莎凝视",
+    "weather_bolt": "天气闪电",
+    "weather_frost": "气象霜华",
+    "weather_glow": "气象辉光",
+    "weather_gradient": "气象渐变",
+    "affinity:weather:acid_rain": "酸雨属性",
+    "affinity:weather:thunder": "雷电属性",
+    "affinity:weather:flame": "火焰属性",
+    "affinity:weather:frost": "冰霜属性",
+}
+
+
+for _season in SEASON_DEFINITIONS:
+    for _group in ("bricks", "purples", "blues", "greens"):
+        for _skin in _season.get(_group, []) or []:
+            meta = (_skin.get("meta") or {})
+            for _rule in meta.get("template_rules", []) or []:
+                key = str(_rule.get("key") or "").lower()
+                label = _rule.get("label")
+                if key and label and key not in TEMPLATE_LABEL_LOOKUP:
+                    TEMPLATE_LABEL_LOOKUP[key] = label
+
+
+# ---- RNG & Grades ----
+def grade_from_wear_bp(wear_bp: int) -> str:
+    # 0–0.40 S, 0.40–1.22 A, 1.22–2.50 B, 2.50–5.00 C  （wear_bp = 0..500）
+    if wear_bp < 40:   return "S"
+    if wear_bp < 122:  return "A"
+    if wear_bp < 250:  return "B"
+    return "C"
+
+def wear_random_bp() -> int:
+    return secrets.randbelow(501)
+
+def rng_ppm() -> int: return secrets.randbelow(1_000_000)
+def ppm(percent: float) -> int: return int(round(percent * 10_000))
+
+# ---- Visual Generator ----
+COLOR_PALETTE = [
+    {"hex": "#f06449", "name": "熔岩橙"},
+    {"hex": "#f9a620", "name": "流金黄"},
+    {"hex": "#ffd166", "name": "暖阳金"},
+    {"hex": "#ff6b6b", "name": "燃焰红"},
+    {"hex": "#ef476f", "name": "曦粉"},
+    {"hex": "#5b5f97", "name": "紫曜蓝"},
+    {"hex": "#577590", "name": "风暴蓝"},
+    {"hex": "#118ab2", "name": "极地蓝"},
+    {"hex": "#06d6a0", "name": "量子绿"},
+    {"hex": "#0ead69", "name": "热带绿"},
+    {"hex": "#26547c", "name": "暗夜蓝"},
+    {"hex": "#4cc9f0", "name": "星辉青"},
+    {"hex": "#845ec2", "name": "霓虹紫"},
+    {"hex": "#ff9671", "name": "霞光橘"},
+    {"hex": "#ffc75f", "name": "琥珀金"},
+    {"hex": "#d65db1", "name": "星云粉"},
+    {"hex": "#4b8b3b", "name": "密林绿"},
+    {"hex": "#8c7ae6", "name": "暮光紫"},
+    {"hex": "#2f4858", "name": "石墨蓝"},
+]
+
+BRICK_TEMPLATES = {
+    "brick_normal",
+    "brick_white_diamond",
+    "brick_yellow_diamond",
+    "brick_pink_diamond",
+    "brick_brushed_metal",
+    "brick_laser_gradient",
+    "brick_prism_spectrum",
+    "brick_medusa_relic",
+    "brick_arcade_crystal",
+    "brick_arcade_serpent",
+    "brick_arcade_blackhawk",
+    "brick_arcade_champion",
+    "brick_arcade_default",
+    "brick_fate_strawberry",
+    "brick_fate_blueberry",
+    "brick_fate_goldenberry",
+    "brick_fate_metal",
+    "brick_fate_brass",
+    "brick_fate_gold",
+    "brick_fate_jade",
+    "brick_fate_whitepeach",
+    "brick_fate_gradient",
+    "brick_fate_default",
+    "brick_blade_royal",
+    "brick_weather_gundam",
+    "brick_weather_clathrate",
+    "brick_weather_redbolt",
+    "brick_weather_purplebolt",
+    "brick_weather_gradient",
+    "brick_weather_default",
+    "brick_prism2_flux",
+}
+BRICK_TEMPLATE_LABELS = {
+    "brick_normal": "标准模板",
+    "brick_white_diamond": "白钻模板",
+    "brick_yellow_diamond": "黄钻模板",
+    "brick_pink_diamond": "粉钻模板",
+    "brick_brushed_metal": "金属拉丝",
+    "brick_laser_gradient": "镭射渐变",
+    "brick_prism_spectrum": "棱镜光谱",
+    "brick_medusa_relic": "蛇神遗痕",
+    "brick_arcade_crystal": "水晶贪吃蛇",
+    "brick_arcade_serpent": "贪吃蛇",
+    "brick_arcade_blackhawk": "黑鹰坠落",
+    "brick_arcade_champion": "拳王",
+    "brick_arcade_default": "电玩标准",
+    "brick_fate_strawberry": "草莓金",
+    "brick_fate_blueberry": "蓝莓玉",
+    "brick_fate_goldenberry": "金莓",
+    "brick_fate_metal": "命运金属",
+    "brick_fate_brass": "黄铜浮雕",
+    "brick_fate_gold": "黄金流光",
+    "brick_fate_jade": "翡翠绿",
+    "brick_fate_whitepeach": "白桃",
+    "brick_fate_gradient": "命运渐变",
+    "brick_fate_default": "命运经典",
+    "brick_blade_royal": "王牌镶嵌",
+    "brick_weather_gundam": "高达气象",
+    "brick_weather_clathrate": "可燃冰",
+    "brick_weather_redbolt": "红电",
+    "brick_weather_purplebolt": "紫电",
+    "brick_weather_gradient": "气象渐变",
+    "brick_weather_default": "气象标准",
+    "brick_prism2_flux": "棱镜攻势2",
+}
+EXQUISITE_ONLY_TEMPLATES = {
+    "brick_white_diamond",
+    "brick_yellow_diamond",
+    "brick_pink_diamond",
+    "brick_brushed_metal",
+    "brick_arcade_crystal",
+    "brick_arcade_serpent",
+    "brick_arcade_blackhawk",
+    "brick_arcade_champion",
+    "brick_fate_strawberry",
+    "brick_fate_blueberry",
+    "brick_fate_goldenberry",
+    "brick_fate_metal",
+    "brick_fate_brass",
+    "brick_fate_gold",
+    "brick_fate_jade",
+    "brick_fate_whitepeach",
+    "brick_weather_gundam",
+    "brick_weather_clathrate",
+    "brick_weather_redbolt",
+    "brick_weather_purplebolt",
+}
+DIAMOND_TEMPLATE_KEYS = {
+    "brick_white_diamond",
+    "brick_yellow_diamond",
+    "brick_pink_diamond",
+}
+SPECIAL_PRICE_TEMPLATES = DIAMOND_TEMPLATE_KEYS | {
+    "brick_brushed_metal",
+    "brick_prism_spectrum",
+    "brick_medusa_relic",
+    "brick_arcade_crystal",
+    "brick_arcade_serpent",
+    "brick_arcade_blackhawk",
+    "brick_arcade_champion",
+    "brick_fate_strawberry",
+    "brick_fate_blueberry",
+    "brick_fate_goldenberry",
+    "brick_fate_metal",
+    "brick_fate_brass",
+    "brick_fate_gold",
+    "brick_fate_jade",
+    "brick_fate_whitepeach",
+    "brick_weather_gundam",
+    "brick_weather_clathrate",
+    "brick_weather_redbolt",
+    "brick_weather_purplebolt",
+    "brick_prism2_flux",
+}
+
+COLOR_NAME_MAP = {c["hex"].lower(): c["name"] for c in COLOR_PALETTE}
+
+
+def _normalize_hex(value: Any) -> str:
+    if value is None:
+        return ""
+    s = str(value).strip()
+    if not s:
+        return ""
+    if not s.startswith("#"):
+        s = "#" + s
+    if len(s) not in (4, 7):
+        return ""
+    try:
+        int(s[1:], 16)
+    except ValueError:
+        return ""
+    return s.lower()
+
+
+def _color_entry(value: Any) -> Optional[Dict[str, str]]:
+    if isinstance(value, dict):
+        hex_raw = value.get("hex") or value.get("color") or value.get("value")
+        name = value.get("name") or value.get("label")
+    else:
+        hex_raw = value
+        name = None
+    hex_val = _normalize_hex(hex_raw)
+    if not hex_val:
+        return None
+    if not name:
+        name = COLOR_NAME_MAP.get(hex_val, hex_val)
+    return {"hex": hex_val, "name": name}
+
+
+def _resolve_palette(options: Any) -> List[Dict[str, str]]:
+    if not options:
+        return []
+    if isinstance(options, list):
+        choice = secrets.choice(options)
+    else:
+        choice = options
+    if isinstance(choice, list):
+        colors = []
+        for item in choice:
+            entry = _color_entry(item)
+            if entry:
+                colors.append(entry)
+        return colors
+    entry = _color_entry(choice)
+    return [entry] if entry else []
+
+
+def _unique_list(items: List[str]) -> List[str]:
+    seen = set()
+    out: List[str] = []
+    for item in items:
+        if not item:
+            continue
+        key = str(item)
+        if key in seen:
+            continue
+        seen.add(key)
+        out.append(key)
+    return out
+
+
+def skin_meta_dict(skin: Any) -> Dict[str, Any]:
+    if not skin:
+        return {}
+    raw = getattr(skin, "meta", None)
+    if not raw:
+        return {}
+    try:
+        data = json.loads(raw)
+        if isinstance(data, dict):
+            return data
+    except Exception:
+        return {}
+    return {}
+
+
+def default_brick_template(exquisite: bool) -> str:
+    roll = secrets.randbelow(10000)
+    if exquisite:
+        if roll < 100:
+            trio = ["brick_white_diamond", "brick_yellow_diamond", "brick_pink_diamond"]
+            return trio[secrets.randbelow(len(trio))]
+        if roll < 600:
+            return "brick_brushed_metal"
+        if roll < 1600:
+            return "brick_laser_gradient"
+        return "brick_normal"
+    if roll < 1000:
+        return "brick_laser_gradient"
+    return "brick_normal"
+
+def _pick_color() -> Dict[str, str]:
+    base = secrets.choice(COLOR_PALETTE)
+    return {"hex": base["hex"], "name": base["name"]}
+
+def _normalize_affinity_config(meta: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    conf = meta.get("weather_attributes") if isinstance(meta, dict) else None
+    if not isinstance(conf, dict):
+        return None
+    type_key = str(conf.get("type") or "weather").strip().lower() or "weather"
+    pool_raw = conf.get("pool") or []
+    pool: List[Tuple[str, str]] = []
+    for entry in pool_raw:
+        if isinstance(entry, dict):
+            key = str(entry.get("key") or "").strip().lower()
+            label = str(entry.get("label") or "").strip() or key
+        else:
+            key = str(entry or "").strip().lower()
+            label = key
+        if key:
+            pool.append((key, label))
+    if not pool:
+        return None
+    overrides: Dict[str, str] = {}
+    raw_overrides = conf.get("template_overrides") or {}
+    if isinstance(raw_overrides, dict):
+        for tpl, value in raw_overrides.items():
+            tpl_key = str(tpl or "").strip().lower()
+            val_key = str(value or "").strip().lower()
+            if tpl_key and val_key:
+                overrides[tpl_key] = val_key
+    return {"type": type_key, "pool": pool, "overrides": overrides}
+
+def _affinity_info_from_key(config: Dict[str, Any], key: str) -> Dict[str, str]:
+    for pool_key, label in config.get("pool", []):
+        if pool_key == key:
+            return {"type": config.get("type", "weather"), "key": key, "label": label}
+    return {"type": config.get("type", "weather"), "key": key, "label": key}
+
+def _parse_affinity_tag(tag: str) -> Optional[Tuple[str, str]]:
+    if not tag:
+        return None
+    parts = str(tag).split(":")
+    if len(parts) < 3:
+        return None
+    head = parts[0].strip().lower()
+    if head != "affinity":
+        return None
+    return parts[1].strip().lower(), parts[2].strip().lower()
+
+def _affinity_tag(info: Dict[str, str]) -> str:
+    return f"affinity:{info.get('type', 'weather')}:{info.get('key', '')}"
+
+def _pick_affinity(
+    config: Optional[Dict[str, Any]],
+    template_key: str = "",
+    *,
+    deterministic_seed: Optional[int] = None,
+) -> Optional[Dict[str, str]]:
+    if not config:
+        return None
+    tpl = str(template_key or "").strip().lower()
+    if tpl and tpl in config.get("overrides", {}):
+        key = config["overrides"][tpl]
+        return _affinity_info_from_key(config, key)
+    pool = config.get("pool", [])
+    if not pool:
+        return None
+    if deterministic_seed is not None:
+        idx = int(abs(deterministic_seed)) % len(pool)
+        key = pool[idx][0]
+        return _affinity_info_from_key(config, key)
+    key, _label = secrets.choice(pool)
+    return _affinity_info_from_key(config, key)
+
+def _affinity_info_from_tag(
+    config: Optional[Dict[str, Any]],
+    tag: str,
+) -> Optional[Dict[str, str]]:
+    parsed = _parse_affinity_tag(tag)
+    if not parsed:
+        return None
+    tag_type, tag_key = parsed
+    if config and tag_type == config.get("type"):
+        return _affinity_info_from_key(config, tag_key)
+    label = tag_key
+    return {"type": tag_type or "weather", "key": tag_key, "label": label}
+
+def generate_visual_profile(
+    rarity: str,
+    exquisite: bool,
+    *,
+    model_key: str = "",
+    skin: Any = None,
+    meta: Optional[Dict[str, Any]] = None,
+) -> Dict[str, object]:
+    rarity = (rarity or "").upper()
+    # 调用方可传入预解析的 meta（服务端来自皮肤目录缓存），避免逐抽重复 json.loads
+    if meta is None:
+        meta = skin_meta_dict(skin)
+    base_model_key = model_key or (skin.model_key if skin else "")
+    model = _resolve_model_key(base_model_key, skin)
+    if not model:
+        model = "assault"
+    affinity_config = _normalize_affinity_config(meta)
+    affinity_payload: Optional[Dict[str, str]] = None
+
+    body = _resolve_palette(meta.get("body_colors"))
+    if not body:
+        layers = 2 if secrets.randbelow(100) < 55 else 1
+        body = [_pick_color() for _ in range(layers)]
+
+    attachments = _resolve_palette(meta.get("attachment_colors"))
+    if not attachments:
+        attachments = [_pick_color()]
+
+    template_key = ""
+    template_label = ""
+    hidden_template = False
+    effects: List[str] = []
+
+    if rarity == "BRICK":
+        rule = None
+        template_rules = meta.get("template_rules")
+        if template_rules:
+            pool: List[Tuple[Dict[str, Any], int]] = []
+            for rule_entry in template_rules:
+                allow_exq = rule_entry.get("allow_exquisite", True)
+                allow_prem = rule_entry.get("allow_premium", True)
+                if exquisite and not allow_exq:
+                    continue
+                if not exquisite and not allow_prem:
+                    continue
+                weight = int(rule_entry.get("weight", 1) or 0)
+                if weight <= 0:
+                    continue
+                pool.append((rule_entry, weight))
+            if pool:
+                total = sum(weight for _, weight in pool)
+                pick = secrets.randbelow(total)
+                cursor = 0
+                for rule_entry, weight in pool:
+                    cursor += weight
+                    if pick < cursor:
+                        rule = rule_entry
+                        break
+        if rule:
+            template_key = str(rule.get("key") or "")
+            template_label = str(rule.get("label") or "")
+            hidden_template = bool(rule.get("hidden", False))
+            chosen_body = _resolve_palette(rule.get("body"))
+            if chosen_body:
+                body = chosen_body
+            chosen_att = _resolve_palette(rule.get("attachments"))
+            if chosen_att:
+                attachments = chosen_att
+            effects.extend(rule.get("effects", []))
+        else:
+            template_key = default_brick_template(bool(exquisite))
+        effects.append("sheen")
+        extra = meta.get("extra_effects", {})
+        if exquisite:
+            effects.extend(["bold_tracer", "kill_counter"])
+            effects.extend(extra.get("exquisite", []))
+        else:
+            effects.extend(extra.get("premium", []))
+        if affinity_config:
+            picked_affinity = _pick_affinity(affinity_config, template_key)
+            if picked_affinity:
+                affinity_payload = picked_affinity
+                effects.append(_affinity_tag(picked_affinity))
+    else:
+        eff_conf = meta.get("effects")
+        if isinstance(eff_conf, dict):
+            key = "exquisite" if exquisite else "premium"
+            effects.extend(eff_conf.get(key, []))
+        elif isinstance(eff_conf, list):
+            effects.extend(eff_conf)
+
+    effects = _unique_list(effects)
+    if affinity_config:
+        for tag in effects:
+            info = _affinity_info_from_tag(affinity_config, tag)
+            if info:
+                affinity_payload = info
+                break
+    if not template_label and template_key:
+        template_label = TEMPLATE_LABEL_LOOKUP.get(str(template_key).lower(), "")
+    effect_labels = [
+        EFFECT_LABEL_LOOKUP.get(str(tag).lower(), str(tag))
+        for tag in effects
+    ]
+
+    payload = {
+        "body": body,
+        "attachments": attachments,
+        "template": template_key,
+        "hidden_template": hidden_template,
+        "effects": effects,
+        "model": model,
+        "template_label": template_label,
+        "effect_labels": effect_labels,
+    }
+    if affinity_payload:
+        payload["affinity"] = affinity_payload
+        payload["affinity_tag"] = _affinity_tag(affinity_payload)
+        payload["affinity_label"] = affinity_payload.get("label", "")
+    return payload
+
+
+# ---- Odds & Pity ----
+class OddsOut(BaseModel):
+    brick: float; purple: float; blue: float; green: float
+    force_brick_next: bool; force_purple_next: bool
+    pity_brick: int; pity_purple: int
+
+
+def compute_odds(pity_brick: int, pity_purple: int, cfg: Any) -> OddsOut:
+    n = max(0, int(pity_brick or 0))
+    m = max(0, int(pity_purple or 0))
+    p_brick = cfg.p_brick_base; p_purple = cfg.p_purple_base
+    p_blue = cfg.p_blue_base;   p_green = cfg.p_green_base
+    # 65~75 抽动态提升砖皮 & 压缩其他
+    if n >= cfg.brick_ramp_start and n < cfg.brick_pity_max:
+        p_brick = p_brick + (100.0 - p_brick) * ((n - cfg.brick_ramp_start + 1) / (cfg.brick_pity_max - cfg.brick_ramp_start))
+        step = min(cfg.brick_pity_max - 1, n) - cfg.brick_ramp_start
+        if step > 0:
+            frac = max(0.0, min(1.0, step / (cfg.brick_pity_max - cfg.brick_ramp_start)))
+            c = 1.0 - cfg.compression_alpha * frac
+            p_purple_c = p_purple * c; p_blue_c = p_blue * c; p_green_c = p_green * c
+            delta = (p_purple + p_blue + p_green) - (p_purple_c + p_blue_c + p_green_c)
+            p_brick = min(100.0, p_brick + delta)
+            p_purple, p_blue, p_green = p_purple_c, p_blue_c, p_green_c
+    total = p_brick + p_purple + p_blue + p_green
+    if abs(total - 100.0) > 1e-9:
+        scale = 100.0 / total
+        p_brick *= scale; p_purple *= scale; p_blue *= scale; p_green *= scale
+    force_brick = (n + 1) >= cfg.brick_pity_max
+    force_purple = (m + 1) >= cfg.purple_pity_max
+    return OddsOut(brick=round(p_brick,6), purple=round(p_purple,6),
+                   blue=round(p_blue,6), green=round(p_green,6),
+                   force_brick_next=force_brick, force_purple_next=force_purple,
+                   pity_brick=n, pity_purple=m)
+
+ODDS_RARITIES = ("BRICK", "PURPLE", "BLUE", "GREEN")
+
+
+def odds_config_key(cfg: Any) -> Tuple[Any, ...]:
+    return (
+        float(cfg.p_brick_base), float(cfg.p_purple_base),
+        float(cfg.p_blue_base), float(cfg.p_green_base),
+        int(cfg.brick_pity_max), int(cfg.brick_ramp_start),
+        int(cfg.purple_pity_max), float(cfg.compression_alpha),
+    )
+
+
+class OddsTable:
+    """按保底状态预编译的整数 PPM 累积分布表，每个卡池配置版本构建一次。
+
+    保底计数超过上限后概率不再变化，因此查表前把 (n, m) 截断到
+    [0, brick_pity_max] × [0, purple_pity_max]。累积阈值沿用原先
+    “砖 → 紫 → 蓝/绿” 逐级判定的实际分布，单次 rng_ppm() 即可出结果。
+    """
+
+    def __init__(self, cfg: Any):
+        self.key = odds_config_key(cfg)
+        self.brick_pity_max = max(0, int(cfg.brick_pity_max or 0))
+        self.purple_pity_max = max(0, int(cfg.purple_pity_max or 0))
+        self.cdf: List[List[Tuple[int, int, int]]] = []
+        self.odds_rows: List[List[Dict[str, Any]]] = []
+        for n in range(self.brick_pity_max + 1):
+            cdf_row: List[Tuple[int, int, int]] = []
+            odds_row: List[Dict[str, Any]] = []
+            for m in range(self.purple_pity_max + 1):
+                od = compute_odds(n, m, cfg)
+                cdf_row.append(self._thresholds(od))
+                odds_row.append(od.dict())
+            self.cdf.append(cdf_row)
+            self.odds_rows.append(odds_row)
+
+    @staticmethod
+    def _thresholds(od: OddsOut) -> Tuple[int, int, int]:
+        if od.force_brick_next:
+            return (1_000_000, 1_000_000, 1_000_000)
+        brick = min(1_000_000, ppm(od.brick))
+        rest = 1_000_000 - brick
+        if od.force_purple_next:
+            purple = rest
+        else:
+            purple = rest * min(1_000_000, ppm(od.purple)) // 1_000_000
+        rest -= purple
+        blue = rest * min(1_000_000, ppm(od.blue)) // 1_000_000
+        return (brick, brick + purple, brick + purple + blue)
+
+    def _index(self, pity_brick: int, pity_purple: int) -> Tuple[int, int]:
+        n = min(self.brick_pity_max, max(0, int(pity_brick or 0)))
+        m = min(self.purple_pity_max, max(0, int(pity_purple or 0)))
+        return n, m
+
+    def odds(self, pity_brick: int, pity_purple: int) -> Dict[str, Any]:
+        n, m = self._index(pity_brick, pity_purple)
+        payload = dict(self.odds_rows[n][m])
+        payload["pity_brick"] = max(0, int(pity_brick or 0))
+        payload["pity_purple"] = max(0, int(pity_purple or 0))
+        return payload
+
+    def roll(self, pity_brick: int, pity_purple: int) -> str:
+        n, m = self._index(pity_brick, pity_purple)
+        brick, purple, blue = self.cdf[n][m]
+        r = rng_ppm()
+        if r < brick:
+            return "BRICK"
+        if r < purple:
+            return "PURPLE"
+        if r < blue:
+            return "BLUE"
+        return "GREEN"
+
+
+def advance_pity(rarity: str, pity_brick: int, pity_purple: int) -> Tuple[int, int]:
+    pity_brick = int(pity_brick or 0)
+    pity_purple = int(pity_purple or 0)
+    if rarity == "BRICK":
+        return 0, pity_purple + 1
+    if rarity == "PURPLE":
+        return pity_brick + 1, 0
+    return pity_brick + 1, pity_purple + 1
@@ -0,0 +1,227 @@
+"""离线抽卡蒙特卡洛模拟器。
+
+复用 gacha_core 的概率表与外观生成逻辑，不连接数据库，可用于调参前
+验证卡池配置的实际出货率与保底分布。
+
+    python gacha_sim.py --players 10000 --pulls 200
+    python gacha_sim.py --config pool.json --brick-pity-max 80 --json
+"""
+from __future__ import annotations
+from typing import Optional, List, Dict, Any
+from types import SimpleNamespace
+import argparse, json, secrets, time
+
+try:
+    import numpy as np
+except ImportError as exc:  # pragma: no cover - 仅离线工具依赖 numpy
+    raise ImportError("gacha_sim 需要 numpy：pip install numpy") from exc
+
+from season_data import SEASON_DEFINITIONS
+from gacha_core import ODDS_RARITIES, OddsTable, generate_visual_profile
+
+# 与 server.PoolConfigIn 的默认值保持一致
+DEFAULT_POOL_CONFIG: Dict[str, Any] = {
+    "brick_price": 100,
+    "key_price": 60,
+    "p_brick_base": 0.3,
+    "p_purple_base": 2.7,
+    "p_blue_base": 20.0,
+    "p_green_base": 77.0,
+    "brick_pity_max": 75,
+    "brick_ramp_start": 65,
+    "purple_pity_max": 20,
+    "compression_alpha": 0.5,
+}
+
+EXQUISITE_RATE_PERCENT = 15
+
+
+def pool_config(overrides: Optional[Dict[str, Any]] = None) -> SimpleNamespace:
+    data = dict(DEFAULT_POOL_CONFIG)
+    for key, value in (overrides or {}).items():
+        if key in DEFAULT_POOL_CONFIG and value is not None:
+            data[key] = type(DEFAULT_POOL_CONFIG[key])(value)
+    return SimpleNamespace(**data)
+
+
+def _brick_skins(season: Optional[str] = None) -> List[SimpleNamespace]:
+    wanted = (season or "").upper()
+    skins: List[SimpleNamespace] = []
+    for item in SEASON_DEFINITIONS:
+        sid = (item.get("id") or "").upper()
+        if wanted and sid != wanted:
+            continue
+        for brick in item.get("bricks", []) or []:
+            skins.append(SimpleNamespace(
+                skin_id=brick["skin_id"],
+                name=brick.get("name", ""),
+                rarity="BRICK",
+                season=sid,
+                weapon=brick.get("weapon", ""),
+                model_key=brick.get("model_key", ""),
+                meta=json.dumps(brick.get("meta", {}), ensure_ascii=False),
+                _meta=brick.get("meta", {}) or {},
+            ))
+    return skins
+
+
+def simulate(
+    cfg: Any,
+    *,
+    players: int = 1000,
+    pulls: int = 100,
+    seed: Optional[int] = None,
+    visual_samples: int = 2000,
+    season: Optional[str] = None,
+) -> Dict[str, Any]:
+    """模拟 players 名玩家各连续抽 pulls 次（从零保底开始），返回统计结果。
+
+    出货判定与线上一致：按 (砖保底, 紫保底) 查 OddsTable 的 PPM 累积阈值，
+    每抽对全部玩家一次性向量化掷骰。
+    """
+    players = max(1, int(players))
+    pulls = max(0, int(pulls))
+    table = OddsTable(cfg)
+    cdf = np.asarray(table.cdf, dtype=np.int64)  # (brick_pity_max+1, purple_pity_max+1, 3)
+    rng = np.random.default_rng(seed)
+
+    pity_brick = np.zeros(players, dtype=np.int64)
+    pity_purple = np.zeros(players, dtype=np.int64)
+    counts = np.zeros(len(ODDS_RARITIES), dtype=np.int64)
+    # 命中砖皮时已垫的抽数（1 表示第一抽即出）
+    brick_at = np.zeros(max(int(cfg.brick_pity_max), 1) + 2, dtype=np.int64)
+
+    started = time.perf_counter()
+    for _ in range(pulls):
+        n = np.minimum(pity_brick, table.brick_pity_max)
+        m = np.minimum(pity_purple, table.purple_pity_max)
+        thresholds = cdf[n, m]
+        r = rng.integers(0, 1_000_000, size=players, dtype=np.int64)
+        idx = (r[:, None] >= thresholds).sum(axis=1)  # 0=BRICK 1=PURPLE 2=BLUE 3=GREEN
+        counts += np.bincount(idx, minlength=len(ODDS_RARITIES))
+
+        is_brick = idx == 0
+        is_purple = idx == 1
+        if is_brick.any():
+            hit_at = np.minimum(pity_brick[is_brick] + 1, len(brick_at) - 1)
+            brick_at += np.bincount(hit_at, minlength=len(brick_at))
+        pity_brick = np.where(is_brick, 0, pity_brick + 1)
+        pity_purple = np.where(is_purple, 0, pity_purple + 1)
+    elapsed = time.perf_counter() - started
+
+    total = int(counts.sum())
+    bricks = int(counts[0])
+    rates = {
+        rarity: (int(counts[i]) / total * 100.0 if total else 0.0)
+        for i, rarity in enumerate(ODDS_RARITIES)
+    }
+    hit_pulls = np.nonzero(brick_at)[0]
+    mean_pity = float((brick_at * np.arange(len(brick_at))).sum() / bricks) if bricks else 0.0
+
+    exquisite = int(rng.binomial(bricks, EXQUISITE_RATE_PERCENT / 100.0)) if bricks else 0
+    visual = _sample_visuals(min(bricks, max(0, int(visual_samples))), season=season)
+
+    return {
+        "players": players,
+        "pulls_per_player": pulls,
+        "total_pulls": total,
+        "counts": {rarity: int(counts[i]) for i, rarity in enumerate(ODDS_RARITIES)},
+        "rates_percent": rates,
+        "brick_pity_histogram": {int(k): int(brick_at[k]) for k in hit_pulls},
+        "mean_pulls_per_brick": mean_pity,
+        "exquisite_bricks": exquisite,
+        "exquisite_rate_percent": (exquisite / bricks * 100.0) if bricks else 0.0,
+        "template_frequency": visual,
+        "elapsed_seconds": elapsed,
+        "pulls_per_second": (total / elapsed) if elapsed > 0 else 0.0,
+    }
+
+
+def _sample_visuals(samples: int, *, season: Optional[str] = None) -> Dict[str, int]:
+    """对部分砖皮命中抽样生成外观，统计模板出现次数（外观生成走 secrets，无法向量化）。"""
+    skins = _brick_skins(season)
+    freq: Dict[str, int] = {}
+    if not skins or samples <= 0:
+        return freq
+    for _ in range(samples):
+        skin = skins[secrets.randbelow(len(skins))]
+        exquisite = secrets.randbelow(100) < EXQUISITE_RATE_PERCENT
+        profile = generate_visual_profile(
+            "BRICK", exquisite, model_key=skin.model_key, skin=skin, meta=skin._meta
+        )
+        template = profile.get("template") or ""
+        freq[template] = freq.get(template, 0) + 1
+    return dict(sorted(freq.items(), key=lambda kv: -kv[1]))
+
+
+def _format_report(result: Dict[str, Any]) -> str:
+    lines = [
+        f"玩家 {result['players']} × 每人 {result['pulls_per_player']} 抽 = {result['total_pulls']} 抽",
+        f"耗时 {result['elapsed_seconds']:.3f}s（{result['pulls_per_second']:,.0f} 抽/秒）",
+        "",
+        "稀有度分布：",
+    ]
+    for rarity in ODDS_RARITIES:
+        lines.append(
+            f"  {rarity:<6} {result['counts'][rarity]:>12}  {result['rates_percent'][rarity]:8.4f}%"
+        )
+    lines.append("")
+    lines.append(f"平均 {result['mean_pulls_per_brick']:.2f} 抽出一次砖皮")
+    lines.append(
+        f"极品砖皮 {result['exquisite_bricks']}（{result['exquisite_rate_percent']:.2f}%）"
+    )
+    hist = result["brick_pity_histogram"]
+    if hist:
+        lines.append("")
+        lines.append("砖皮命中抽数分布（抽数: 次数）：")
+        for pulls, count in hist.items():
+            lines.append(f"  {pulls:>3}: {count}")
+    freq = result["template_frequency"]
+    if freq:
+        sampled = sum(freq.values())
+        lines.append("")
+        lines.append(f"模板频率（抽样 {sampled} 个砖皮）：")
+        for key, count in freq.items():
+            lines.append(f"  {key or '-':<28} {count:>8}  {count / sampled * 100:6.2f}%")
+    return "\n".join(lines)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="离线抽卡蒙特卡洛模拟")
+    parser.add_argument("--players", type=int, default=1000, help="并行模拟的玩家数")
+    parser.add_argument("--pulls", type=int, default=100, help="每名玩家的抽数")
+    parser.add_argument("--seed", type=int, default=None, help="随机种子（仅影响出货判定）")
+    parser.add_argument("--visual-samples", type=int, default=2000, help="外观抽样上限，0 表示跳过")
+    parser.add_argument("--season", default=None, help="外观抽样限定赛季，如 S1")
+    parser.add_argument("--config", default=None, help="卡池配置 JSON 文件（字段同 /admin/config）")
+    for key, default in DEFAULT_POOL_CONFIG.items():
+        parser.add_argument(f"--{key.replace('_', '-')}", dest=key, type=type(default), default=None)
+    parser.add_argument("--json", action="store_true", help="以 JSON 输出结果")
+    args = parser.parse_args(argv)
+
+    overrides: Dict[str, Any] = {}
+    if args.config:
+        with open(args.config, "r", encoding="utf-8") as fh:
+            overrides.update(json.load(fh))
+    for key in DEFAULT_POOL_CONFIG:
+        value = getattr(args, key)
+        if value is not None:
+            overrides[key] = value
+
+    result = simulate(
+        pool_config(overrides),
+        players=args.players,
+        pulls=args.pulls,
+        seed=args.seed,
+        visual_samples=args.visual_samples,
+        season=args.season,
+    )
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    else:
+        print(_format_report(result))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
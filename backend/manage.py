@@ -0,0 +1,98 @@
+"""运维命令行：迁移、皮肤种子与离线数据回填。
+
+导入 server 时会自动执行未完成的版本化迁移；以下命令用于部署脚本或手动维护。
+
+    python manage.py migrate
+    python manage.py seed --force
+    python manage.py backfill-inventory-meta --batch-size 2000
+    python manage.py settle-cookie-week
+"""
+from __future__ import annotations
+from typing import Optional, List
+import argparse, os, sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def _cmd_migrate(server, args) -> int:
+    applied = server.apply_schema_migrations()
+    done = sorted(server.SCHEMA_MIGRATIONS)
+    print(f"迁移已是最新（共 {len(done)} 个，最新编号 {done[-1] if done else 0}）")
+    if applied:
+        print("本次执行：" + ", ".join(str(v) for v in applied))
+    return 0
+
+
+def _cmd_seed(server, args) -> int:
+    with server.SessionLocal() as db:
+        changed = server.seed_skins_if_changed(db, force=args.force)
+        db.commit()
+    if changed:
+        print(f"皮肤表已按 season_data 更新（hash={server.SEASON_DATA_HASH[:12]}）")
+        print("如皮肤赛季/模型有变化，请再执行 backfill-inventory-meta")
+    else:
+        print("season_data 未变化，跳过")
+    return 0
+
+
+def _cmd_backfill_inventory_meta(server, args) -> int:
+    def progress(last_id: int, changed: int) -> None:
+        if not args.quiet:
+            print(f"  已处理至 id={last_id}，改动 {changed} 行", flush=True)
+
+    changed = server.backfill_inventory_skin_meta(batch_size=args.batch_size, progress=progress)
+    print(f"背包赛季/模型回填完成，共改动 {changed} 行")
+    if changed:
+        # 模型变化的行已清空外观缓存，这里顺带补渲染，避免上线后首批请求现场渲染
+        rendered = 0
+        while True:
+            count = server.VISUAL_BACKFILL.run_batch()
+            if not count:
+                break
+            rendered += count
+        print(f"外观缓存补渲染 {rendered} 行")
+    return 0
+
+
+def _cmd_settle_cookie_week(server, args) -> int:
+    def progress(last_user_id: int, count: int, bricks: int) -> None:
+        if not args.quiet:
+            print(f"  已结算至 user_id={last_user_id}，本批 {count} 个档案，补发砖 {bricks}", flush=True)
+
+    settlement = server.CookieWeeklySettlement(chunk_size=args.batch_size)
+    settled = settlement.run(progress=progress)
+    print(f"饼干工坊周结算完成，本次结算 {settled} 个档案")
+    return 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="三角洲抽砖运维命令")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    sub.add_parser("migrate", help="执行未完成的表结构迁移")
+
+    seed = sub.add_parser("seed", help="season_data 变化时重新写入皮肤表")
+    seed.add_argument("--force", action="store_true", help="忽略内容哈希强制写入")
+
+    backfill = sub.add_parser("backfill-inventory-meta", help="分批对齐背包行的赛季/模型")
+    backfill.add_argument("--batch-size", type=int, default=1000)
+    backfill.add_argument("--quiet", action="store_true", help="不输出逐批进度")
+
+    settle = sub.add_parser("settle-cookie-week", help="把停留在上周的饼干工坊档案结算到本周（可中断续跑）")
+    settle.add_argument("--batch-size", type=int, default=500)
+    settle.add_argument("--quiet", action="store_true", help="不输出逐批进度")
+
+    args = parser.parse_args(argv)
+    import server  # 导入即完成迁移与基础种子
+
+    handlers = {
+        "migrate": _cmd_migrate,
+        "seed": _cmd_seed,
+        "backfill-inventory-meta": _cmd_backfill_inventory_meta,
+        "settle-cookie-week": _cmd_settle_cookie_week,
+    }
+    return handlers[args.command](server, args)
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
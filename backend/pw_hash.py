@@ -0,0 +1,20 @@
+"""bcrypt 计算函数，供 server 的密码进程池调用。
+
+单独成模块是为了让进程池按模块名反序列化这些函数时只导入 bcrypt，而不是整个 server。
+spawn 子进程还会以 __mp_main__ 重新导入启动脚本，所以启动脚本（server_web.py）
+要把导入 server、构建应用放在 __mp_main__ 判断之后。
+"""
+from __future__ import annotations
+
+import bcrypt
+
+
+def hash_password(data: bytes, rounds: int) -> str:
+    return bcrypt.hashpw(data, bcrypt.gensalt(rounds=rounds)).decode("utf-8")
+
+
+def check_password(data: bytes, hashed: bytes) -> bool:
+    try:
+        return bcrypt.checkpw(data, hashed)
+    except ValueError:
+        return False
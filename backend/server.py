@@ -6,64 +6,297 @@
 # D) 兼容性：保留你原有全部接口；新增逻辑以 Router 追加，不覆盖既有路由
 # E) 重要修正：扩展段的 JWT 解析按 sub=用户名（与你原 token 一致），避免 401
 from __future__ import annotations
-from fastapi import FastAPI, Depends, HTTPException, Header, Query, Path
+from fastapi import FastAPI, Depends, HTTPException, Header, Query, Path, Request, Response
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel
-from typing import Optional, Literal, List, Dict, Any, Tuple, Set
+from typing import Optional, Literal, List, Dict, Any, Tuple, Set, Iterable, get_args
 from datetime import datetime, timedelta
-import time, os, secrets, jwt, re, json, random, math, hashlib
-import bcrypt
+import time, os, secrets, jwt, re, json, random, math, hashlib, threading, bisect, heapq, asyncio, contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import hmac, multiprocessing
+from concurrent.futures.process import BrokenProcessPool
+import pw_hash
 from sqlalchemy import (
     create_engine, Column, Integer, String, Boolean, Float,
-    ForeignKey, Text, func, UniqueConstraint
+    ForeignKey, Text, func, UniqueConstraint, insert, update, select, or_, tuple_, event, bindparam
 )
-from sqlalchemy.orm import declarative_base, sessionmaker, Session
+from sqlalchemy.orm import declarative_base, sessionmaker, Session, object_session
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 import sqlite3
 
 from season_data import SEASON_DEFINITIONS
+from gacha_core import (
+    TEMPLATE_LABEL_LOOKUP, EFFECT_LABEL_LOOKUP,
+    BRICK_TEMPLATES, BRICK_TEMPLATE_LABELS, EXQUISITE_ONLY_TEMPLATES, SPECIAL_PRICE_TEMPLATES,
+    grade_from_wear_bp, wear_random_bp, skin_meta_dict, generate_visual_profile,
+    _normalize_affinity_config, _parse_affinity_tag, _affinity_tag, _pick_affinity, _affinity_info_from_tag,
+    odds_config_key, OddsTable, advance_pity,
+)
 
 # ------------------ Config ------------------
 DB_PATH_FS = os.path.join(os.path.dirname(__file__), "delta_brick.db")
-DB_URL = os.environ.get("DELTA_DB", "sqlite:///./delta_brick.db")
+DB_URL = os.environ.get("DELTA_DB", "sqlite:///" + DB_PATH_FS)
 JWT_SECRET = os.environ.get("DELTA_JWT_SECRET", "dev-secret-change-me")
 ADMIN_KEY = os.environ.get("DELTA_ADMIN_KEY", "dev-admin-key")
 OTP_EXPIRE_SEC = 300  # 5 分钟
 OTP_FILE = "sms_codes.txt"
 
-engine = create_engine(DB_URL, connect_args={"check_same_thread": False})
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get("DELTA_DB_BUSY_TIMEOUT_MS", "15000"))
+DB_POOL_SIZE = int(os.environ.get("DELTA_DB_POOL_SIZE", "10"))
+DB_POOL_OVERFLOW = int(os.environ.get("DELTA_DB_POOL_OVERFLOW", "20"))
+
+engine = create_engine(
+    DB_URL,
+    connect_args={
+        "check_same_thread": False,
+        "timeout": SQLITE_BUSY_TIMEOUT_MS / 1000.0,
+        "cached_statements": 512,  # sqlite3 预编译语句缓存（按 SQL 文本复用）
+    },
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_POOL_OVERFLOW,
+)
 SessionLocal = sessionmaker(bind=engine, expire_on_commit=False)
-Base = declarative_base()
-http_bearer = HTTPBearer()
 
-WEAPON_NAME_ALIASES = {
-    "沙漠之鹰手枪": "deserteagle",
-    "腾龙突击步枪": "tenglong",
-    "莫辛纳甘步枪": "mosin",
-}
 
+@event.listens_for(engine, "connect")
+def _sqlite_connection_pragmas(dbapi_conn, _record):
+    # WAL 让读写互不阻塞；写锁冲突时等待 busy_timeout 而不是立刻报 "database is locked"
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.close()
 
-def _slug_weapon_name(name: str) -> str:
-    if not name:
-        return ""
-    name = name.strip()
-    if not name:
-        return ""
-    alias = WEAPON_NAME_ALIASES.get(name)
-    if alias:
-        return alias
-    lowered = name.lower()
-    slug = re.sub(r"[^a-z0-9]+", "_", lowered).strip("_")
-    slug = re.sub(r"_+", "_", slug)
-    return slug
-
-
-def _resolve_model_key(provided: str, skin: Optional[Skin]) -> str:
-    if skin and skin.weapon:
-        slug = _slug_weapon_name(skin.weapon)
-        if slug:
-            return slug
-    normalized = (provided or "").strip().lower()
-    return normalized
+
+# ---- 请求级数据库开销计数（汇总见 ROUTE_METRICS）----
+class RequestMetrics:
+    """单个请求内累计的 SQL 条数/耗时、ORM 载入行数与提交次数。
+
+    由指标中间件放进 REQUEST_METRICS；线程池里执行的查询继承同一个对象。
+    原生连接（raw_connection）的语句经 sqlite trace 回调计数，不计耗时。
+    """
+
+    __slots__ = ("statements", "sql_seconds", "rows", "commits")
+
+    def __init__(self):
+        self.statements = 0
+        self.sql_seconds = 0.0
+        self.rows = 0
+        self.commits = 0
+
+    def trace(self, statement: str) -> None:
+        if not statement.startswith(("BEGIN", "COMMIT", "ROLLBACK")):
+            self.statements += 1
+
+
+REQUEST_METRICS: contextvars.ContextVar[Optional[RequestMetrics]] = contextvars.ContextVar(
+    "request_metrics", default=None
+)
+
+
+@event.listens_for(engine, "before_cursor_execute")
+def _metrics_before_execute(conn, cursor, statement, parameters, context, executemany):
+    if REQUEST_METRICS.get() is not None:
+        conn.info["metrics_t0"] = time.perf_counter()
+
+
+@event.listens_for(engine, "after_cursor_execute")
+def _metrics_after_execute(conn, cursor, statement, parameters, context, executemany):
+    metrics = REQUEST_METRICS.get()
+    if metrics is None:
+        return
+    metrics.statements += 1
+    started = conn.info.pop("metrics_t0", None)
+    if started is not None:
+        metrics.sql_seconds += time.perf_counter() - started
+
+
+@event.listens_for(engine, "commit")
+def _metrics_commit(conn):
+    metrics = REQUEST_METRICS.get()
+    if metrics is not None:
+        metrics.commits += 1
+
+
+class RawConnection:
+    """从 engine 连接池借出的原生 sqlite3 连接，接口同 sqlite3.Connection 的常用子集。
+
+    close() 把连接还回连接池（未提交的事务会被回滚），而不是真正断开。
+    """
+
+    __slots__ = ("_conn", "_row_factory", "_metrics")
+
+    def __init__(self, row_factory: Any = None):
+        self._conn = engine.raw_connection()
+        self._row_factory = row_factory
+        self._metrics = REQUEST_METRICS.get()
+        if self._metrics is not None:
+            self._conn.dbapi_connection.set_trace_callback(self._metrics.trace)
+
+    def cursor(self):
+        cur = self._conn.cursor()
+        if self._row_factory is not None:
+            cur.row_factory = self._row_factory
+        return cur
+
+    def execute(self, sql: str, params: Any = ()):
+        cur = self.cursor()
+        cur.execute(sql, params)
+        return cur
+
+    def commit(self) -> None:
+        self._conn.commit()
+        if self._metrics is not None:
+            self._metrics.commits += 1
+
+    def rollback(self) -> None:
+        self._conn.rollback()
+
+    def close(self) -> None:
+        if self._conn is not None:
+            if self._metrics is not None:
+                self._conn.dbapi_connection.set_trace_callback(None)
+            self._conn.close()
+            self._conn = None
+
+    def __enter__(self) -> "RawConnection":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
+
+
+def raw_connection(row_factory: Any = None) -> RawConnection:
+    return RawConnection(row_factory)
+
+
+# ---- 多 worker 协调：缓存失效通道 + 后台任务租约 ----
+# 由 server_web.py --workers N 设置；单进程部署时两者都退化为本进程内操作。
+WORKER_COUNT = max(1, int(os.environ.get("DELTA_WORKERS", "1") or 1))
+WORKER_ID = f"{os.getpid()}-{secrets.token_hex(4)}"
+CACHE_BUS_POLL_SEC = float(os.environ.get("DELTA_CACHE_POLL_SEC", "0.1"))
+CACHE_EVENT_RETENTION_SEC = 3600
+
+
+class CacheBus:
+    """进程间缓存失效通道：变更追加到 cache_events 表，各 worker 在请求入口按间隔拉取。
+
+    publish() 先通知本进程的监听器再写表；broadcast() 只写表，用于本进程已自行更新
+    的场景（如价格快照）。未开启多 worker 时不写表、也不轮询。
+    """
+
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._listeners: Dict[str, List[Any]] = {}
+        self._last_id = 0
+        self._own_ids: Set[int] = set()
+        self._next_poll = 0.0
+
+    def subscribe(self, channel: str, fn) -> None:
+        self._listeners.setdefault(channel, []).append(fn)
+
+    def _dispatch(self, channel: str, key: str) -> None:
+        for fn in self._listeners.get(channel, ()):
+            try:
+                fn(key)
+            except Exception as exc:
+                print(f"[cache-bus] {channel} 处理失败：{exc}")
+
+    def publish(self, channel: str, key: Any = "") -> None:
+        self._dispatch(channel, str(key))
+        self.broadcast(channel, key)
+
+    def broadcast(self, channel: str, key: Any = "") -> None:
+        if not self.enabled:
+            return
+        now = int(time.time())
+        with raw_connection() as con:
+            cur = con.execute(
+                "INSERT INTO cache_events(channel, key, created_at) VALUES (?,?,?)",
+                (channel, str(key), now),
+            )
+            event_id = int(cur.lastrowid)
+            if event_id % 1000 == 0:
+                con.execute("DELETE FROM cache_events WHERE created_at < ?", (now - CACHE_EVENT_RETENTION_SEC,))
+            con.commit()
+        with self._lock:
+            self._own_ids.add(event_id)
+
+    def prime(self) -> None:
+        """从当前最新事件之后开始接收（进程启动时缓存都是冷的，无需回放历史）。"""
+        if not self.enabled:
+            return
+        with raw_connection() as con:
+            row = con.execute("SELECT COALESCE(MAX(id), 0) FROM cache_events").fetchone()
+        with self._lock:
+            self._last_id = max(self._last_id, int(row[0]))
+
+    def replay(self, channel: str) -> List[str]:
+        """取某通道在 prime() 位置之前仍保留的事件，供需要累计状态的缓存在启动时重建。"""
+        if not self.enabled:
+            return []
+        with self._lock:
+            last_id = self._last_id
+        with raw_connection() as con:
+            rows = con.execute(
+                "SELECT key FROM cache_events WHERE channel=? AND id <= ? ORDER BY id", (channel, last_id)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def due(self) -> bool:
+        return self.enabled and time.monotonic() >= self._next_poll
+
+    def poll(self, force: bool = False) -> int:
+        if not self.enabled:
+            return 0
+        now = time.monotonic()
+        with self._lock:
+            if not force and now < self._next_poll:
+                return 0
+            self._next_poll = now + CACHE_BUS_POLL_SEC
+            last_id = self._last_id
+        with raw_connection() as con:
+            rows = con.execute(
+                "SELECT id, channel, key FROM cache_events WHERE id > ? ORDER BY id", (last_id,)
+            ).fetchall()
+        if not rows:
+            return 0
+        fresh: List[Tuple[str, str]] = []
+        with self._lock:
+            for event_id, channel, key in rows:
+                if event_id <= self._last_id:
+                    continue
+                if event_id in self._own_ids:
+                    self._own_ids.discard(event_id)
+                    continue
+                fresh.append((channel, key))
+            self._last_id = max(self._last_id, int(rows[-1][0]))
+        for channel, key in fresh:
+            self._dispatch(channel, key)
+        return len(fresh)
+
+
+CACHE_BUS = CacheBus(enabled=WORKER_COUNT > 1)
+
+
+def acquire_worker_lease(name: str, ttl: int) -> bool:
+    """多 worker 下只让一个进程执行某项后台任务；持有者在 ttl 内续约，过期后由其他进程接手。"""
+    if not CACHE_BUS.enabled:
+        return True
+    now = int(time.time())
+    with raw_connection() as con:
+        cur = con.execute(
+            """INSERT INTO worker_leases(name, owner, expires_at) VALUES (?,?,?)
+               ON CONFLICT(name) DO UPDATE SET owner=excluded.owner, expires_at=excluded.expires_at
+               WHERE worker_leases.owner=excluded.owner OR worker_leases.expires_at < ?""",
+            (name, WORKER_ID, now + int(ttl), now),
+        )
+        con.commit()
+        return cur.rowcount > 0
+Base = declarative_base()
+http_bearer = HTTPBearer()
 
 # ------------------ ORM ------------------
 class User(Base):
@@ -123,6 +356,7 @@ class Inventory(Base):
     lock_reason = Column(String, default="")
     season = Column(String, default="")
     model_key = Column(String, default="")
+    visual_payload = Column(String, default="")     # JSON: 预渲染外观，见 render_visual_payload
 
 class SystemSetting(Base):
     __tablename__ = "system_settings"
@@ -317,18 +551,15 @@ class CookieFactoryProfile(Base):
     prestige = Column(Integer, default=0)
     prestige_points = Column(Integer, default=0)
     sugar_lumps = Column(Integer, default=0)
-    buildings = Column(Text, default="{}")
-    mini_games = Column(Text, default="{}")
-    active_points = Column(Text, default="{}")
-    login_days = Column(Text, default="{}")
+    # 建筑、小游戏、按日活跃/签到/挑战、修仙存档见下方子表（迁移 16 之前是本表的 JSON 列）
     login_streak = Column(Integer, default=0)
     last_login_day = Column(String, default="")
-    challenge_clicks = Column(Text, default="{}")
     week_start_ts = Column(Integer, default=0)
     last_active_ts = Column(Integer, default=0)
     golden_ready_ts = Column(Integer, default=0)
     golden_cooldown = Column(Integer, default=0)
     production_bonus_multiplier = Column(Float, default=1.0)
+    production_cps = Column(Float, nullable=True)  # 基础产量系数缓存，建筑/升天/小游戏等级变化时置空
     pending_bonus_multiplier = Column(Float, default=1.0)
     penalty_multiplier = Column(Float, default=1.0)
     pending_penalty_multiplier = Column(Float, default=1.0)
@@ -340,6 +571,53 @@ class CookieFactoryProfile(Base):
     last_sugar_ts = Column(Integer, default=0)
 
 
+class CookieFactoryBuilding(Base):
+    __tablename__ = "cookie_factory_buildings"
+    user_id = Column(Integer, ForeignKey("cookie_factory_profiles.user_id"), primary_key=True)
+    building = Column(String, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+
+class CookieFactoryMiniGame(Base):
+    __tablename__ = "cookie_factory_mini_games"
+    user_id = Column(Integer, ForeignKey("cookie_factory_profiles.user_id"), primary_key=True)
+    mini = Column(String, primary_key=True)
+    level = Column(Integer, nullable=False, default=0)
+    progress = Column(Integer, nullable=False, default=0)
+    last_action = Column(Integer, nullable=False, default=0)
+
+
+class CookieFactoryDay(Base):
+    """按自然日记录活跃度、签到与点击挑战；周结算清空前两项，挑战点击保留作历史。"""
+    __tablename__ = "cookie_factory_days"
+    user_id = Column(Integer, ForeignKey("cookie_factory_profiles.user_id"), primary_key=True)
+    day = Column(String, primary_key=True)  # YYYY-MM-DD
+    active_points = Column(Integer, nullable=False, default=0)
+    login_ts = Column(Integer, nullable=True)  # 签到日 0 点；未签到为 NULL
+    challenge_clicks = Column(Integer, nullable=False, default=0)
+
+
+class CookieCultivationState(Base):
+    """修仙存档（含进行中的历练，体积较大）；单独成表，点饼干不会重写它。"""
+    __tablename__ = "cookie_cultivation_states"
+    user_id = Column(Integer, ForeignKey("cookie_factory_profiles.user_id"), primary_key=True)
+    best_score = Column(Integer, nullable=False, default=0)
+    play_count = Column(Integer, nullable=False, default=0)
+    node = Column(Text, nullable=False, default="{}")
+
+
+class CookieSettlementRun(Base):
+    """周结算批处理进度：每个结算周一行，记录已处理到的 user_id，进程中断后从断点继续。"""
+    __tablename__ = "cookie_settlement_runs"
+    week_start = Column(Integer, primary_key=True)
+    last_user_id = Column(Integer, nullable=False, default=0)
+    settled = Column(Integer, nullable=False, default=0)
+    bricks = Column(Integer, nullable=False, default=0)
+    started_at = Column(Integer, nullable=False, default=0)
+    updated_at = Column(Integer, nullable=False, default=0)
+    finished_at = Column(Integer, nullable=True)
+
+
 class TradeLog(Base):
     __tablename__ = "trade_logs"
     id = Column(Integer, primary_key=True)
@@ -374,8 +652,49 @@ class UserSeasonPity(Base):
     pity_purple = Column(Integer, nullable=False, default=0)
     __table_args__ = (UniqueConstraint("user_id", "season", name="uq_user_season_pity"),)
 
+# ---- 版本化迁移：每个编号只执行一次，已执行编号记录在 schema_migrations ----
+# 新增表结构改动时追加新的编号函数，不要修改已发布的编号。
+SCHEMA_MIGRATIONS: Dict[int, Tuple[str, Any]] = {}
+
+
+def schema_migration(version: int, name: str):
+    def register(fn):
+        if version in SCHEMA_MIGRATIONS:
+            raise RuntimeError(f"迁移编号重复：{version}")
+        SCHEMA_MIGRATIONS[version] = (name, fn)
+        return fn
+    return register
+
+
+def apply_schema_migrations() -> List[int]:
+    """执行尚未记录的迁移，返回本次执行的编号。"""
+    with raw_connection() as con:
+        con.execute("""CREATE TABLE IF NOT EXISTS schema_migrations(
+            version    INTEGER PRIMARY KEY,
+            name       TEXT NOT NULL,
+            applied_at INTEGER NOT NULL
+        )""")
+        con.commit()
+        done = {int(row[0]) for row in con.execute("SELECT version FROM schema_migrations").fetchall()}
+    applied: List[int] = []
+    for version in sorted(SCHEMA_MIGRATIONS):
+        if version in done:
+            continue
+        name, fn = SCHEMA_MIGRATIONS[version]
+        fn()
+        with raw_connection() as con:
+            con.execute(
+                "INSERT OR IGNORE INTO schema_migrations(version, name, applied_at) VALUES (?,?,?)",
+                (version, name, int(time.time())),
+            )
+            con.commit()
+        applied.append(version)
+    return applied
+
+
+@schema_migration(1, "users.session_ver")
 def _ensure_user_sessionver():
-    con = sqlite3.connect(DB_PATH_FS)
+    con = raw_connection()
     cur = con.cursor()
     cur.execute("PRAGMA table_info(users)")
     cols = [row[1] for row in cur.fetchall()]
@@ -384,8 +703,9 @@ def _ensure_user_sessionver():
         con.commit()
     con.close()
 
+@schema_migration(2, "inventory 外观列")
 def _ensure_inventory_visual_columns():
-    con = sqlite3.connect(DB_PATH_FS)
+    con = raw_connection()
     cur = con.cursor()
     cur.execute("PRAGMA table_info(inventory)")
     cols = {row[1] for row in cur.fetchall()}
@@ -407,12 +727,15 @@ def _ensure_inventory_visual_columns():
         cur.execute("ALTER TABLE inventory ADD COLUMN season TEXT NOT NULL DEFAULT ''")
     if "model_key" not in cols:
         cur.execute("ALTER TABLE inventory ADD COLUMN model_key TEXT NOT NULL DEFAULT ''")
+    if "visual_payload" not in cols:
+        cur.execute("ALTER TABLE inventory ADD COLUMN visual_payload TEXT NOT NULL DEFAULT ''")
     con.commit()
     con.close()
 
 
+@schema_migration(3, "skins 赛季/武器/模型/meta")
 def _ensure_skin_extended_columns():
-    con = sqlite3.connect(DB_PATH_FS)
+    con = raw_connection()
     cur = con.cursor()
     cur.execute("PRAGMA table_info(skins)")
     cols = {row[1] for row in cur.fetchall()}
@@ -428,8 +751,9 @@ def _ensure_skin_extended_columns():
     con.close()
 
 
+@schema_migration(4, "trade_logs.season")
 def _ensure_trade_log_columns():
-    con = sqlite3.connect(DB_PATH_FS)
+    con = raw_connection()
     cur = con.cursor()
     cur.execute("PRAGMA table_info(trade_logs)")
     cols = {row[1] for row in cur.fetchall()}
@@ -439,8 +763,9 @@ def _ensure_trade_log_columns():
     con.close()
 
 
+@schema_migration(5, "brick_sell_orders.season")
 def _ensure_brick_sell_columns():
-    con = sqlite3.connect(DB_PATH_FS)
+    con = raw_connection()
     cur = con.cursor()
     cur.execute("PRAGMA table_info(brick_sell_orders)")
     cols = {row[1] for row in cur.fetchall()}
@@ -450,8 +775,22 @@ def _ensure_brick_sell_columns():
     con.close()
 
 
+@schema_migration(7, "交易行浏览索引")
+def _ensure_market_browse_indexes():
+    con = raw_connection()
+    cur = con.cursor()
+    # 交易行分页：(active, 排序列, id) 供游标翻页；背包侧覆盖 on_market + 常用筛选列
+    cur.execute("CREATE INDEX IF NOT EXISTS ix_market_active_price ON market (active, price, id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS ix_market_active_created ON market (active, created_at, id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS ix_inventory_market_rarity ON inventory (on_market, rarity, wear_bp)")
+    cur.execute("CREATE INDEX IF NOT EXISTS ix_inventory_market_skin ON inventory (on_market, skin_id, exquisite, grade)")
+    con.commit()
+    con.close()
+
+
+@schema_migration(6, "brick_buy_orders.season")
 def _ensure_brick_buy_columns():
-    con = sqlite3.connect(DB_PATH_FS)
+    con = raw_connection()
     cur = con.cursor()
     cur.execute("PRAGMA table_info(brick_buy_orders)")
     cols = {row[1] for row in cur.fetchall()}
@@ -469,12 +808,208 @@ def _season_skin_entries():
                 yield sid, item
 
 
+class GachaSkinPool:
+    """按 (rarity, season) 分桶的可用皮肤池，整批抽卡在内存中选取。"""
+
+    def __init__(self, skins: List[Skin], meta: Optional[Dict[str, Dict[str, Any]]] = None):
+        self.by_id: Dict[str, Skin] = {}
+        self.by_rarity: Dict[str, List[Skin]] = {}
+        self.by_key: Dict[Tuple[str, str], List[Skin]] = {}
+        self._meta: Dict[str, Dict[str, Any]] = meta if meta is not None else {}
+        for skin in skins:
+            self.by_id[str(skin.skin_id)] = skin
+            self.by_rarity.setdefault(skin.rarity, []).append(skin)
+            season_key = str(skin.season or "").strip().upper()
+            self.by_key.setdefault((skin.rarity, season_key), []).append(skin)
+
+    def meta(self, skin: Skin) -> Dict[str, Any]:
+        key = str(skin.skin_id)
+        cached = self._meta.get(key)
+        if cached is None:
+            cached = skin_meta_dict(skin)
+            self._meta[key] = cached
+        return cached
+
+    def draw(self, rarity: str, season: Optional[str] = None, preferred_skin_id: Optional[str] = None) -> Skin:
+        season_key = _normalize_season(season)
+        if season_key:
+            rows = self.by_key.get((rarity, season_key), [])
+        else:
+            rows = self.by_rarity.get(rarity, [])
+        if preferred_skin_id:
+            pref = self.by_id.get(str(preferred_skin_id))
+            if pref and pref.rarity == rarity:
+                if not season_key or _normalize_season(pref.season) == season_key:
+                    return pref
+        if not rows:
+            rows = self.by_rarity.get(rarity, [])
+        if not rows: raise HTTPException(500, f"当前没有可用的 {rarity} 皮肤")
+        return secrets.choice(rows)
+
+
+class SkinCatalog:
+    """进程内皮肤目录缓存：预解析全部皮肤及其 meta，版本号变化后懒加载重建。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.version = 0
+        self._loaded_version = -1
+        self._by_id: Dict[str, Skin] = {}
+        self._meta: Dict[str, Dict[str, Any]] = {}
+        self._pool: Optional[GachaSkinPool] = None
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self.version += 1
+
+    def _ensure_loaded(self) -> None:
+        if self._loaded_version == self.version and self._pool is not None:
+            return
+        with self._lock:
+            if self._loaded_version == self.version and self._pool is not None:
+                return
+            target_version = self.version
+            with SessionLocal() as db:
+                rows = db.query(Skin).all()
+                db.expunge_all()
+            by_id = {str(row.skin_id): row for row in rows}
+            meta = {key: skin_meta_dict(row) for key, row in by_id.items()}
+            self._pool = GachaSkinPool([row for row in rows if row.active], meta=meta)
+            self._by_id = by_id
+            self._meta = meta
+            self._loaded_version = target_version
+
+    def pool(self) -> "GachaSkinPool":
+        self._ensure_loaded()
+        return self._pool
+
+    def get(self, skin_id: Optional[str]) -> Optional[Skin]:
+        if not skin_id:
+            return None
+        self._ensure_loaded()
+        return self._by_id.get(str(skin_id))
+
+    def skin_map(self, skin_ids) -> Dict[str, Skin]:
+        self._ensure_loaded()
+        return {sid: self._by_id[sid] for sid in skin_ids if sid in self._by_id}
+
+    def meta(self, skin: Optional[Skin]) -> Dict[str, Any]:
+        if not skin:
+            return {}
+        self._ensure_loaded()
+        cached = self._meta.get(str(skin.skin_id))
+        if cached is None:
+            return skin_meta_dict(skin)
+        return cached
+
+
+SKIN_CATALOG = SkinCatalog()
+CACHE_BUS.subscribe("skins", lambda _key: SKIN_CATALOG.invalidate())
+
+
+class SystemSettingsRegistry:
+    """system_settings 的进程内副本：整表一次载入，读走内存。
+
+    写入经 set() 落到会话里，提交成功后才更新副本并通知其他 worker；
+    同一会话内提交前的读取能看到自己待提交的值。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values: Optional[Dict[str, str]] = None
+        # apply()/invalidate() 每次加一；读库期间代数变了，说明读到的可能是改动前的快照
+        self._generation = 0
+
+    def _load(self) -> Dict[str, str]:
+        values = self._values
+        if values is not None:
+            return values
+        for _ in range(3):
+            with self._lock:
+                generation = self._generation
+            with SessionLocal() as db:
+                values = {row.key: str(row.value) for row in db.query(SystemSetting).all()}
+            with self._lock:
+                if self._generation == generation:
+                    if self._values is None:
+                        self._values = values
+                    return self._values
+        # 连续被改动打断时本次直接用最后读到的快照，不写入缓存
+        return values
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._generation += 1
+            self._values = None
+
+    def get(self, key: str, default: Optional[str] = None, db: Optional[Session] = None) -> Optional[str]:
+        if db is not None:
+            pending = db.info.get("system_settings_pending")
+            if pending and key in pending:
+                return pending[key]
+        return self._load().get(key, default)
+
+    def flag(self, key: str, default: bool, db: Optional[Session] = None) -> bool:
+        value = self.get(key, None, db)
+        if value is None:
+            return default
+        return str(value) != "0"
+
+    def set(self, db: Session, key: str, value: Any) -> None:
+        value = str(value)
+        row = db.get(SystemSetting, key)
+        if row:
+            row.value = value
+        else:
+            db.add(SystemSetting(key=key, value=value))
+        db.flush()
+        db.info.setdefault("system_settings_pending", {})[key] = value
+
+    def apply(self, changes: Dict[str, str]) -> None:
+        with self._lock:
+            self._generation += 1
+            if self._values is not None:
+                self._values.update(changes)
+
+
+SYSTEM_SETTINGS = SystemSettingsRegistry()
+CACHE_BUS.subscribe("settings", lambda _key: SYSTEM_SETTINGS.invalidate())
+
+
+@event.listens_for(SessionLocal, "after_commit")
+def _apply_settings_after_commit(session):
+    changes = session.info.pop("system_settings_pending", None)
+    if changes:
+        SYSTEM_SETTINGS.apply(changes)
+        for key in changes:
+            CACHE_BUS.broadcast("settings", key)
+
+
+@event.listens_for(SessionLocal, "after_rollback")
+def _drop_settings_changes(session):
+    session.info.pop("system_settings_pending", None)
+
+
+@event.listens_for(SessionLocal, "after_commit")
+def _invalidate_skins_after_commit(session):
+    if session.info.pop("skins_changed", False):
+        CACHE_BUS.publish("skins")
+
+
+@event.listens_for(SessionLocal, "after_rollback")
+def _drop_skins_changes(session):
+    session.info.pop("skins_changed", None)
+
+
 def _seed_skins(db: Session):
     existing = {row.skin_id: row for row in db.query(Skin).all()}
+    restyled: List[str] = []
     for season_id, data in _season_skin_entries():
         meta_json = json.dumps(data.get("meta", {}), ensure_ascii=False)
         row = existing.get(data["skin_id"])
         if row:
+            if (row.meta or "{}") != meta_json or (row.model_key or "") != data.get("model_key", ""):
+                restyled.append(row.skin_id)
             row.name = data["name"]
             row.rarity = data["rarity"]
             row.active = True
@@ -494,28 +1029,83 @@ def _seed_skins(db: Session):
                 meta=meta_json,
             ))
     db.flush()
+    # 外观渲染依赖皮肤 meta（含亲和配置）和模型：这些变了的皮肤，其背包行的预渲染结果
+    # （包括渲染失败标记）一并作废，由 VisualBackfill 按新数据重渲染
+    for start in range(0, len(restyled), 500):
+        db.query(Inventory).filter(Inventory.skin_id.in_(restyled[start:start + 500])).update(
+            {Inventory.visual_payload: ""}, synchronize_session=False
+        )
+    # 提交后再让目录失效：提交前失效的话，并发的重建会读到旧表并缓存下来
+    db.info["skins_changed"] = True
 
 
-def sync_inventory_skin_meta(db: Session):
-    skins = {s.skin_id: s for s in db.query(Skin).all()}
-    rows = db.query(Inventory).all()
-    changed = False
-    for inv in rows:
-        skin = skins.get(inv.skin_id)
-        if not skin:
-            continue
-        if (inv.season or "").upper() != (skin.season or "").upper():
-            inv.season = skin.season or ""
-            changed = True
-        model_key = skin.model_key or ""
-        if (inv.model_key or "") != model_key:
-            inv.model_key = model_key
-            changed = True
-    if changed:
-        db.flush()
+SEASON_DATA_HASH_KEY = "season_data_hash"
+SEASON_DATA_HASH = hashlib.sha256(
+    json.dumps(SEASON_DEFINITIONS, ensure_ascii=False, sort_keys=True).encode("utf-8")
+).hexdigest()
+
 
+def seed_skins_if_changed(db: Session, force: bool = False) -> bool:
+    """season_data 内容哈希与库中记录不同（或 force）时才重新写入皮肤表。"""
+    row = db.get(SystemSetting, SEASON_DATA_HASH_KEY)
+    if not force and row is not None and row.value == SEASON_DATA_HASH:
+        return False
+    _seed_skins(db)
+    if row is None:
+        db.add(SystemSetting(key=SEASON_DATA_HASH_KEY, value=SEASON_DATA_HASH))
+    else:
+        row.value = SEASON_DATA_HASH
+    return True
+
+
+def backfill_inventory_skin_meta(batch_size: int = 1000, progress=None) -> int:
+    """离线批量把背包行的赛季/模型对齐到皮肤表，返回改动行数。
+
+    按 id 分批提交，不会一次载入整张 inventory；模型变化的行清空 visual_payload，
+    由 VisualBackfill 重新渲染。用法：python manage.py backfill-inventory-meta
+    """
+    batch_size = max(1, int(batch_size))
+    with SessionLocal() as db:
+        skins = {s.skin_id: (s.season or "", s.model_key or "") for s in db.query(Skin).all()}
+    changed_total = 0
+    last_id = 0
+    while True:
+        with SessionLocal() as db:
+            rows = (
+                db.query(Inventory)
+                .filter(Inventory.id > last_id)
+                .order_by(Inventory.id.asc())
+                .limit(batch_size)
+                .all()
+            )
+            if not rows:
+                break
+            last_id = rows[-1].id
+            changed = 0
+            for inv in rows:
+                meta = skins.get(inv.skin_id)
+                if not meta:
+                    continue
+                season, model_key = meta
+                dirty = False
+                if (inv.season or "").upper() != season.upper():
+                    inv.season = season
+                    dirty = True
+                if (inv.model_key or "") != model_key:
+                    inv.model_key = model_key
+                    inv.visual_payload = ""
+                    dirty = True
+                changed += dirty
+            if changed:
+                db.commit()
+            changed_total += changed
+        if progress:
+            progress(last_id, changed_total)
+    return changed_total
+
+@schema_migration(8, "users 赠送余额列")
 def _ensure_user_gift_columns():
-    con = sqlite3.connect(DB_PATH_FS)
+    con = raw_connection()
     cur = con.cursor()
     cur.execute("PRAGMA table_info(users)")
     cols = {row[1] for row in cur.fetchall()}
@@ -530,8 +1120,9 @@ def _ensure_user_gift_columns():
     con.commit()
     con.close()
 
+@schema_migration(9, "users.password_plain")
 def _ensure_user_password_plain():
-    con = sqlite3.connect(DB_PATH_FS)
+    con = raw_connection()
     cur = con.cursor()
     cur.execute("PRAGMA table_info(users)")
     cols = {row[1] for row in cur.fetchall()}
@@ -540,8 +1131,9 @@ def _ensure_user_password_plain():
     con.commit()
     con.close()
 
+@schema_migration(10, "cookie_factory_profiles 扩展列")
 def _ensure_cookie_profile_columns():
-    con = sqlite3.connect(DB_PATH_FS)
+    con = raw_connection()
     cur = con.cursor()
     cur.execute("PRAGMA table_info(cookie_factory_profiles)")
     cols = {row[1] for row in cur.fetchall()}
@@ -561,16 +1153,219 @@ def _ensure_cookie_profile_columns():
     con.commit()
     con.close()
 
+
+@schema_migration(11, "sms_rate 表")
+def _ensure_sms_rate_table():
+    # 已发布的编号保留为空操作：sms_rate 已不再使用，旧库里的表由迁移 19 删除
+    pass
+
+
+# 管理员/充值扩展（文件末尾 ext 路由）用到的列和表；须在首次 apply_schema_migrations() 之前登记
+@schema_migration(12, "管理员/充值扩展表")
+def _migrate_ext():
+    con=raw_connection(); cur=con.cursor()
+    # users 增加 is_admin（如果不存在）
+    cur.execute("PRAGMA table_info(users)")
+    cols = [row[1] for row in cur.fetchall()]
+    if "is_admin" not in cols:
+        cur.execute("ALTER TABLE users ADD COLUMN is_admin INTEGER NOT NULL DEFAULT 0")
+    if "last_login_ts" not in cols:
+        cur.execute("ALTER TABLE users ADD COLUMN last_login_ts INTEGER NOT NULL DEFAULT 0")
+    if "admin_note" not in cols:
+        cur.execute("ALTER TABLE users ADD COLUMN admin_note TEXT NOT NULL DEFAULT ''")
+    # admin_pending
+    cur.execute("""CREATE TABLE IF NOT EXISTS admin_pending(
+      username TEXT PRIMARY KEY,
+      code TEXT NOT NULL,
+      expire_at INTEGER NOT NULL
+    )""")
+    # topup_codes
+    cur.execute("""CREATE TABLE IF NOT EXISTS topup_codes(
+      username TEXT NOT NULL,
+      code TEXT NOT NULL,
+      amount INTEGER NOT NULL,
+      expire_at INTEGER NOT NULL
+    )""")
+    # + 新增：管理员删号验证码表
+    cur.execute("""CREATE TABLE IF NOT EXISTS admin_deluser_codes(
+      target_username TEXT NOT NULL,
+      code TEXT NOT NULL,
+      requested_by TEXT NOT NULL,
+      expire_at INTEGER NOT NULL
+    )""")
+    cur.execute("""CREATE TABLE IF NOT EXISTS admin_password_codes(
+      target_id INTEGER NOT NULL,
+      code TEXT NOT NULL,
+      requested_by TEXT NOT NULL,
+      expire_at INTEGER NOT NULL
+    )""")
+
+    con.commit(); con.close()
+
+
+@schema_migration(13, "cache_events / worker_leases 表")
+def _ensure_worker_coordination_tables():
+    con = raw_connection()
+    con.execute("""CREATE TABLE IF NOT EXISTS cache_events(
+        id         INTEGER PRIMARY KEY AUTOINCREMENT,
+        channel    TEXT NOT NULL,
+        key        TEXT NOT NULL DEFAULT '',
+        created_at INTEGER NOT NULL
+    )""")
+    con.execute("""CREATE TABLE IF NOT EXISTS worker_leases(
+        name       TEXT PRIMARY KEY,
+        owner      TEXT NOT NULL,
+        expires_at INTEGER NOT NULL
+    )""")
+    con.commit()
+    con.close()
+
+
+@schema_migration(14, "otp_events 表")
+def _ensure_otp_events_table():
+    con = raw_connection()
+    con.execute("""CREATE TABLE IF NOT EXISTS otp_events(
+        id         INTEGER PRIMARY KEY AUTOINCREMENT,
+        purpose    TEXT NOT NULL,
+        tag        TEXT NOT NULL,
+        code       TEXT NOT NULL,
+        amount     INTEGER,
+        extra      TEXT NOT NULL DEFAULT '',
+        created_at INTEGER NOT NULL,
+        expire_at  INTEGER NOT NULL
+    )""")
+    # 管理员日志：按 expire_at 只扫仍可能有效的行，再按 (purpose, tag) 取最新一条
+    con.execute("CREATE INDEX IF NOT EXISTS ix_otp_events_expire ON otp_events (expire_at)")
+    con.execute("CREATE INDEX IF NOT EXISTS ix_otp_events_key ON otp_events (purpose, tag, id)")
+    con.commit()
+    con.close()
+
+
+@schema_migration(15, "rate_limit_state 表")
+def _ensure_rate_limit_table():
+    con = raw_connection()
+    con.execute("""CREATE TABLE IF NOT EXISTS rate_limit_state(
+        policy     TEXT NOT NULL,
+        key        TEXT NOT NULL,
+        state      TEXT NOT NULL,
+        updated_at INTEGER NOT NULL,
+        PRIMARY KEY (policy, key)
+    )""")
+    con.execute("CREATE INDEX IF NOT EXISTS ix_rate_limit_updated ON rate_limit_state (updated_at)")
+    con.commit()
+    con.close()
+
+
+@schema_migration(19, "删除 sms_rate 表")
+def _drop_sms_rate_table():
+    # 验证码冷却已改由 RATE_LIMITER（rate_limit_state 表）负责，迁移 11 建的旧表不再使用
+    con = raw_connection()
+    con.execute("DROP TABLE IF EXISTS sms_rate")
+    con.commit()
+    con.close()
+
+
+@schema_migration(20, "rate_limit_state.reset_at 列")
+def _ensure_rate_limit_reset_column():
+    con = raw_connection()
+    cols = {row[1] for row in con.execute("PRAGMA table_info(rate_limit_state)").fetchall()}
+    if "reset_at" not in cols:
+        con.execute("ALTER TABLE rate_limit_state ADD COLUMN reset_at REAL NOT NULL DEFAULT 0")
+    con.commit()
+    con.close()
+
+
+@schema_migration(17, "cookie_factory_profiles.production_cps 列")
+def _ensure_cookie_production_column():
+    con = raw_connection()
+    cols = {row[1] for row in con.execute("PRAGMA table_info(cookie_factory_profiles)").fetchall()}
+    if "production_cps" not in cols:
+        con.execute("ALTER TABLE cookie_factory_profiles ADD COLUMN production_cps FLOAT")
+    con.commit()
+    con.close()
+
+
+@schema_migration(18, "cookie_factory_profiles 周起点索引")
+def _ensure_cookie_week_index():
+    # 周结算批处理按 week_start_ts < 本周 找待结算档案；已结算完时这条索引让检查只读一页
+    con = raw_connection()
+    con.execute("CREATE INDEX IF NOT EXISTS ix_cookie_profiles_week_start ON cookie_factory_profiles (week_start_ts, user_id)")
+    con.commit()
+    con.close()
+
+
+COOKIE_LEGACY_JSON_COLUMNS = ("buildings", "mini_games", "active_points", "login_days", "challenge_clicks")
+
+
+@schema_migration(16, "饼干工坊 JSON 列拆分为子表")
+def _split_cookie_profile_json():
+    def obj(raw: Any) -> Dict[str, Any]:
+        try:
+            data = json.loads(raw) if raw else {}
+        except Exception:
+            data = {}
+        return data if isinstance(data, dict) else {}
+
+    def num(value: Any) -> int:
+        try:
+            return int(value or 0)
+        except (TypeError, ValueError):
+            return 0
+
+    con = raw_connection()
+    cols = {row[1] for row in con.execute("PRAGMA table_info(cookie_factory_profiles)").fetchall()}
+    legacy = [c for c in COOKIE_LEGACY_JSON_COLUMNS if c in cols]
+    if not legacy:
+        con.close()
+        return
+    select_cols = ", ".join(c if c in legacy else "NULL" for c in COOKIE_LEGACY_JSON_COLUMNS)
+    buildings, minis, days, cultivation = [], [], [], []
+    for user_id, b_raw, m_raw, a_raw, l_raw, c_raw in con.execute(
+        f"SELECT user_id, {select_cols} FROM cookie_factory_profiles"
+    ).fetchall():
+        for key, count in obj(b_raw).items():
+            if num(count) > 0:
+                buildings.append((user_id, str(key), num(count)))
+        for key, node in obj(m_raw).items():
+            if not isinstance(node, dict):
+                continue
+            if key == "cultivation":
+                cultivation.append((user_id, num(node.get("best_score") or node.get("best")),
+                                    num(node.get("play_count") or node.get("count")),
+                                    json.dumps(node, ensure_ascii=False)))
+            else:
+                minis.append((user_id, str(key), num(node.get("level")), num(node.get("progress")),
+                              num(node.get("last_action"))))
+        per_day: Dict[str, List[Any]] = {}
+        for day, pts in obj(a_raw).items():
+            per_day.setdefault(str(day), [0, None, 0])[0] = num(pts)
+        for day, info in obj(l_raw).items():
+            per_day.setdefault(str(day), [0, None, 0])[1] = num(info.get("ts") if isinstance(info, dict) else 0)
+        for day, clicks in obj(c_raw).items():
+            per_day.setdefault(str(day), [0, None, 0])[2] = num(clicks)
+        days.extend((user_id, day, v[0], v[1], v[2]) for day, v in per_day.items())
+    cur = con.cursor()
+    cur.executemany("INSERT OR REPLACE INTO cookie_factory_buildings(user_id, building, count) VALUES (?,?,?)", buildings)
+    cur.executemany(
+        "INSERT OR REPLACE INTO cookie_factory_mini_games(user_id, mini, level, progress, last_action) VALUES (?,?,?,?,?)",
+        minis,
+    )
+    cur.executemany(
+        "INSERT OR REPLACE INTO cookie_factory_days(user_id, day, active_points, login_ts, challenge_clicks) VALUES (?,?,?,?,?)",
+        days,
+    )
+    cur.executemany(
+        "INSERT OR REPLACE INTO cookie_cultivation_states(user_id, best_score, play_count, node) VALUES (?,?,?,?)",
+        cultivation,
+    )
+    con.execute(f"UPDATE cookie_factory_profiles SET {', '.join(f'{c} = NULL' for c in legacy)}")
+    con.commit()
+    con.close()
+
+
 Base.metadata.create_all(engine)
-_ensure_user_sessionver()
-_ensure_inventory_visual_columns()
-_ensure_skin_extended_columns()
-_ensure_trade_log_columns()
-_ensure_brick_sell_columns()
-_ensure_brick_buy_columns()
-_ensure_user_gift_columns()
-_ensure_user_password_plain()
-_ensure_cookie_profile_columns()
+apply_schema_migrations()
+CACHE_BUS.prime()
 
 # ------------------ Pydantic ------------------
 RarityT = Literal["BRICK", "PURPLE", "BLUE", "GREEN"]
@@ -639,21 +1434,34 @@ class FriendTargetIn(BaseModel):
     target_id: int
 
 
+CookieActionType = Literal[
+    "click",
+    "buy_building",
+    "golden",
+    "mini",
+    "claim",
+    "prestige",
+    "sugar",
+]
+COOKIE_ACTION_TYPES = frozenset(get_args(CookieActionType))
+
+
 class CookieActIn(BaseModel):
-    type: Literal[
-        "click",
-        "buy_building",
-        "golden",
-        "mini",
-        "claim",
-        "prestige",
-        "sugar",
-    ]
+    type: CookieActionType
     amount: Optional[int] = 1
     building: Optional[str] = None
     mini: Optional[str] = None
 
 
+class CookieBatchActionIn(CookieActIn):
+    type: str  # 逐个在接口里校验，未知类型只记入该操作的 errors，不让整批 422
+    ts: Optional[int] = None  # 客户端记录的操作时间（秒）
+
+
+class CookieBatchIn(BaseModel):
+    actions: List[CookieBatchActionIn] = []
+
+
 class StarfallRunIn(BaseModel):
     score: int
     day: int
@@ -733,12 +1541,207 @@ class MarketBrowseOut(BaseModel):
 # ------------------ App & Utils ------------------
 app = FastAPI(title="三角洲砖皮模拟器 (SQLite+JWT+手机验证码+合成+交易行)")
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+
+@app.middleware("http")
+async def _poll_cache_bus(request: Request, call_next):
+    # 其他 worker 的写入（配置、皮肤、挂单、登录等）在处理本请求前生效；
+    # 轮询要查一次 cache_events，交给数据库线程池，未到间隔时 due() 只比较一下时间
+    if CACHE_BUS.due():
+        await asyncio.get_running_loop().run_in_executor(DB_EXECUTOR, CACHE_BUS.poll)
+    return await call_next(request)
+
+
+# ---- 接口耗时与查询扇出指标 ----
+METRICS_SAMPLE_SIZE = int(os.environ.get("DELTA_METRICS_SAMPLES", "1024"))
+METRICS_QUANTILES = (0.5, 0.95, 0.99)
+
+
+class RouteMetrics:
+    """单个路由的累计值，外加最近 METRICS_SAMPLE_SIZE 次请求的耗时与 SQL 条数采样（算分位数用）。"""
+
+    __slots__ = ("count", "errors", "seconds", "statements", "sql_seconds", "rows", "commits",
+                 "max_statements", "latency", "fanout")
+
+    def __init__(self, sample_size: int):
+        self.count = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.statements = 0
+        self.sql_seconds = 0.0
+        self.rows = 0
+        self.commits = 0
+        self.max_statements = 0
+        self.latency: deque = deque(maxlen=sample_size)
+        self.fanout: deque = deque(maxlen=sample_size)
+
+
+def _quantiles(samples: Iterable[float]) -> Dict[float, float]:
+    ordered = sorted(samples)
+    if not ordered:
+        return {q: 0.0 for q in METRICS_QUANTILES}
+    return {q: ordered[min(len(ordered) - 1, int(math.ceil(q * len(ordered))) - 1)] for q in METRICS_QUANTILES}
+
+
+class MetricsRegistry:
+    """按 (方法, 路由模板) 汇总请求指标。只统计本进程；多 worker 时各自独立。"""
+
+    def __init__(self, sample_size: int):
+        self.sample_size = sample_size
+        self.started_at = int(time.time())
+        self._lock = threading.Lock()
+        self._routes: Dict[Tuple[str, str], RouteMetrics] = {}
+
+    def observe(self, method: str, route: str, status: int, elapsed: float, req: RequestMetrics) -> None:
+        with self._lock:
+            entry = self._routes.get((method, route))
+            if entry is None:
+                entry = self._routes[(method, route)] = RouteMetrics(self.sample_size)
+            entry.count += 1
+            if status >= 500:
+                entry.errors += 1
+            entry.seconds += elapsed
+            entry.statements += req.statements
+            entry.sql_seconds += req.sql_seconds
+            entry.rows += req.rows
+            entry.commits += req.commits
+            entry.max_statements = max(entry.max_statements, req.statements)
+            entry.latency.append(elapsed)
+            entry.fanout.append(req.statements)
+
+    def _entries(self) -> List[Tuple[str, str, RouteMetrics, Dict[float, float], Dict[float, float]]]:
+        with self._lock:
+            items = [(method, route, entry, list(entry.latency), list(entry.fanout))
+                     for (method, route), entry in self._routes.items()]
+        return [(method, route, entry, _quantiles(latency), _quantiles(fanout))
+                for method, route, entry, latency, fanout in items]
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        rows = []
+        for method, route, entry, latency, fanout in self._entries():
+            n = max(entry.count, 1)
+            rows.append({
+                "method": method,
+                "route": route,
+                "count": entry.count,
+                "errors": entry.errors,
+                "total_ms": round(entry.seconds * 1000, 1),
+                "latency_ms": {f"p{int(q * 100)}": round(v * 1000, 2) for q, v in latency.items()},
+                "sql_per_request": {
+                    "avg": round(entry.statements / n, 2),
+                    **{f"p{int(q * 100)}": int(v) for q, v in fanout.items()},
+                    "max": entry.max_statements,
+                },
+                "sql_ms_avg": round(entry.sql_seconds * 1000 / n, 2),
+                "rows_loaded_avg": round(entry.rows / n, 2),
+                "commits_avg": round(entry.commits / n, 2),
+            })
+        rows.sort(key=lambda r: r["total_ms"], reverse=True)
+        return rows
+
+    def prometheus(self) -> str:
+        def esc(value: str) -> str:
+            return value.replace("\\", "\\\\").replace('"', '\\"')
+
+        series: Dict[str, List[str]] = {}
+        for method, route, entry, latency, fanout in self._entries():
+            labels = f'method="{esc(method)}",route="{esc(route)}"'
+            for name, quantiles, total in (
+                ("delta_http_request_seconds", latency, entry.seconds),
+                ("delta_http_sql_statements_per_request", fanout, entry.statements),
+            ):
+                lines = series.setdefault(name, [])
+                for q, v in quantiles.items():
+                    lines.append(f'{name}{{{labels},quantile="{q}"}} {v:.6g}')
+                lines.append(f"{name}_sum{{{labels}}} {total:.6g}")
+                lines.append(f"{name}_count{{{labels}}} {entry.count}")
+            for name, value in (
+                ("delta_http_request_errors_total", entry.errors),
+                ("delta_http_sql_seconds_total", entry.sql_seconds),
+                ("delta_http_rows_loaded_total", entry.rows),
+                ("delta_http_commits_total", entry.commits),
+            ):
+                series.setdefault(name, []).append(f"{name}{{{labels}}} {value:.6g}")
+        meta = {
+            "delta_http_request_seconds": ("summary", "请求耗时（秒），分位数取最近采样"),
+            "delta_http_sql_statements_per_request": ("summary", "每个请求执行的 SQL 条数"),
+            "delta_http_request_errors_total": ("counter", "返回 5xx 的请求数"),
+            "delta_http_sql_seconds_total": ("counter", "SQL 累计耗时（秒，仅 ORM/Core 语句）"),
+            "delta_http_rows_loaded_total": ("counter", "ORM 载入的实体行数"),
+            "delta_http_commits_total": ("counter", "数据库提交次数"),
+        }
+        out: List[str] = []
+        for name, (kind, help_text) in meta.items():
+            out.append(f"# HELP {name} {help_text}")
+            out.append(f"# TYPE {name} {kind}")
+            out.extend(series.get(name, []))
+        return "\n".join(out) + "\n"
+
+
+ROUTE_METRICS = MetricsRegistry(METRICS_SAMPLE_SIZE)
+
+
+@event.listens_for(Base, "load", propagate=True)
+def _metrics_row_loaded(target, context):
+    metrics = REQUEST_METRICS.get()
+    if metrics is not None:
+        metrics.rows += 1
+
+
+@app.middleware("http")
+async def _collect_route_metrics(request: Request, call_next):
+    # 最外层中间件：耗时包含缓存总线轮询与依赖项（鉴权、会话）开销
+    metrics = RequestMetrics()
+    token = REQUEST_METRICS.set(metrics)
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        REQUEST_METRICS.reset(token)
+        route = getattr(request.scope.get("route"), "path", None) or "unmatched"
+        ROUTE_METRICS.observe(request.method, route, status, time.perf_counter() - started, metrics)
+
+def get_db():
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+# ---- 异步读路径：专用、有界的数据库线程池 ----
+# SQLite 没有真正的异步 I/O（aiosqlite 内部也是每连接一个线程），热点读接口改为 async def，
+# 把同步查询交给这里的线程池，与 Starlette 默认线程池互不挤占；排队过长直接 503。
+DB_EXECUTOR_WORKERS = int(os.environ.get("DELTA_DB_EXECUTOR_WORKERS", str(DB_POOL_SIZE)))
+DB_EXECUTOR_QUEUE = int(os.environ.get("DELTA_DB_EXECUTOR_QUEUE", "256"))
+DB_EXECUTOR = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="db-executor")
+_DB_EXECUTOR_SLOTS = threading.BoundedSemaphore(DB_EXECUTOR_WORKERS + DB_EXECUTOR_QUEUE)
+
+
+async def run_in_db_executor(fn, *args, **kwargs):
+    if not _DB_EXECUTOR_SLOTS.acquire(blocking=False):
+        raise HTTPException(503, "服务器繁忙，请稍后再试")
+
+    try:
+        # 带上当前上下文，线程池里的查询才能计入本请求的指标
+        future = DB_EXECUTOR.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+    except BaseException:
+        _DB_EXECUTOR_SLOTS.release()
+        raise
+    # 名额在任务结束时归还；请求在排队阶段被取消时任务不会执行，回调照样触发
+    future.add_done_callback(lambda _f: _DB_EXECUTOR_SLOTS.release())
+    return await asyncio.wrap_future(future)
+
+
+async def run_db(fn, **kwargs):
+    """在数据库线程池中开一个会话执行 fn(db=db, **kwargs)，结束即关闭会话。"""
+    def call():
+        with SessionLocal() as db:
+            return fn(db=db, **kwargs)
+
+    return await run_in_db_executor(call)
 
 def _to_bcrypt_bytes(p: str) -> bytes:
     if isinstance(p, bytes):
@@ -748,68 +1751,494 @@ def _to_bcrypt_bytes(p: str) -> bytes:
     return data
 
 
+# ---- bcrypt 进程池 ----
+# bcrypt 是纯 CPU 计算，放进独立进程池后登录高峰不会占满请求线程、也不受 GIL 串行化；
+# DELTA_BCRYPT_WORKERS=0 时退回在当前线程内计算。
+BCRYPT_ROUNDS = min(max(int(os.environ.get("DELTA_BCRYPT_ROUNDS", "12")), 4), 31)
+BCRYPT_WORKERS = int(os.environ.get("DELTA_BCRYPT_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+
+class BcryptPool:
+    def __init__(self, workers: int):
+        self.workers = max(0, int(workers))
+        self._lock = threading.Lock()
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    def _get(self) -> Optional[ProcessPoolExecutor]:
+        if self.workers <= 0:
+            return None
+        with self._lock:
+            if self._executor is None:
+                # 不用 fork：此时进程里已有后台线程和连接池，fork 出的子进程可能继承一把被占用的锁而卡死。
+                # spawn 子进程会以 __mp_main__ 重新导入启动脚本，server_web.py 因此把构建应用放在
+                # __mp_main__ 判断之后，子进程只导入 pw_hash
+                ctx = multiprocessing.get_context("spawn")
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=ctx)
+            return self._executor
+
+    def call(self, fn, *args):
+        executor = self._get()
+        if executor is None:
+            return fn(*args)
+        try:
+            return executor.submit(fn, *args).result()
+        except BrokenProcessPool:
+            self._discard(executor)
+            return fn(*args)
+
+    def _discard(self, executor: ProcessPoolExecutor) -> None:
+        # 子进程异常退出：丢弃旧池，下次调用重建
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False)
+
+    async def run(self, fn, *args):
+        """异步版 call：在进程池里计算，协程只等待结果，不占用请求线程。"""
+        executor = self._get()
+        if executor is None:
+            return await asyncio.to_thread(fn, *args)
+        try:
+            return await asyncio.wrap_future(executor.submit(fn, *args))
+        except BrokenProcessPool:
+            self._discard(executor)
+            return await asyncio.to_thread(fn, *args)
+
+    def shutdown(self) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+BCRYPT_POOL = BcryptPool(BCRYPT_WORKERS)
+
+
+@app.on_event("shutdown")
+def _stop_bcrypt_pool():
+    BCRYPT_POOL.shutdown()
+
+
 def hash_pw(p: str) -> str:
-    data = _to_bcrypt_bytes(p)
-    hashed = bcrypt.hashpw(data, bcrypt.gensalt())
-    return hashed.decode("utf-8")
+    return BCRYPT_POOL.call(pw_hash.hash_password, _to_bcrypt_bytes(p), BCRYPT_ROUNDS)
 
 
 def verify_pw(p: str, h: str) -> bool:
     if not h:
         return False
-    try:
-        return bcrypt.checkpw(_to_bcrypt_bytes(p), str(h).encode("utf-8"))
-    except ValueError:
+    return BCRYPT_POOL.call(pw_hash.check_password, _to_bcrypt_bytes(p), str(h).encode("utf-8"))
+
+
+async def hash_pw_async(p: str) -> str:
+    return await BCRYPT_POOL.run(pw_hash.hash_password, _to_bcrypt_bytes(p), BCRYPT_ROUNDS)
+
+
+async def verify_pw_async(p: str, h: str) -> bool:
+    if not h:
         return False
+    return await BCRYPT_POOL.run(pw_hash.check_password, _to_bcrypt_bytes(p), str(h).encode("utf-8"))
+
 
-def mk_jwt(username: str, session_ver: int, exp_min: int = 60*24) -> str:
+def password_needs_rehash(h: str) -> bool:
+    """哈希的 cost 与当前 BCRYPT_ROUNDS 不一致时返回 True（格式 $2b$12$...）。"""
+    parts = str(h or "").split("$")
+    return len(parts) < 4 or not parts[2].isdigit() or int(parts[2]) != BCRYPT_ROUNDS
+
+def mk_jwt(username: str, session_ver: int, exp_min: int = 60*24, user_id: Optional[int] = None) -> str:
     payload = {"sub": username, "sv": int(session_ver), "exp": datetime.utcnow() + timedelta(minutes=exp_min)}
+    if user_id is not None:
+        payload["uid"] = int(user_id)
     return jwt.encode(payload, JWT_SECRET, algorithm="HS256")
 
-# ---- OTP 发送频率限制（同一 purpose+tag 60 秒一次）----
-import sqlite3 as _sqlite3
+# ---- 限流 ----
+class RateLimitPolicy:
+    """kind="bucket"：令牌桶，容量 capacity、每 period 秒补 1 个；kind="window"：滑动窗口，period 秒内最多 capacity 次。"""
+
+    __slots__ = ("name", "kind", "capacity", "period")
+
+    def __init__(self, name: str, kind: Literal["bucket", "window"], capacity: int, period: float):
+        self.name = name
+        self.kind = kind
+        self.capacity = int(capacity)
+        self.period = float(period)
+
+    def retry_after(self, state: List[float], now: float) -> float:
+        """按当前状态还需等待多少秒才允许下一次（0 表示放行）。会就地整理状态。"""
+        if self.kind == "bucket":
+            tokens = min(self.capacity, state[0] + (now - state[1]) / self.period)
+            state[0], state[1] = tokens, now
+            return 0.0 if tokens >= 1 else (1 - tokens) * self.period
+        cutoff = now - self.period
+        while state and state[0] <= cutoff:
+            state.pop(0)
+        return 0.0 if len(state) < self.capacity else state[0] + self.period - now
+
+    def consume(self, state: List[float], now: float) -> None:
+        if self.kind == "bucket":
+            state[0] -= 1
+        else:
+            state.append(now)
+
+    def idle(self, state: List[float], now: float) -> bool:
+        """状态是否已等同于全新（令牌回满 / 窗口内无记录），可以从内存中移除。不改动 state。"""
+        if self.kind == "bucket":
+            return state[0] + (now - state[1]) / self.period >= self.capacity
+        return not state or state[-1] <= now - self.period
+
+    def last_seen(self, state: List[float]) -> float:
+        if self.kind == "bucket":
+            return state[1]
+        return state[-1] if state else 0.0
+
+    def fresh(self, now: float) -> List[float]:
+        return [float(self.capacity), now] if self.kind == "bucket" else []
+
+    def merge(self, mine: List[float], other: List[float], now: float) -> List[float]:
+        """合并两个 worker 的同一 key：取更严格的一方（令牌更少 / 记录并集）。"""
+        if self.kind == "bucket":
+            self.retry_after(mine, now)
+            self.retry_after(other, now)
+            return [min(mine[0], other[0]), now]
+        merged = sorted(set(mine) | set(other))
+        self.retry_after(merged, now)
+        return merged
+
+
+RATE_LIMIT_POLICIES: Dict[str, RateLimitPolicy] = {
+    p.name: p for p in (
+        RateLimitPolicy("otp-cooldown", "bucket", 1, 60),     # 同一 purpose+手机号/用户名 60 秒一条
+        RateLimitPolicy("otp-tag-hourly", "window", 10, 3600),  # 同一手机号/用户名每小时最多 10 条
+        RateLimitPolicy("otp-ip", "window", 30, 600),           # 同一 IP 10 分钟最多 30 条
+        RateLimitPolicy("login-fail", "window", 10, 900),       # 同一账号 15 分钟最多输错 10 次密码
+        RateLimitPolicy("login-fail-ip", "window", 50, 900),    # 同一 IP 15 分钟最多输错 50 次密码
+    )
+}
+
+
+class RateLimiter:
+    """内存限流器：判定只查内存，变更由后台线程每秒批量写入 rate_limit_state。
+
+    进程启动时载入仍在窗口内的状态；多 worker 时写库后顺带读回其他进程的更新并合并，
+    各进程最终按同一份计数限流。被拒绝的请求不产生任何写入。
+
+    reset() 给 key 记一个重置时刻（reset_at 列）：合并时重置更晚的一方整体胜出，
+    库里的行也只接受重置时刻不早于自己的写入，免得其他 worker 的旧计数被并回来。
+    """
+
+    flush_interval = 1.0
+    max_keys = 100_000  # 超出时按最近活动时间淘汰最旧的 key，防止随意用户名把内存撑大
+
+    def __init__(self, policies: Dict[str, RateLimitPolicy]):
+        self.policies = policies
+        self._lock = threading.Lock()
+        self._state: Dict[Tuple[str, str], List[float]] = {}
+        self._dirty: Set[Tuple[str, str]] = set()
+        self._resets: Dict[Tuple[str, str], float] = {}
+        self._loaded = False
+        self._last_sync = 0
+        self._thread: Optional[threading.Thread] = None
+
+    def _horizon(self) -> float:
+        return max(p.period * max(p.capacity, 1) if p.kind == "bucket" else p.period
+                   for p in self.policies.values())
+
+    def _ensure_loaded(self) -> None:
+        if self._loaded:
+            return
+        since = int(time.time() - self._horizon())
+        with raw_connection() as con:
+            rows = con.execute(
+                "SELECT policy, key, state, reset_at FROM rate_limit_state WHERE updated_at >= ?", (since,)
+            ).fetchall()
+        with self._lock:
+            if self._loaded:
+                return
+            for policy, key, state, reset_at in rows:
+                if policy in self.policies:
+                    self._state[(policy, key)] = json.loads(state)
+                    if reset_at:
+                        self._resets[(policy, key)] = float(reset_at)
+            self._last_sync = int(time.time())
+            self._loaded = True
+
+    def _start(self) -> None:
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="rate-limit-flush", daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as exc:
+                print(f"[rate-limit] 写入失败：{exc}")
+
+    def hit(self, checks: List[Tuple[str, str]], consume: bool = True) -> float:
+        """checks 为 [(策略名, key)]：全部放行才一起计数，否则返回最长需等待秒数。
+
+        consume=False 只判断不计数（如登录先看是否已被锁，输错密码后再计数）。
+        """
+        self._ensure_loaded()
+        self._start()
+        now = time.time()
+        with self._lock:
+            states = []
+            wait = 0.0
+            for name, key in checks:
+                policy = self.policies[name]
+                state = self._state.get((name, key))
+                if state is None:
+                    state = policy.fresh(now)
+                wait = max(wait, policy.retry_after(state, now))
+                states.append((policy, (name, key), state))
+            if wait > 0 or not consume:
+                return wait
+            for policy, skey, state in states:
+                policy.consume(state, now)
+                self._state[skey] = state
+                self._dirty.add(skey)
+        return 0.0
+
+    def flush(self) -> None:
+        now = time.time()
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            rows = [(name, key, json.dumps(self._state[(name, key)]), int(now), self._resets.get((name, key), 0.0))
+                    for name, key in dirty if (name, key) in self._state]
+            last_sync = self._last_sync
+            self._evict(now)
+        if not rows and not CACHE_BUS.enabled:
+            return
+        with raw_connection() as con:
+            if rows:
+                con.cursor().executemany(
+                    """INSERT INTO rate_limit_state(policy, key, state, updated_at, reset_at) VALUES (?,?,?,?,?)
+                       ON CONFLICT(policy, key) DO UPDATE SET
+                           state=excluded.state, updated_at=excluded.updated_at, reset_at=excluded.reset_at
+                       WHERE excluded.reset_at >= rate_limit_state.reset_at""",
+                    rows,
+                )
+                con.execute("DELETE FROM rate_limit_state WHERE updated_at < ?", (int(now - self._horizon()),))
+                con.commit()
+            remote = []
+            if CACHE_BUS.enabled:
+                remote = con.execute(
+                    "SELECT policy, key, state, reset_at FROM rate_limit_state WHERE updated_at >= ?", (last_sync - 1,)
+                ).fetchall()
+        with self._lock:
+            for name, key, state, reset_at in remote:
+                policy = self.policies.get(name)
+                if policy is None:
+                    continue
+                skey = (name, key)
+                mine = self._state.get(skey)
+                mine_reset = self._resets.get(skey, 0.0)
+                other_reset = float(reset_at or 0)
+                if other_reset < mine_reset:
+                    # 库里是本次重置之前的计数，不并入
+                    continue
+                other = json.loads(state)
+                if mine is None or other_reset > mine_reset:
+                    self._state[skey] = other
+                    self._resets[skey] = other_reset
+                else:
+                    self._state[skey] = policy.merge(mine, other, now)
+            self._last_sync = int(now)
+
+    def _evict(self, now: float) -> None:
+        """移除已恢复为全新状态的 key，总数仍超过 max_keys 时再淘汰最久未活动的。调用方持有锁。
+
+        被移除的 key 若有改动已在本轮写库，库里的旧行由 flush 按 _horizon 清理。
+        """
+        for skey in [k for k, state in self._state.items() if self.policies[k[0]].idle(state, now)]:
+            del self._state[skey]
+            self._resets.pop(skey, None)
+        overflow = len(self._state) - self.max_keys
+        if overflow > 0:
+            oldest = heapq.nsmallest(
+                overflow, self._state.items(), key=lambda item: self.policies[item[0][0]].last_seen(item[1])
+            )
+            for skey, _state in oldest:
+                del self._state[skey]
+                self._resets.pop(skey, None)
+
+    def reset(self, name: str, key: str) -> None:
+        """清空某个 key 的计数（如密码输对后清掉该账号的失败次数），并在下次 flush 时写回库。"""
+        self._ensure_loaded()
+        self._start()
+        now = time.time()
+        with self._lock:
+            self._state[(name, key)] = self.policies[name].fresh(now)
+            self._resets[(name, key)] = max(now, self._resets.get((name, key), 0.0))
+            self._dirty.add((name, key))
+
+
+RATE_LIMITER = RateLimiter(RATE_LIMIT_POLICIES)
+
+
+@app.on_event("shutdown")
+def _flush_rate_limiter():
+    RATE_LIMITER.flush()
+
+
+def client_ip(request: Optional[Request]) -> Optional[str]:
+    if request is None or request.client is None:
+        return None
+    return request.client.host
+
+
+def _login_fail_checks(username: str, ip: Optional[str]) -> List[Tuple[str, str]]:
+    checks = [("login-fail", username)]
+    if ip:
+        checks.append(("login-fail-ip", ip))
+    return checks
+
 
-def _sms_rate_guard(purpose: str, tag: str, min_interval: int = 60):
+# ---- OTP 发送频率限制（同一 purpose+tag 60 秒一次，另有每小时/每 IP 上限）----
+def _sms_rate_guard(purpose: str, tag: str, ip: Optional[str] = None):
     """
-    purpose: 验证码用途；tag: 手机号或用户名（视用途而定）
-    若 60s 内同一 (purpose, tag) 已发送过，则抛出 429。
+    purpose: 验证码用途；tag: 手机号或用户名（视用途而定）；ip: 请求来源（可选）
+    任一策略超限则抛出 429，且本次不计数。
     """
-    db_path = DB_PATH_FS  # 复用现有数据库
-    con = _sqlite3.connect(db_path)
-    cur = con.cursor()
-    cur.execute("""CREATE TABLE IF NOT EXISTS sms_rate(
-        purpose TEXT NOT NULL,
-        tag     TEXT NOT NULL,
-        last_ts INTEGER NOT NULL,
-        PRIMARY KEY (purpose, tag)
-    )""")
-    now = int(time.time())
-    cur.execute("SELECT last_ts FROM sms_rate WHERE purpose=? AND tag=?", (purpose, tag))
-    row = cur.fetchone()
-    if row:
-        last_ts = int(row[0])
-        remain = min_interval - (now - last_ts)
-        if remain > 0:
-            con.close()
-            raise HTTPException(status_code=429, detail=f"发送过于频繁，请 {remain} 秒后再试")
-    # 允许发送：更新最后发送时间
-    cur.execute("REPLACE INTO sms_rate(purpose, tag, last_ts) VALUES (?,?,?)", (purpose, tag, now))
-    con.commit(); con.close()
+    checks = [("otp-cooldown", f"{purpose}:{tag}"), ("otp-tag-hourly", str(tag))]
+    if ip:
+        checks.append(("otp-ip", ip))
+    wait = RATE_LIMITER.hit(checks)
+    if wait > 0:
+        raise HTTPException(status_code=429, detail=f"发送过于频繁，请 {max(int(math.ceil(wait)), 1)} 秒后再试")
 
 
-def user_from_token(creds: HTTPAuthorizationCredentials = Depends(http_bearer),
-                    db: Session = Depends(get_db)) -> User:
+class AuthSession:
+    """令牌校验通过后的轻量会话信息；需要余额等字段的接口再用 user_from_token 取完整用户行。"""
+
+    __slots__ = ("id", "username", "session_ver", "is_admin")
+
+    def __init__(self, user_id: int, username: str, session_ver: int, is_admin: bool):
+        self.id = user_id
+        self.username = username
+        self.session_ver = session_ver
+        self.is_admin = is_admin
+
+
+class SessionVersionCache:
+    """进程内会话版本缓存：user_id -> (username, session_ver, is_admin)。
+
+    登录递增 session_ver 后由 remember() 写入新值；令牌版本比缓存新时回源一次，
+    以便接住其他进程的登录。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: Dict[int, Tuple[str, int, bool]] = {}
+        self._ids: Dict[str, int] = {}
+
+    def remember(self, user_id: int, username: str, session_ver: int, is_admin: bool) -> Tuple[str, int, bool]:
+        entry = (username, int(session_ver or 0), bool(is_admin))
+        with self._lock:
+            cached = self._entries.get(int(user_id))
+            # 并发的回源可能读到登录提交前的旧行：版本只进不退，旧值不能覆盖新登录写入的缓存
+            if cached is not None and cached[0] == username and cached[1] > entry[1]:
+                return cached
+            self._entries[int(user_id)] = entry
+            self._ids[username] = int(user_id)
+        return entry
+
+    def forget(self, user_id: Optional[int] = None, username: Optional[str] = None) -> None:
+        with self._lock:
+            if user_id is None and username is not None:
+                user_id = self._ids.get(username)
+            if user_id is None:
+                return
+            entry = self._entries.pop(int(user_id), None)
+            if entry:
+                self._ids.pop(entry[0], None)
+
+    def lookup(self, user_id: Optional[int], username: str) -> Optional[Tuple[int, Tuple[str, int, bool]]]:
+        with self._lock:
+            if user_id is None:
+                user_id = self._ids.get(username)
+            entry = self._entries.get(user_id) if user_id is not None else None
+        if entry is None or entry[0] != username:
+            return None
+        return user_id, entry
+
+    def load(self, username: str) -> Optional[Tuple[int, Tuple[str, int, bool]]]:
+        with SessionLocal() as db:
+            row = db.query(User.id, User.username, User.session_ver, User.is_admin)\
+                .filter(User.username == username).first()
+        if not row:
+            self.forget(username=username)
+            return None
+        return row.id, self.remember(row.id, row.username, row.session_ver, row.is_admin)
+
+
+SESSION_CACHE = SessionVersionCache()
+CACHE_BUS.subscribe("sessions", lambda username: SESSION_CACHE.forget(username=username))
+
+
+def _decode_session_token(token: str) -> Tuple[str, int, Optional[int]]:
     try:
-        payload = jwt.decode(creds.credentials, JWT_SECRET, algorithms=["HS256"])
+        payload = jwt.decode(token, JWT_SECRET, algorithms=["HS256"])
         username = payload.get("sub")
         token_sv = int(payload.get("sv", -1))
+        token_uid = payload.get("uid")
+        token_uid = int(token_uid) if token_uid is not None else None
     except Exception:
         raise HTTPException(401, "令牌无效，请重新登录")
-    user = db.query(User).filter_by(username=username).first()
-    if not user:
+    if not username:
+        raise HTTPException(401, "令牌无效，请重新登录")
+    return username, token_sv, token_uid
+
+
+def _session_from_hit(hit, token_sv: int) -> AuthSession:
+    if hit is None:
         raise HTTPException(401, "用户不存在")
+    user_id, (name, session_ver, is_admin) = hit
     # ★ 关键：单点登录校验
-    if int(user.session_ver or 0) != token_sv:
+    if session_ver != token_sv:
+        raise HTTPException(status_code=401, detail="SESSION_REVOKED")
+    return AuthSession(user_id, name, session_ver, is_admin)
+
+
+def resolve_session_token(token: str) -> AuthSession:
+    username, token_sv, token_uid = _decode_session_token(token)
+    hit = SESSION_CACHE.lookup(token_uid, username)
+    if hit is None or hit[1][1] < token_sv:
+        hit = SESSION_CACHE.load(username)
+    return _session_from_hit(hit, token_sv)
+
+
+def auth_session(creds: HTTPAuthorizationCredentials = Depends(http_bearer)) -> AuthSession:
+    """只校验签名与会话版本（查缓存），不读用户行。"""
+    return resolve_session_token(creds.credentials)
+
+
+async def auth_session_async(creds: HTTPAuthorizationCredentials = Depends(http_bearer)) -> AuthSession:
+    """auth_session 的异步版：缓存命中时不占用任何线程，未命中才到数据库线程池回源。"""
+    username, token_sv, token_uid = _decode_session_token(creds.credentials)
+    hit = SESSION_CACHE.lookup(token_uid, username)
+    if hit is None or hit[1][1] < token_sv:
+        hit = await run_in_db_executor(SESSION_CACHE.load, username)
+    return _session_from_hit(hit, token_sv)
+
+
+def user_from_token(auth: AuthSession = Depends(auth_session),
+                    db: Session = Depends(get_db)) -> User:
+    return load_session_user(db, auth)
+
+
+def load_session_user(db: Session, auth: AuthSession) -> User:
+    user = db.get(User, auth.id)
+    if not user:
+        SESSION_CACHE.forget(auth.id)
+        raise HTTPException(401, "用户不存在")
+    if int(user.session_ver or 0) != auth.session_ver:
+        # 缓存落后于数据库（如其他进程刚登录过）：以行数据为准刷新后拒绝旧令牌
+        SESSION_CACHE.remember(user.id, user.username, user.session_ver, user.is_admin)
         raise HTTPException(status_code=401, detail="SESSION_REVOKED")
     return user
 
@@ -824,10 +2253,7 @@ VIRTUAL_PHONE_PREFIX = "virtual:"
 AUTH_MODE_KEY = "auth_free_mode"
 
 def get_auth_free_mode(db: Session) -> bool:
-    row = db.query(SystemSetting).filter_by(key=AUTH_MODE_KEY).first()
-    if not row:
-        return True
-    return str(row.value) != "0"
+    return SYSTEM_SETTINGS.flag(AUTH_MODE_KEY, True, db)
 
 def _alloc_virtual_phone(db: Session, username: str) -> str:
     """为无需绑定手机号的账户生成内部占位符，保持唯一性。"""
@@ -861,10 +2287,51 @@ def check_password_complexity(p: str):
         raise HTTPException(400, "密码需要至少 1 个小写字母")
 
 # ---- OTP ----
+# sms_codes.txt 仍是模拟短信的“发件箱”（玩家从中查看验证码），超过上限滚动为 .1；
+# 管理员日志改查 otp_events 表，事件保留 OTP_LOG_RETENTION_SEC。
+SMS_FILE_MAX_BYTES = int(os.environ.get("DELTA_SMS_FILE_MAX_BYTES", str(4 * 1024 * 1024)))
+OTP_LOG_RETENTION_SEC = 7 * 24 * 3600
+OTP_LOG_LIVE_SEC = 15 * 60  # 管理员/充值类验证码的最长有效期，真实有效性以各自的表为准
+
+
+def append_sms_file(path: str, line: str) -> None:
+    try:
+        if os.path.getsize(path) > SMS_FILE_MAX_BYTES:
+            os.replace(path, path + ".1")
+    except OSError:
+        pass
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(line)
+
+
+def log_otp_event(purpose: str, tag: str, code: str, expire_at: int,
+                  amount: Optional[int] = None, extra: str = "") -> None:
+    now = int(time.time())
+    with raw_connection() as con:
+        cur = con.execute(
+            "INSERT INTO otp_events(purpose, tag, code, amount, extra, created_at, expire_at) VALUES (?,?,?,?,?,?,?)",
+            (purpose, str(tag), str(code), amount, extra, now, int(expire_at)),
+        )
+        if int(cur.lastrowid) % 500 == 0:
+            con.execute("DELETE FROM otp_events WHERE created_at < ?", (now - OTP_LOG_RETENTION_SEC,))
+        con.commit()
+
+
 def write_sms_line(phone: str, code: str, purpose: str):
     ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    with open(OTP_FILE, "a", encoding="utf-8") as f:
-        f.write(f"phone={phone} purpose={purpose} code={code} ts={ts}\n")
+    append_sms_file(OTP_FILE, f"phone={phone} purpose={purpose} code={code} ts={ts}\n")
+    log_otp_event(purpose, phone, code, int(time.time()) + OTP_EXPIRE_SEC)
+
+OTP_HMAC_KEY = os.environ.get("DELTA_OTP_KEY", "").encode("utf-8") or hashlib.sha256(
+    ("otp:" + JWT_SECRET).encode("utf-8")
+).digest()
+
+
+def otp_digest(phone: str, purpose: str, code: str) -> str:
+    """验证码的带密钥 HMAC：校验时直接按摘要等值查询，不必逐条跑 bcrypt。"""
+    msg = f"{purpose}:{phone}:{str(code).strip()}".encode("utf-8")
+    return "hmac-sha256$" + hmac.new(OTP_HMAC_KEY, msg, hashlib.sha256).hexdigest()
+
 
 def save_otp(db: Session, phone: str, purpose: str, code: str):
     """
@@ -878,7 +2345,7 @@ def save_otp(db: Session, phone: str, purpose: str, code: str):
     ).delete(synchronize_session=False)
 
     # 新验证码入库
-    h = hash_pw(code)
+    h = otp_digest(phone, purpose, code)
     expire_ts = int(time.time()) + OTP_EXPIRE_SEC
     db.add(SmsCode(phone=phone, purpose=purpose, code_hash=h, expire_ts=expire_ts))
     db.commit()
@@ -886,16 +2353,16 @@ def save_otp(db: Session, phone: str, purpose: str, code: str):
 
 def verify_otp(db: Session, phone: str, purpose: str, code: str) -> bool:
     now = int(time.time())
-    rows = db.query(SmsCode).filter(
-        SmsCode.phone==phone, SmsCode.purpose==purpose, SmsCode.expire_ts>=now
-    ).all()
-    for r in rows:
-        if verify_pw(code, r.code_hash):
-            # ★ 命中即视为“已使用”，删除该条记录（可选：同 purpose 其他旧记录也可删）
-            db.delete(r)
-            db.commit()
-            return True
-    return False
+    r = db.query(SmsCode).filter(
+        SmsCode.phone==phone, SmsCode.purpose==purpose, SmsCode.expire_ts>=now,
+        SmsCode.code_hash==otp_digest(phone, purpose, code),
+    ).first()
+    if r is None:
+        return False
+    # ★ 命中即视为“已使用”，删除该条记录（可选：同 purpose 其他旧记录也可删）
+    db.delete(r)
+    db.commit()
+    return True
 
 
 # ---- Seed ----
@@ -909,8 +2376,7 @@ with SessionLocal() as _db:
         init_price = round(random.uniform(60, 120), 2)
         _db.add(BrickMarketState(price=init_price, sentiment=0.0, last_update=int(time.time())))
         cfg.brick_price = max(40, min(150, int(round(init_price))))
-    _seed_skins(_db)
-    sync_inventory_skin_meta(_db)
+    SKIN_SEED_CHANGED = seed_skins_if_changed(_db)
     _db.commit()
 
 # ---- RNG & Grades ----
@@ -919,98 +2385,6 @@ SEASON_IDS = [sid for sid in SEASON_LOOKUP.keys() if sid]
 LATEST_SEASON = SEASON_IDS[-1] if SEASON_IDS else ""
 
 
-TEMPLATE_LABEL_LOOKUP: Dict[str, str] = {
-    "brick_normal": "标准模板",
-    "brick_white_diamond": "白钻切面",
-    "brick_yellow_diamond": "黄钻切面",
-    "brick_pink_diamond": "粉钻切面",
-    "brick_brushed_metal": "金属拉丝",
-    "brick_laser_gradient": "镭射渐变",
-    "brick_prism_spectrum": "棱镜光谱",
-    "brick_medusa_relic": "蛇神遗痕",
-    "brick_arcade_crystal": "水晶贪吃蛇",
-    "brick_arcade_serpent": "像素贪吃蛇",
-    "brick_arcade_blackhawk": "街机黑鹰",
-    "brick_arcade_champion": "拳王",
-    "brick_arcade_default": "电玩标准",
-    "brick_blade_royal": "王牌镶嵌",
-    "brick_fate_blueberry": "蓝莓玉",
-    "brick_fate_brass": "黄铜",
-    "brick_fate_default": "命运经典",
-    "brick_fate_gold": "黄金",
-    "brick_fate_goldenberry": "金莓",
-    "brick_fate_gradient": "命运渐变",
-    "brick_fate_jade": "翡翠绿",
-    "brick_fate_metal": "金属拉丝",
-    "brick_fate_strawberry": "草莓金",
-    "brick_fate_whitepeach": "白桃",
-    "brick_prism2_flux": "棱镜攻势2",
-    "brick_weather_clathrate": "可燃冰",
-    "brick_weather_default": "气象标准",
-    "brick_weather_gradient": "气象渐变",
-    "brick_weather_gundam": "高达气象",
-    "brick_weather_purplebolt": "紫电",
-    "brick_weather_redbolt": "红电",
-    "prism_flux": "棱镜流光",
-    "ember_strata": "余烬分层",
-    "ion_tessellate": "离子镶嵌",
-    "diamond_veil": "钻石面纱",
-    "aurora_matrix": "极光矩阵",
-    "nebula_glass": "星云玻璃",
-    "ion_glaze": "离子釉彩",
-    "vapor_trace": "雾态轨迹",
-    "phase_shift": "相位位移",
-    "urban_mesh": "都市网格",
-    "fiber_wave": "纤维波纹",
-    "midnight_line": "午夜线条",
-    "field_classic": "野战经典",
-    "steel_ridge": "钢脊纹",
-    "matte_guard": "哨卫磨砂",
-}
-
-
-EFFECT_LABEL_LOOKUP: Dict[str, str] = {
-    "glow": "辉光涌动",
-    "pulse": "能量脉冲",
-    "sheen": "流光泛映",
-    "sparkle": "星火闪烁",
-    "trail": "残影拖尾",
-    "refraction": "晶体折射",
-    "flux": "相位流动",
-    "prism_flux": "棱镜流光",
-    "bold_tracer": "显眼曳光",
-    "kill_counter": "击杀计数",
-    "arcade_core": "街机核心",
-    "arcade_glass": "街机玻璃",
-    "arcade_glow": "街机辉光",
-    "arcade_pulse": "街机脉冲",
-    "arcade_trail": "街机拖尾",
-    "blade_glow": "王牌辉光",
-    "chromatic_flame": "彩焰",
-    "fate_glow": "命运辉光",
-    "fate_gradient": "命运渐变",
-    "medusa_glare": "美杜莎凝视",
-    "weather_bolt": "天气闪电",
-    "weather_frost": "气象霜华",
-    "weather_glow": "气象辉光",
-    "weather_gradient": "气象渐变",
-    "affinity:weather:acid_rain": "酸雨属性",
-    "affinity:weather:thunder": "雷电属性",
-    "affinity:weather:flame": "火焰属性",
-    "affinity:weather:frost": "冰霜属性",
-}
-
-
-for _season in SEASON_DEFINITIONS:
-    for _group in ("bricks", "purples", "blues", "greens"):
-        for _skin in _season.get(_group, []) or []:
-            meta = (_skin.get("meta") or {})
-            for _rule in meta.get("template_rules", []) or []:
-                key = str(_rule.get("key") or "").lower()
-                label = _rule.get("label")
-                if key and label and key not in TEMPLATE_LABEL_LOOKUP:
-                    TEMPLATE_LABEL_LOOKUP[key] = label
-
 def _normalize_season(season: Optional[str]) -> Optional[str]:
     if not season:
         return None
@@ -1319,461 +2693,6 @@ def require_season(season: Optional[str]) -> str:
     return key
 
 
-def grade_from_wear_bp(wear_bp: int) -> str:
-    # 0–0.40 S, 0.40–1.22 A, 1.22–2.50 B, 2.50–5.00 C  （wear_bp = 0..500）
-    if wear_bp < 40:   return "S"
-    if wear_bp < 122:  return "A"
-    if wear_bp < 250:  return "B"
-    return "C"
-
-def wear_random_bp() -> int:
-    return secrets.randbelow(501)
-
-def rng_ppm() -> int: return secrets.randbelow(1_000_000)
-def ppm(percent: float) -> int: return int(round(percent * 10_000))
-
-# ---- Visual Generator ----
-COLOR_PALETTE = [
-    {"hex": "#f06449", "name": "熔岩橙"},
-    {"hex": "#f9a620", "name": "流金黄"},
-    {"hex": "#ffd166", "name": "暖阳金"},
-    {"hex": "#ff6b6b", "name": "燃焰红"},
-    {"hex": "#ef476f", "name": "曦粉"},
-    {"hex": "#5b5f97", "name": "紫曜蓝"},
-    {"hex": "#577590", "name": "风暴蓝"},
-    {"hex": "#118ab2", "name": "极地蓝"},
-    {"hex": "#06d6a0", "name": "量子绿"},
-    {"hex": "#0ead69", "name": "热带绿"},
-    {"hex": "#26547c", "name": "暗夜蓝"},
-    {"hex": "#4cc9f0", "name": "星辉青"},
-    {"hex": "#845ec2", "name": "霓虹紫"},
-    {"hex": "#ff9671", "name": "霞光橘"},
-    {"hex": "#ffc75f", "name": "琥珀金"},
-    {"hex": "#d65db1", "name": "星云粉"},
-    {"hex": "#4b8b3b", "name": "密林绿"},
-    {"hex": "#8c7ae6", "name": "暮光紫"},
-    {"hex": "#2f4858", "name": "石墨蓝"},
-]
-
-BRICK_TEMPLATES = {
-    "brick_normal",
-    "brick_white_diamond",
-    "brick_yellow_diamond",
-    "brick_pink_diamond",
-    "brick_brushed_metal",
-    "brick_laser_gradient",
-    "brick_prism_spectrum",
-    "brick_medusa_relic",
-    "brick_arcade_crystal",
-    "brick_arcade_serpent",
-    "brick_arcade_blackhawk",
-    "brick_arcade_champion",
-    "brick_arcade_default",
-    "brick_fate_strawberry",
-    "brick_fate_blueberry",
-    "brick_fate_goldenberry",
-    "brick_fate_metal",
-    "brick_fate_brass",
-    "brick_fate_gold",
-    "brick_fate_jade",
-    "brick_fate_whitepeach",
-    "brick_fate_gradient",
-    "brick_fate_default",
-    "brick_blade_royal",
-    "brick_weather_gundam",
-    "brick_weather_clathrate",
-    "brick_weather_redbolt",
-    "brick_weather_purplebolt",
-    "brick_weather_gradient",
-    "brick_weather_default",
-    "brick_prism2_flux",
-}
-BRICK_TEMPLATE_LABELS = {
-    "brick_normal": "标准模板",
-    "brick_white_diamond": "白钻模板",
-    "brick_yellow_diamond": "黄钻模板",
-    "brick_pink_diamond": "粉钻模板",
-    "brick_brushed_metal": "金属拉丝",
-    "brick_laser_gradient": "镭射渐变",
-    "brick_prism_spectrum": "棱镜光谱",
-    "brick_medusa_relic": "蛇神遗痕",
-    "brick_arcade_crystal": "水晶贪吃蛇",
-    "brick_arcade_serpent": "贪吃蛇",
-    "brick_arcade_blackhawk": "黑鹰坠落",
-    "brick_arcade_champion": "拳王",
-    "brick_arcade_default": "电玩标准",
-    "brick_fate_strawberry": "草莓金",
-    "brick_fate_blueberry": "蓝莓玉",
-    "brick_fate_goldenberry": "金莓",
-    "brick_fate_metal": "命运金属",
-    "brick_fate_brass": "黄铜浮雕",
-    "brick_fate_gold": "黄金流光",
-    "brick_fate_jade": "翡翠绿",
-    "brick_fate_whitepeach": "白桃",
-    "brick_fate_gradient": "命运渐变",
-    "brick_fate_default": "命运经典",
-    "brick_blade_royal": "王牌镶嵌",
-    "brick_weather_gundam": "高达气象",
-    "brick_weather_clathrate": "可燃冰",
-    "brick_weather_redbolt": "红电",
-    "brick_weather_purplebolt": "紫电",
-    "brick_weather_gradient": "气象渐变",
-    "brick_weather_default": "气象标准",
-    "brick_prism2_flux": "棱镜攻势2",
-}
-EXQUISITE_ONLY_TEMPLATES = {
-    "brick_white_diamond",
-    "brick_yellow_diamond",
-    "brick_pink_diamond",
-    "brick_brushed_metal",
-    "brick_arcade_crystal",
-    "brick_arcade_serpent",
-    "brick_arcade_blackhawk",
-    "brick_arcade_champion",
-    "brick_fate_strawberry",
-    "brick_fate_blueberry",
-    "brick_fate_goldenberry",
-    "brick_fate_metal",
-    "brick_fate_brass",
-    "brick_fate_gold",
-    "brick_fate_jade",
-    "brick_fate_whitepeach",
-    "brick_weather_gundam",
-    "brick_weather_clathrate",
-    "brick_weather_redbolt",
-    "brick_weather_purplebolt",
-}
-DIAMOND_TEMPLATE_KEYS = {
-    "brick_white_diamond",
-    "brick_yellow_diamond",
-    "brick_pink_diamond",
-}
-SPECIAL_PRICE_TEMPLATES = DIAMOND_TEMPLATE_KEYS | {
-    "brick_brushed_metal",
-    "brick_prism_spectrum",
-    "brick_medusa_relic",
-    "brick_arcade_crystal",
-    "brick_arcade_serpent",
-    "brick_arcade_blackhawk",
-    "brick_arcade_champion",
-    "brick_fate_strawberry",
-    "brick_fate_blueberry",
-    "brick_fate_goldenberry",
-    "brick_fate_metal",
-    "brick_fate_brass",
-    "brick_fate_gold",
-    "brick_fate_jade",
-    "brick_fate_whitepeach",
-    "brick_weather_gundam",
-    "brick_weather_clathrate",
-    "brick_weather_redbolt",
-    "brick_weather_purplebolt",
-    "brick_prism2_flux",
-}
-
-COLOR_NAME_MAP = {c["hex"].lower(): c["name"] for c in COLOR_PALETTE}
-
-
-def _normalize_hex(value: Any) -> str:
-    if value is None:
-        return ""
-    s = str(value).strip()
-    if not s:
-        return ""
-    if not s.startswith("#"):
-        s = "#" + s
-    if len(s) not in (4, 7):
-        return ""
-    try:
-        int(s[1:], 16)
-    except ValueError:
-        return ""
-    return s.lower()
-
-
-def _color_entry(value: Any) -> Optional[Dict[str, str]]:
-    if isinstance(value, dict):
-        hex_raw = value.get("hex") or value.get("color") or value.get("value")
-        name = value.get("name") or value.get("label")
-    else:
-        hex_raw = value
-        name = None
-    hex_val = _normalize_hex(hex_raw)
-    if not hex_val:
-        return None
-    if not name:
-        name = COLOR_NAME_MAP.get(hex_val, hex_val)
-    return {"hex": hex_val, "name": name}
-
-
-def _resolve_palette(options: Any) -> List[Dict[str, str]]:
-    if not options:
-        return []
-    if isinstance(options, list):
-        choice = secrets.choice(options)
-    else:
-        choice = options
-    if isinstance(choice, list):
-        colors = []
-        for item in choice:
-            entry = _color_entry(item)
-            if entry:
-                colors.append(entry)
-        return colors
-    entry = _color_entry(choice)
-    return [entry] if entry else []
-
-
-def _unique_list(items: List[str]) -> List[str]:
-    seen = set()
-    out: List[str] = []
-    for item in items:
-        if not item:
-            continue
-        key = str(item)
-        if key in seen:
-            continue
-        seen.add(key)
-        out.append(key)
-    return out
-
-
-def skin_meta_dict(skin: Optional[Skin]) -> Dict[str, Any]:
-    if not skin:
-        return {}
-    raw = getattr(skin, "meta", None)
-    if not raw:
-        return {}
-    try:
-        data = json.loads(raw)
-        if isinstance(data, dict):
-            return data
-    except Exception:
-        return {}
-    return {}
-
-
-def default_brick_template(exquisite: bool) -> str:
-    roll = secrets.randbelow(10000)
-    if exquisite:
-        if roll < 100:
-            trio = ["brick_white_diamond", "brick_yellow_diamond", "brick_pink_diamond"]
-            return trio[secrets.randbelow(len(trio))]
-        if roll < 600:
-            return "brick_brushed_metal"
-        if roll < 1600:
-            return "brick_laser_gradient"
-        return "brick_normal"
-    if roll < 1000:
-        return "brick_laser_gradient"
-    return "brick_normal"
-
-def _pick_color() -> Dict[str, str]:
-    base = secrets.choice(COLOR_PALETTE)
-    return {"hex": base["hex"], "name": base["name"]}
-
-def _normalize_affinity_config(meta: Dict[str, Any]) -> Optional[Dict[str, Any]]:
-    conf = meta.get("weather_attributes") if isinstance(meta, dict) else None
-    if not isinstance(conf, dict):
-        return None
-    type_key = str(conf.get("type") or "weather").strip().lower() or "weather"
-    pool_raw = conf.get("pool") or []
-    pool: List[Tuple[str, str]] = []
-    for entry in pool_raw:
-        if isinstance(entry, dict):
-            key = str(entry.get("key") or "").strip().lower()
-            label = str(entry.get("label") or "").strip() or key
-        else:
-            key = str(entry or "").strip().lower()
-            label = key
-        if key:
-            pool.append((key, label))
-    if not pool:
-        return None
-    overrides: Dict[str, str] = {}
-    raw_overrides = conf.get("template_overrides") or {}
-    if isinstance(raw_overrides, dict):
-        for tpl, value in raw_overrides.items():
-            tpl_key = str(tpl or "").strip().lower()
-            val_key = str(value or "").strip().lower()
-            if tpl_key and val_key:
-                overrides[tpl_key] = val_key
-    return {"type": type_key, "pool": pool, "overrides": overrides}
-
-def _affinity_info_from_key(config: Dict[str, Any], key: str) -> Dict[str, str]:
-    for pool_key, label in config.get("pool", []):
-        if pool_key == key:
-            return {"type": config.get("type", "weather"), "key": key, "label": label}
-    return {"type": config.get("type", "weather"), "key": key, "label": key}
-
-def _parse_affinity_tag(tag: str) -> Optional[Tuple[str, str]]:
-    if not tag:
-        return None
-    parts = str(tag).split(":")
-    if len(parts) < 3:
-        return None
-    head = parts[0].strip().lower()
-    if head != "affinity":
-        return None
-    return parts[1].strip().lower(), parts[2].strip().lower()
-
-def _affinity_tag(info: Dict[str, str]) -> str:
-    return f"affinity:{info.get('type', 'weather')}:{info.get('key', '')}"
-
-def _pick_affinity(
-    config: Optional[Dict[str, Any]],
-    template_key: str = "",
-    *,
-    deterministic_seed: Optional[int] = None,
-) -> Optional[Dict[str, str]]:
-    if not config:
-        return None
-    tpl = str(template_key or "").strip().lower()
-    if tpl and tpl in config.get("overrides", {}):
-        key = config["overrides"][tpl]
-        return _affinity_info_from_key(config, key)
-    pool = config.get("pool", [])
-    if not pool:
-        return None
-    if deterministic_seed is not None:
-        idx = int(abs(deterministic_seed)) % len(pool)
-        key = pool[idx][0]
-        return _affinity_info_from_key(config, key)
-    key, _label = secrets.choice(pool)
-    return _affinity_info_from_key(config, key)
-
-def _affinity_info_from_tag(
-    config: Optional[Dict[str, Any]],
-    tag: str,
-) -> Optional[Dict[str, str]]:
-    parsed = _parse_affinity_tag(tag)
-    if not parsed:
-        return None
-    tag_type, tag_key = parsed
-    if config and tag_type == config.get("type"):
-        return _affinity_info_from_key(config, tag_key)
-    label = tag_key
-    return {"type": tag_type or "weather", "key": tag_key, "label": label}
-
-def generate_visual_profile(
-    rarity: str,
-    exquisite: bool,
-    *,
-    model_key: str = "",
-    skin: Optional[Skin] = None,
-) -> Dict[str, object]:
-    rarity = (rarity or "").upper()
-    meta = skin_meta_dict(skin)
-    base_model_key = model_key or (skin.model_key if skin else "")
-    model = _resolve_model_key(base_model_key, skin)
-    if not model:
-        model = "assault"
-    affinity_config = _normalize_affinity_config(meta)
-    affinity_payload: Optional[Dict[str, str]] = None
-
-    body = _resolve_palette(meta.get("body_colors"))
-    if not body:
-        layers = 2 if secrets.randbelow(100) < 55 else 1
-        body = [_pick_color() for _ in range(layers)]
-
-    attachments = _resolve_palette(meta.get("attachment_colors"))
-    if not attachments:
-        attachments = [_pick_color()]
-
-    template_key = ""
-    template_label = ""
-    hidden_template = False
-    effects: List[str] = []
-
-    if rarity == "BRICK":
-        rule = None
-        template_rules = meta.get("template_rules")
-        if template_rules:
-            pool: List[Tuple[Dict[str, Any], int]] = []
-            for rule_entry in template_rules:
-                allow_exq = rule_entry.get("allow_exquisite", True)
-                allow_prem = rule_entry.get("allow_premium", True)
-                if exquisite and not allow_exq:
-                    continue
-                if not exquisite and not allow_prem:
-                    continue
-                weight = int(rule_entry.get("weight", 1) or 0)
-                if weight <= 0:
-                    continue
-                pool.append((rule_entry, weight))
-            if pool:
-                total = sum(weight for _, weight in pool)
-                pick = secrets.randbelow(total)
-                cursor = 0
-                for rule_entry, weight in pool:
-                    cursor += weight
-                    if pick < cursor:
-                        rule = rule_entry
-                        break
-        if rule:
-            template_key = str(rule.get("key") or "")
-            template_label = str(rule.get("label") or "")
-            hidden_template = bool(rule.get("hidden", False))
-            chosen_body = _resolve_palette(rule.get("body"))
-            if chosen_body:
-                body = chosen_body
-            chosen_att = _resolve_palette(rule.get("attachments"))
-            if chosen_att:
-                attachments = chosen_att
-            effects.extend(rule.get("effects", []))
-        else:
-            template_key = default_brick_template(bool(exquisite))
-        effects.append("sheen")
-        extra = meta.get("extra_effects", {})
-        if exquisite:
-            effects.extend(["bold_tracer", "kill_counter"])
-            effects.extend(extra.get("exquisite", []))
-        else:
-            effects.extend(extra.get("premium", []))
-        if affinity_config:
-            picked_affinity = _pick_affinity(affinity_config, template_key)
-            if picked_affinity:
-                affinity_payload = picked_affinity
-                effects.append(_affinity_tag(picked_affinity))
-    else:
-        eff_conf = meta.get("effects")
-        if isinstance(eff_conf, dict):
-            key = "exquisite" if exquisite else "premium"
-            effects.extend(eff_conf.get(key, []))
-        elif isinstance(eff_conf, list):
-            effects.extend(eff_conf)
-
-    effects = _unique_list(effects)
-    if affinity_config:
-        for tag in effects:
-            info = _affinity_info_from_tag(affinity_config, tag)
-            if info:
-                affinity_payload = info
-                break
-    if not template_label and template_key:
-        template_label = TEMPLATE_LABEL_LOOKUP.get(str(template_key).lower(), "")
-    effect_labels = [
-        EFFECT_LABEL_LOOKUP.get(str(tag).lower(), str(tag))
-        for tag in effects
-    ]
-
-    payload = {
-        "body": body,
-        "attachments": attachments,
-        "template": template_key,
-        "hidden_template": hidden_template,
-        "effects": effects,
-        "model": model,
-        "template_label": template_label,
-        "effect_labels": effect_labels,
-    }
-    if affinity_payload:
-        payload["affinity"] = affinity_payload
-        payload["affinity_tag"] = _affinity_tag(affinity_payload)
-        payload["affinity_label"] = affinity_payload.get("label", "")
-    return payload
-
-
 @app.get("/seasons/catalog")
 def seasons_catalog():
     seasons_payload = []
@@ -1832,7 +2751,7 @@ def ensure_visual(inv: Inventory, skin: Optional[Skin] = None) -> Dict[str, obje
     model_key = inv.model_key or ""
     if not model_key and skin:
         model_key = skin.model_key or ""
-    meta = skin_meta_dict(skin)
+    meta = SKIN_CATALOG.meta(skin)
     affinity_config = _normalize_affinity_config(meta)
     affinity_info: Optional[Dict[str, str]] = None
     affinity_tag = None
@@ -1846,7 +2765,7 @@ def ensure_visual(inv: Inventory, skin: Optional[Skin] = None) -> Dict[str, obje
 
     if rarity == "BRICK":
         if not body or not attachments or template not in BRICK_TEMPLATES:
-            profile = generate_visual_profile(inv.rarity, bool(inv.exquisite), model_key=model_key, skin=skin)
+            profile = generate_visual_profile(inv.rarity, bool(inv.exquisite), model_key=model_key, skin=skin, meta=meta)
             body = profile["body"]
             attachments = profile["attachments"]
             template = profile["template"]
@@ -1863,7 +2782,7 @@ def ensure_visual(inv: Inventory, skin: Optional[Skin] = None) -> Dict[str, obje
             model_key = inv.model_key
             changed = True
         if not bool(inv.exquisite) and template in EXQUISITE_ONLY_TEMPLATES:
-            profile = generate_visual_profile(inv.rarity, False, model_key=model_key, skin=skin)
+            profile = generate_visual_profile(inv.rarity, False, model_key=model_key, skin=skin, meta=meta)
             body = profile["body"]
             attachments = profile["attachments"]
             template = profile["template"]
@@ -1915,7 +2834,7 @@ def ensure_visual(inv: Inventory, skin: Optional[Skin] = None) -> Dict[str, obje
             changed = True
     else:
         if not body or not attachments:
-            profile = generate_visual_profile(inv.rarity, bool(inv.exquisite), model_key=model_key, skin=skin)
+            profile = generate_visual_profile(inv.rarity, bool(inv.exquisite), model_key=model_key, skin=skin, meta=meta)
             body = profile["body"]
             attachments = profile["attachments"]
             inv.body_colors = json.dumps(body, ensure_ascii=False)
@@ -1969,15 +2888,145 @@ def ensure_visual(inv: Inventory, skin: Optional[Skin] = None) -> Dict[str, obje
     }
 
 
-# ------------------ Cookie Factory Mini-game ------------------
-COOKIE_FACTORY_SETTING_KEY = "cookie_factory_enabled"
-COOKIE_CULTIVATION_SETTING_KEY = "cookie_cultivation_enabled"
-STARFALL_SETTING_KEY = "starfall_enabled"
-COOKIE_WEEKLY_CAP = 100
-COOKIE_DELTA_BONUS = 0.05
-COOKIE_DELTA_BONUS_CAP = 1.25
-COOKIE_SUGAR_COOLDOWN = 6 * 3600
-COOKIE_DAILY_CHALLENGE_TARGET = 120
+VISUAL_PAYLOAD_KEYS = (
+    "body", "attachments", "template", "template_label", "hidden_template",
+    "effects", "effect_labels", "affinity", "affinity_label", "affinity_tag", "model",
+)
+_VISUAL_SOURCE_FIELDS = (
+    "body_colors", "attachment_colors", "template_name", "effect_tags", "hidden_template", "model_key",
+)
+
+
+def render_visual_payload(inv: Inventory, skin: Optional[Skin] = None) -> Dict[str, object]:
+    """规范化外观并写入 inv.visual_payload；铸造与迁移时调用，读接口直接取用。"""
+    if skin is None:
+        skin = SKIN_CATALOG.get(inv.skin_id)
+    vis = ensure_visual(inv, skin)
+    payload = {key: vis.get(key) for key in VISUAL_PAYLOAD_KEYS}
+    inv.visual_payload = json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
+    return payload
+
+
+def prerender_inventory_row(row: Dict[str, Any], skin: Optional[Skin] = None) -> Dict[str, Any]:
+    """为待批量插入的背包行预渲染外观，规范化后的外观字段同步回行字典。"""
+    draft = Inventory(**row)
+    render_visual_payload(draft, skin)
+    for field in _VISUAL_SOURCE_FIELDS:
+        row[field] = getattr(draft, field)
+    row["visual_payload"] = draft.visual_payload
+    return row
+
+
+# 回填时渲染抛错的行写入此标记（JSON null），回填不再挑中它，读接口照常现场计算；
+# 皮肤 meta 或模型变化时 _seed_skins / backfill_inventory_skin_meta 会清空 visual_payload，届时重新尝试
+VISUAL_PAYLOAD_FAILED = "null"
+
+
+def load_visual(inv: Inventory, skin: Optional[Skin] = None) -> Dict[str, object]:
+    """读接口取外观：优先用预渲染结果；尚未回填的旧数据在临时副本上计算，不改写原行。"""
+    cached = _load_json_field(inv.visual_payload, None)
+    if isinstance(cached, dict):
+        return cached
+    if skin is None:
+        skin = SKIN_CATALOG.get(inv.skin_id)
+    draft = Inventory(**{col.key: getattr(inv, col.key) for col in Inventory.__table__.columns})
+    vis = ensure_visual(draft, skin)
+    if inv.visual_payload != VISUAL_PAYLOAD_FAILED:
+        VISUAL_BACKFILL.kick()
+    return {key: vis.get(key) for key in VISUAL_PAYLOAD_KEYS}
+
+
+class VisualBackfill:
+    """后台回填任务：为缺少 visual_payload 的旧背包行补渲染外观并规范赛季。"""
+
+    batch_size = 200
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._pending = False
+        self._sync_meta = False
+
+    def kick(self, sync_meta: bool = False) -> None:
+        """sync_meta=True 时先批量对齐背包赛季/模型（皮肤数据变更后），再补渲染外观。"""
+        with self._lock:
+            self._sync_meta = self._sync_meta or sync_meta
+            if self._thread is not None and self._thread.is_alive():
+                self._pending = True
+                return
+            self._pending = False
+            self._thread = threading.Thread(target=self._run, name="visual-backfill", daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            try:
+                if not acquire_worker_lease("visual_backfill", 120):
+                    with self._lock:
+                        self._thread = None
+                    return
+                with self._lock:
+                    sync_meta, self._sync_meta = self._sync_meta, False
+                if sync_meta:
+                    backfill_inventory_skin_meta()
+                while self.run_batch():
+                    pass
+            except Exception as exc:
+                print(f"[visual-backfill] 回填失败：{exc}")
+            with self._lock:
+                if not self._pending:
+                    self._thread = None
+                    return
+                self._pending = False
+
+    def run_batch(self) -> int:
+        with SessionLocal() as db:
+            rows = (
+                db.query(Inventory)
+                .filter(or_(Inventory.visual_payload == None, Inventory.visual_payload == ""))
+                .order_by(Inventory.id.asc())
+                .limit(self.batch_size)
+                .all()
+            )
+            if not rows:
+                return 0
+            skin_map = SKIN_CATALOG.skin_map({r.skin_id for r in rows if r.skin_id})
+            for inv in rows:
+                skin = skin_map.get(inv.skin_id)
+                try:
+                    render_visual_payload(inv, skin)
+                except Exception as exc:
+                    # 丢弃渲染到一半的改动，只记失败标记，避免同一行卡住整批、线程反复重试
+                    print(f"[visual-backfill] inventory {inv.id} 渲染失败：{exc}")
+                    db.expire(inv)
+                    inv.visual_payload = VISUAL_PAYLOAD_FAILED
+                    continue
+                season_key = _brick_season_key(inv.season or (skin.season if skin else ""))
+                if season_key and (inv.season or "") != season_key:
+                    inv.season = season_key
+            db.commit()
+            return len(rows)
+
+
+VISUAL_BACKFILL = VisualBackfill()
+
+
+@app.on_event("startup")
+def _start_visual_backfill():
+    VISUAL_BACKFILL.kick(sync_meta=SKIN_SEED_CHANGED)
+
+
+# ------------------ Cookie Factory Mini-game ------------------
+COOKIE_FACTORY_SETTING_KEY = "cookie_factory_enabled"
+COOKIE_CULTIVATION_SETTING_KEY = "cookie_cultivation_enabled"
+STARFALL_SETTING_KEY = "starfall_enabled"
+COOKIE_WEEKLY_CAP = 100
+COOKIE_DELTA_BONUS = 0.05
+COOKIE_DELTA_BONUS_CAP = 1.25
+COOKIE_SETTLEMENT_CHUNK = 500
+COOKIE_SETTLEMENT_INTERVAL = 60
+COOKIE_SUGAR_COOLDOWN = 6 * 3600
+COOKIE_DAILY_CHALLENGE_TARGET = 120
 
 COOKIE_BUILDINGS = [
     {
@@ -6090,54 +7139,27 @@ def _coerce_int(value: Any, default: int = 0) -> int:
 
 
 def cookie_factory_enabled(db: Session) -> bool:
-    row = db.query(SystemSetting).filter_by(key=COOKIE_FACTORY_SETTING_KEY).first()
-    if not row:
-        return True
-    return str(row.value) != "0"
+    return SYSTEM_SETTINGS.flag(COOKIE_FACTORY_SETTING_KEY, True, db)
 
 
 def set_cookie_factory_enabled(db: Session, enabled: bool) -> None:
-    value = "1" if enabled else "0"
-    row = db.query(SystemSetting).filter_by(key=COOKIE_FACTORY_SETTING_KEY).first()
-    if row:
-        row.value = value
-    else:
-        db.add(SystemSetting(key=COOKIE_FACTORY_SETTING_KEY, value=value))
-    db.flush()
+    SYSTEM_SETTINGS.set(db, COOKIE_FACTORY_SETTING_KEY, "1" if enabled else "0")
 
 
 def cookie_cultivation_enabled(db: Session) -> bool:
-    row = db.query(SystemSetting).filter_by(key=COOKIE_CULTIVATION_SETTING_KEY).first()
-    if not row:
-        return False
-    return str(row.value) != "0"
+    return SYSTEM_SETTINGS.flag(COOKIE_CULTIVATION_SETTING_KEY, False, db)
 
 
 def set_cookie_cultivation_enabled(db: Session, enabled: bool) -> None:
-    value = "1" if enabled else "0"
-    row = db.query(SystemSetting).filter_by(key=COOKIE_CULTIVATION_SETTING_KEY).first()
-    if row:
-        row.value = value
-    else:
-        db.add(SystemSetting(key=COOKIE_CULTIVATION_SETTING_KEY, value=value))
-    db.flush()
+    SYSTEM_SETTINGS.set(db, COOKIE_CULTIVATION_SETTING_KEY, "1" if enabled else "0")
 
 
 def starfall_game_enabled(db: Session) -> bool:
-    row = db.query(SystemSetting).filter_by(key=STARFALL_SETTING_KEY).first()
-    if not row:
-        return True
-    return str(row.value) != "0"
+    return SYSTEM_SETTINGS.flag(STARFALL_SETTING_KEY, True, db)
 
 
 def set_starfall_game_enabled(db: Session, enabled: bool) -> None:
-    value = "1" if enabled else "0"
-    row = db.query(SystemSetting).filter_by(key=STARFALL_SETTING_KEY).first()
-    if row:
-        row.value = value
-    else:
-        db.add(SystemSetting(key=STARFALL_SETTING_KEY, value=value))
-    db.flush()
+    SYSTEM_SETTINGS.set(db, STARFALL_SETTING_KEY, "1" if enabled else "0")
 
 
 def cookie_week_start(ts: Optional[int] = None) -> int:
@@ -6163,65 +7185,135 @@ def cookie_day_key(ts: Optional[int] = None) -> str:
     return datetime.fromtimestamp(ts).strftime("%Y-%m-%d")
 
 
-def cookie_trim_map(data: Dict[str, Any], keep: int = 14) -> Dict[str, Any]:
-    if not data:
-        return {}
-    items = sorted(data.items(), key=lambda kv: kv[0])
-    if len(items) <= keep:
-        return dict(items)
-    return dict(items[-keep:])
+COOKIE_DAY_ROWS_KEEP = 21
 
 
-def cookie_mini_games_state(profile: CookieFactoryProfile) -> Dict[str, Any]:
-    state = _json_object(profile.mini_games, {})
-    changed = False
-    for key, cfg in COOKIE_MINI_GAMES.items():
-        node = state.get(key)
-        if not isinstance(node, dict):
-            node = {"level": 0, "progress": 0}
-            changed = True
-        else:
-            node.setdefault("level", 0)
-            node.setdefault("progress", 0)
-        node.setdefault("last_action", 0)
+class CookieFactoryState:
+    """一个会话内某玩家的饼干工坊子表行：首次访问时每表一次查询载入，之后都在这些 ORM 行上读写，
+    提交时只 UPDATE/INSERT 真正变动的行。修仙存档按需单独载入。"""
+
+    __slots__ = ("db", "user_id", "buildings", "minis", "days", "_cultivation")
+
+    def __init__(self, db: Session, user_id: int):
+        self.db = db
+        self.user_id = int(user_id)
+        self.buildings: Dict[str, CookieFactoryBuilding] = {
+            row.building: row for row in db.query(CookieFactoryBuilding).filter_by(user_id=self.user_id)
+        }
+        self.minis: Dict[str, CookieFactoryMiniGame] = {
+            row.mini: row for row in db.query(CookieFactoryMiniGame).filter_by(user_id=self.user_id)
+        }
+        self.days: Dict[str, CookieFactoryDay] = {
+            row.day: row for row in db.query(CookieFactoryDay).filter_by(user_id=self.user_id)
+        }
+        self._cultivation: Optional[CookieCultivationState] = None
+
+    def building_counts(self) -> Dict[str, int]:
+        counts: Dict[str, int] = {}
+        for cfg in COOKIE_BUILDINGS:
+            row = self.buildings.get(cfg["key"])
+            counts[cfg["key"]] = int(row.count or 0) if row else 0
+        return counts
+
+    def _insert(self, model, pk, **values):
+        """立即插入一行子表默认值后读回。同一玩家的并发请求可能已先插入这一行：
+        ON CONFLICT DO NOTHING 之后读到的就是那一行，不会在提交时撞主键。"""
+        self.db.execute(sqlite_insert(model).values(**values).on_conflict_do_nothing())
+        return self.db.get(model, pk)
+
+    def set_building_counts(self, counts: Dict[str, int]) -> None:
+        for key, count in counts.items():
+            row = self.buildings.get(key)
+            if row is None:
+                if not count:
+                    continue
+                row = self.buildings[key] = self._insert(
+                    CookieFactoryBuilding, (self.user_id, key), user_id=self.user_id, building=key, count=0
+                )
+            row.count = int(count)
+
+    def mini(self, key: str) -> CookieFactoryMiniGame:
+        row = self.minis.get(key)
+        if row is None:
+            row = self.minis[key] = self._insert(
+                CookieFactoryMiniGame, (self.user_id, key),
+                user_id=self.user_id, mini=key, level=0, progress=0, last_action=0,
+            )
+        return row
+
+    def day(self, day: str) -> CookieFactoryDay:
+        row = self.days.get(day)
+        if row is None:
+            row = self.days[day] = self._insert(
+                CookieFactoryDay, (self.user_id, day),
+                user_id=self.user_id, day=day, active_points=0, login_ts=None, challenge_clicks=0,
+            )
+            for old in sorted(self.days)[:-COOKIE_DAY_ROWS_KEEP]:
+                self.db.delete(self.days.pop(old))
+        return row
+
+    def reset_week(self) -> None:
+        for row in self.days.values():
+            row.active_points = 0
+            row.login_ts = None
+
+    def cultivation(self) -> CookieCultivationState:
+        if self._cultivation is None:
+            row = self.db.get(CookieCultivationState, self.user_id)
+            if row is None:
+                row = self._insert(
+                    CookieCultivationState, self.user_id, user_id=self.user_id, best_score=0, play_count=0, node="{}"
+                )
+            self._cultivation = row
+        return self._cultivation
+
+
+def cookie_state(profile: CookieFactoryProfile) -> CookieFactoryState:
+    db = object_session(profile)
+    states = db.info.setdefault("cookie_states", {})
+    state = states.get(profile.user_id)
+    if state is None:
+        state = states[profile.user_id] = CookieFactoryState(db, profile.user_id)
+    return state
+
+
+@event.listens_for(SessionLocal, "after_rollback")
+def _drop_cookie_states(session):
+    # 回滚后新建的子表行已被逐出会话，下次访问重新载入
+    session.info.pop("cookie_states", None)
+
+
+def cookie_mini_games_state(profile: CookieFactoryProfile) -> Dict[str, Dict[str, int]]:
+    """各小游戏的等级/进度快照（修仙存档见 _cultivation_node）。修改请用 cookie_state(profile).mini(key)。"""
+    rows = cookie_state(profile).minis
+    state: Dict[str, Dict[str, int]] = {}
+    for key in COOKIE_MINI_GAMES:
         if key == COOKIE_CULTIVATION_KEY:
-            node.setdefault("last_result", {})
-            node.setdefault("best_score", 0)
-            node.setdefault("play_count", 0)
-        state[key] = node
-    if changed:
-        profile.mini_games = _json_dump(state)
+            continue
+        row = rows.get(key)
+        state[key] = {
+            "level": int(row.level or 0) if row else 0,
+            "progress": int(row.progress or 0) if row else 0,
+            "last_action": int(row.last_action or 0) if row else 0,
+        }
     return state
 
 
 def cookie_building_counts(profile: CookieFactoryProfile) -> Dict[str, int]:
-    raw = _json_object(profile.buildings, {})
-    counts: Dict[str, int] = {}
-    for cfg in COOKIE_BUILDINGS:
-        key = cfg["key"]
-        counts[key] = int(raw.get(key, 0) or 0)
-    return counts
+    return cookie_state(profile).building_counts()
 
 
 def cookie_store_buildings(profile: CookieFactoryProfile, counts: Dict[str, int]) -> None:
-    profile.buildings = _json_dump({k: int(v) for k, v in counts.items()})
+    cookie_state(profile).set_building_counts(counts)
+    cookie_invalidate_production(profile)
 
 
 def cookie_cultivation_admin_stats(db: Session) -> Tuple[int, int]:
-    runs = 0
-    best = 0
-    rows = db.query(CookieFactoryProfile.mini_games).all()
-    for (raw,) in rows:
-        data = _json_object(raw, {})
-        node = data.get(COOKIE_CULTIVATION_KEY)
-        if not isinstance(node, dict):
-            continue
-        try:
-            runs += int(node.get("play_count") or 0)
-            best = max(best, int(node.get("best_score") or 0))
-        except Exception:
-            continue
-    return runs, best
+    runs, best = db.query(
+        func.coalesce(func.sum(CookieCultivationState.play_count), 0),
+        func.coalesce(func.max(CookieCultivationState.best_score), 0),
+    ).one()
+    return int(runs or 0), int(best or 0)
 
 
 def update_presence(
@@ -6435,10 +7527,9 @@ def _cultivation_outcome_text(
 
 
 
-def _cultivation_node(profile: CookieFactoryProfile) -> Tuple[Dict[str, Any], Dict[str, Any]]:
-    state = cookie_mini_games_state(profile)
-    raw_node = state.get(COOKIE_CULTIVATION_KEY)
-    node = raw_node if isinstance(raw_node, dict) else {}
+def _cultivation_node(profile: CookieFactoryProfile) -> Dict[str, Any]:
+    row = cookie_state(profile).cultivation()
+    node = _json_object(row.node, {})
     if "best_score" not in node:
         legacy_last = node.get("last_result") if isinstance(node.get("last_result"), dict) else None
         best = int(node.get("best_score") or node.get("best") or 0)
@@ -6451,9 +7542,14 @@ def _cultivation_node(profile: CookieFactoryProfile) -> Tuple[Dict[str, Any], Di
             "history": history,
         }
     node.setdefault("history", [])
-    state[COOKIE_CULTIVATION_KEY] = node
-    profile.mini_games = _json_dump(state)
-    return state, node
+    return node
+
+
+def _cultivation_save(profile: CookieFactoryProfile, node: Dict[str, Any]) -> None:
+    row = cookie_state(profile).cultivation()
+    row.node = _json_dump(node)
+    row.best_score = int(node.get("best_score") or 0)
+    row.play_count = int(node.get("play_count") or 0)
 
 
 def _cultivation_stats_template() -> Dict[str, int]:
@@ -8286,7 +9382,6 @@ def _cultivation_finalize(
     profile: CookieFactoryProfile,
     user: User,
     now: int,
-    state: Dict[str, Any],
     node: Dict[str, Any],
     run: Dict[str, Any],
 ) -> Dict[str, Any]:
@@ -8397,8 +9492,7 @@ def _cultivation_finalize(
     node["history"] = history[-10:]
     node.pop("active_run", None)
     node.pop("lobby", None)
-    state[COOKIE_CULTIVATION_KEY] = node
-    profile.mini_games = _json_dump(state)
+    _cultivation_save(profile, node)
     summary = f"{stage_name}境界 · {int(run.get('age', 0))} 岁 · 得分 {score}"
     return {
         "mini": COOKIE_CULTIVATION_KEY,
@@ -8440,25 +9534,46 @@ def cookie_building_cost(key: str, count: int) -> int:
     return int(math.ceil(cost))
 
 
-def cookie_cps(profile: CookieFactoryProfile, counts: Optional[Dict[str, int]] = None) -> Tuple[float, float]:
-    if counts is None:
-        counts = cookie_building_counts(profile)
+def cookie_production_coefficient(
+    counts: Dict[str, int],
+    mini_levels: Dict[str, int],
+    prestige: int,
+    prestige_points: int,
+) -> float:
+    """每秒基础产量：建筑产量 × 升天加成 × 小游戏加成，不含按周变化的奖励/惩罚倍率。"""
     base_cps = 0.0
     for cfg in COOKIE_BUILDINGS:
-        key = cfg["key"]
-        base_cps += float(cfg.get("base_cps", 0.0)) * counts.get(key, 0)
-    prestige_bonus = 1.0 + (float(profile.prestige_points or 0) * 0.05) + (float(profile.prestige or 0) * 0.02)
-    mini_state = cookie_mini_games_state(profile)
+        base_cps += float(cfg.get("base_cps", 0.0)) * counts.get(cfg["key"], 0)
+    prestige_bonus = 1.0 + (float(prestige_points or 0) * 0.05) + (float(prestige or 0) * 0.02)
     mini_bonus = 1.0
-    for key, node in mini_state.items():
+    for key, lvl in mini_levels.items():
         cfg = COOKIE_MINI_GAMES.get(key)
-        if not cfg:
-            continue
-        lvl = int(node.get("level", 0) or 0)
-        mini_bonus += lvl * float(cfg.get("cps_bonus", 0.0))
-    cps = base_cps * prestige_bonus * mini_bonus
-    effective = cps * float(profile.production_bonus_multiplier or 1.0) * float(profile.penalty_multiplier or 1.0)
-    return cps, effective
+        if cfg:
+            mini_bonus += int(lvl or 0) * float(cfg.get("cps_bonus", 0.0))
+    return base_cps * prestige_bonus * mini_bonus
+
+
+def cookie_base_cps(profile: CookieFactoryProfile) -> float:
+    """读取缓存的基础产量系数，缺失时按子表重算并写回 production_cps。"""
+    if profile.production_cps is None:
+        levels = {key: node["level"] for key, node in cookie_mini_games_state(profile).items()}
+        profile.production_cps = cookie_production_coefficient(
+            cookie_building_counts(profile), levels, int(profile.prestige or 0), int(profile.prestige_points or 0)
+        )
+    return float(profile.production_cps)
+
+
+def cookie_invalidate_production(profile: CookieFactoryProfile) -> None:
+    profile.production_cps = None
+
+
+def cookie_effective_cps(coefficient: float, bonus: Optional[float], penalty: Optional[float]) -> float:
+    return float(coefficient or 0.0) * float(bonus or 1.0) * float(penalty or 1.0)
+
+
+def cookie_cps(profile: CookieFactoryProfile) -> Tuple[float, float]:
+    cps = cookie_base_cps(profile)
+    return cps, cookie_effective_cps(cps, profile.production_bonus_multiplier, profile.penalty_multiplier)
 
 
 def cookie_click_gain(profile: CookieFactoryProfile, clicks: int, counts: Optional[Dict[str, int]] = None) -> float:
@@ -8501,11 +9616,8 @@ def cookie_prestige_requirement(profile: CookieFactoryProfile) -> float:
 def cookie_add_active_points(profile: CookieFactoryProfile, now: int, points: int) -> None:
     if points <= 0:
         return
-    day = cookie_day_key(now)
-    data = _json_object(profile.active_points, {})
-    data[day] = int(data.get(day, 0) or 0) + int(points)
-    data = cookie_trim_map(data, keep=21)
-    profile.active_points = _json_dump(data)
+    row = cookie_state(profile).day(cookie_day_key(now))
+    row.active_points = int(row.active_points or 0) + int(points)
 
 
 def cookie_register_login(profile: CookieFactoryProfile, now: int) -> Dict[str, Any]:
@@ -8535,10 +9647,7 @@ def cookie_register_login(profile: CookieFactoryProfile, now: int) -> Dict[str,
             profile.login_streak = 1
         profile.last_login_day = day
         changed = True
-        days = _json_object(profile.login_days, {})
-        days[day] = {"ts": cookie_day_start(now)}
-        days = cookie_trim_map(days, keep=21)
-        profile.login_days = _json_dump(days)
+        cookie_state(profile).day(day).login_ts = cookie_day_start(now)
     streak = int(profile.login_streak or 0)
     if changed:
         message = f"今日签到成功，连续登录 {streak} 天"
@@ -8577,8 +9686,22 @@ def cookie_active_bricks(active_points: Dict[str, int]) -> int:
     return total
 
 
-def cookie_login_bricks(login_days: Dict[str, Any]) -> int:
-    return len(login_days.keys()) * 2
+def cookie_weekly_bricks(
+    cookies_this_week: float,
+    active_bricks: int,
+    login_days: int,
+    login_streak: int,
+    claimed_raw: int,
+) -> Tuple[int, int, int, int, int, int]:
+    """按本周汇总值计算 (基础砖, 签到砖, 连签奖励, 预计, 已领, 可领)；逐档案与批量结算共用。"""
+    base_bricks = cookie_calculate_base_bricks(float(cookies_this_week or 0.0))
+    login_bricks = int(login_days or 0) * 2
+    streak_bonus = 14 if int(login_streak or 0) >= 7 else 0
+    projected = base_bricks + int(active_bricks or 0) + login_bricks + streak_bonus
+    projected = min(COOKIE_WEEKLY_CAP, max(0, projected))
+    claimed = max(0, min(projected, min(COOKIE_WEEKLY_CAP, int(claimed_raw or 0))))
+    claimable = max(0, projected - claimed)
+    return base_bricks, login_bricks, streak_bonus, projected, claimed, claimable
 
 
 def cookie_weekly_progress(
@@ -8594,18 +9717,17 @@ def cookie_weekly_progress(
     Dict[str, int],
     Dict[str, Any],
 ]:
-    active_map_raw = _json_object(profile.active_points, {})
-    active_map = {k: int(v) for k, v in active_map_raw.items()}
-    login_days = _json_object(profile.login_days, {})
-    base_bricks = cookie_calculate_base_bricks(float(profile.cookies_this_week or 0.0))
+    days = cookie_state(profile).days
+    active_map = {day: int(row.active_points) for day, row in days.items() if row.active_points}
+    login_days = {day: {"ts": int(row.login_ts)} for day, row in days.items() if row.login_ts is not None}
     active_bricks = cookie_active_bricks(active_map)
-    login_bricks = cookie_login_bricks(login_days)
-    streak_bonus = 14 if int(profile.login_streak or 0) >= 7 else 0
-    projected = base_bricks + active_bricks + login_bricks + streak_bonus
-    projected = min(COOKIE_WEEKLY_CAP, max(0, projected))
-    claimed_raw = int(getattr(profile, "claimed_bricks_this_week", 0) or 0)
-    claimed = max(0, min(projected, min(COOKIE_WEEKLY_CAP, claimed_raw)))
-    claimable = max(0, projected - claimed)
+    base_bricks, login_bricks, streak_bonus, projected, claimed, claimable = cookie_weekly_bricks(
+        float(profile.cookies_this_week or 0.0),
+        active_bricks,
+        len(login_days),
+        int(profile.login_streak or 0),
+        int(getattr(profile, "claimed_bricks_this_week", 0) or 0),
+    )
     return (
         base_bricks,
         active_bricks,
@@ -8620,24 +9742,21 @@ def cookie_weekly_progress(
 
 
 def cookie_challenge_map(profile: CookieFactoryProfile) -> Dict[str, int]:
-    return {k: int(v or 0) for k, v in _json_object(getattr(profile, "challenge_clicks", "{}"), {}).items()}
+    days = cookie_state(profile).days
+    return {day: int(row.challenge_clicks) for day, row in days.items() if row.challenge_clicks}
 
 
 def cookie_challenge_today(profile: CookieFactoryProfile, now: int) -> int:
-    day = cookie_day_key(now)
-    data = cookie_challenge_map(profile)
-    return int(data.get(day, 0) or 0)
+    row = cookie_state(profile).days.get(cookie_day_key(now))
+    return int(row.challenge_clicks or 0) if row else 0
 
 
 def cookie_challenge_increment(profile: CookieFactoryProfile, now: int, amount: int) -> int:
     if amount <= 0:
         return cookie_challenge_today(profile, now)
-    day = cookie_day_key(now)
-    data = cookie_challenge_map(profile)
-    data[day] = int(data.get(day, 0) or 0) + int(amount)
-    data = cookie_trim_map(data, keep=21)
-    profile.challenge_clicks = _json_dump(data)
-    return int(data.get(day, 0) or 0)
+    row = cookie_state(profile).day(cookie_day_key(now))
+    row.challenge_clicks = int(row.challenge_clicks or 0) + int(amount)
+    return int(row.challenge_clicks)
 
 
 def ensure_cookie_profile(db: Session, user: User, now: Optional[int] = None) -> CookieFactoryProfile:
@@ -8660,7 +9779,6 @@ def ensure_cookie_profile(db: Session, user: User, now: Optional[int] = None) ->
         )
         db.add(profile)
         db.flush()
-        cookie_mini_games_state(profile)
     else:
         start_ts = _coerce_int(getattr(profile, "week_start_ts", 0), 0)
         if start_ts <= 0:
@@ -8682,8 +9800,6 @@ def ensure_cookie_profile(db: Session, user: User, now: Optional[int] = None) ->
             profile.golden_ready_ts = now + int(profile.golden_cooldown or 0)
         if _coerce_int(getattr(profile, "last_sugar_ts", 0), 0) <= 0:
             profile.last_sugar_ts = now - COOKIE_SUGAR_COOLDOWN
-        if not getattr(profile, "mini_games", None):
-            cookie_mini_games_state(profile)
     return profile
 
 
@@ -8701,8 +9817,7 @@ def cookie_prepare_week(profile: CookieFactoryProfile, now: int) -> None:
         start_ts = current_week
         profile.cookies_this_week = 0.0
         profile.weekly_bricks_awarded = 0
-        profile.active_points = _json_dump({})
-        profile.login_days = _json_dump({})
+        cookie_state(profile).reset_week()
         profile.production_bonus_multiplier = float(profile.pending_bonus_multiplier or 1.0)
         profile.penalty_multiplier = float(profile.pending_penalty_multiplier or 1.0)
         profile.pending_bonus_multiplier = 1.0
@@ -8711,50 +9826,63 @@ def cookie_prepare_week(profile: CookieFactoryProfile, now: int) -> None:
     profile.week_start_ts = start_ts
 
 
-def cookie_finalize_week(db: Session, profile: CookieFactoryProfile, user: User, now: int) -> Optional[Dict[str, Any]]:
-    start_ts = _coerce_int(getattr(profile, "week_start_ts", 0), 0)
-    if start_ts <= 0:
-        return None
-    (
-        base_bricks,
-        active_brick,
-        login_brick,
-        streak_bonus,
-        projected,
-        claimed,
-        claimable,
-        active_map,
-        login_map,
-    ) = cookie_weekly_progress(profile)
-    auto_claimed = 0
-    awarded = claimed
-    if claimable > 0:
-        auto_claimed = claimable
-        awarded += claimable
-        claimed += claimable
-        user.unopened_bricks += claimable
-        profile.total_bricks_earned += claimable
-    profile.weekly_bricks_awarded = int(awarded)
-    report = {
+def cookie_week_report(
+    start_ts: int,
+    cookies_this_week: float,
+    active_bricks: int,
+    login_days: int,
+    login_streak: int,
+    claimed_raw: int,
+    penalty: Optional[float],
+    bonus: Optional[float],
+    now: int,
+) -> Dict[str, Any]:
+    """生成周结算报告（写入 last_report）：本周未领取的砖全部自动领取，auto_claimed 即需补发的数量。"""
+    base_bricks, login_bricks, streak_bonus, projected, claimed, claimable = cookie_weekly_bricks(
+        cookies_this_week, active_bricks, login_days, login_streak, claimed_raw
+    )
+    return {
         "week_start": start_ts,
         "week_end": start_ts + 7 * 86400,
-        "awarded": awarded,
+        "awarded": claimed + claimable,
         "base_bricks": base_bricks,
-        "active_bricks": active_brick,
-        "login_bricks": login_brick,
+        "active_bricks": int(active_bricks or 0),
+        "login_bricks": login_bricks,
         "streak_bonus": streak_bonus,
         "projected": projected,
-        "claimed": claimed,
-        "auto_claimed": auto_claimed,
-        "total_cookies": float(profile.cookies_this_week or 0.0),
-        "penalty_multiplier": float(profile.penalty_multiplier or 1.0),
-        "bonus_multiplier": float(profile.production_bonus_multiplier or 1.0),
+        "claimed": claimed + claimable,
+        "auto_claimed": claimable,
+        "total_cookies": float(cookies_this_week or 0.0),
+        "penalty_multiplier": float(penalty or 1.0),
+        "bonus_multiplier": float(bonus or 1.0),
         "timestamp": now,
     }
+
+
+def cookie_finalize_week(db: Session, profile: CookieFactoryProfile, user: User, now: int) -> Optional[Dict[str, Any]]:
+    start_ts = _coerce_int(getattr(profile, "week_start_ts", 0), 0)
+    if start_ts <= 0:
+        return None
+    days = cookie_state(profile).days
+    active_map = {day: int(row.active_points) for day, row in days.items() if row.active_points}
+    report = cookie_week_report(
+        start_ts,
+        float(profile.cookies_this_week or 0.0),
+        cookie_active_bricks(active_map),
+        sum(1 for row in days.values() if row.login_ts is not None),
+        int(profile.login_streak or 0),
+        int(getattr(profile, "claimed_bricks_this_week", 0) or 0),
+        profile.penalty_multiplier,
+        profile.production_bonus_multiplier,
+        now,
+    )
+    if report["auto_claimed"] > 0:
+        user.unopened_bricks += report["auto_claimed"]
+        profile.total_bricks_earned += report["auto_claimed"]
+    profile.weekly_bricks_awarded = int(report["awarded"])
     profile.last_report = json.dumps(report, ensure_ascii=False)
     profile.cookies_this_week = 0.0
-    profile.active_points = _json_dump({})
-    profile.login_days = _json_dump({})
+    cookie_state(profile).reset_week()
     profile.claimed_bricks_this_week = 0
     profile.production_bonus_multiplier = 1.0
     profile.penalty_multiplier = 1.0
@@ -8762,21 +9890,26 @@ def cookie_finalize_week(db: Session, profile: CookieFactoryProfile, user: User,
 
 
 def cookie_maybe_settle(db: Session, profile: CookieFactoryProfile, user: User, now: int) -> Optional[Dict[str, Any]]:
+    """请求路径上的周结算检查：跨周结算由 COOKIE_SETTLEMENT 批处理完成，这里通常只比较一次 week_start_ts。
+
+    批处理还没轮到的档案（刚跨周、或任务未运行）仍就地结算，结果与批处理一致；同时唤醒批处理。
+    """
     current_week = cookie_week_start(now)
     start_ts = _coerce_int(getattr(profile, "week_start_ts", 0), 0)
+    if start_ts >= current_week:
+        return None
     if start_ts <= 0:
         profile.week_start_ts = current_week
         cookie_prepare_week(profile, now)
         return None
-    if start_ts < current_week:
-        report = cookie_finalize_week(db, profile, user, now)
-        profile.week_start_ts = current_week
-        profile.production_bonus_multiplier = float(profile.pending_bonus_multiplier or 1.0)
-        profile.penalty_multiplier = float(profile.pending_penalty_multiplier or 1.0)
-        profile.pending_bonus_multiplier = 1.0
-        profile.pending_penalty_multiplier = 1.0
-        return report
-    return None
+    COOKIE_SETTLEMENT.start()
+    report = cookie_finalize_week(db, profile, user, now)
+    profile.week_start_ts = current_week
+    profile.production_bonus_multiplier = float(profile.pending_bonus_multiplier or 1.0)
+    profile.penalty_multiplier = float(profile.pending_penalty_multiplier or 1.0)
+    profile.pending_bonus_multiplier = 1.0
+    profile.pending_penalty_multiplier = 1.0
+    return report
 
 
 def cookie_tick(profile: CookieFactoryProfile, now: int) -> float:
@@ -8784,45 +9917,333 @@ def cookie_tick(profile: CookieFactoryProfile, now: int) -> float:
     if last <= 0:
         profile.last_active_ts = now
         return 0.0
-    delta = max(0, now - last)
     profile.last_active_ts = now
-    if delta <= 0:
+    if now <= last:
         return 0.0
-    cps, effective = cookie_cps(profile)
-    gain = effective * delta
-    return cookie_add(profile, gain)
+    _, effective = cookie_cps(profile)
+    return cookie_add(profile, cookie_offline_output(effective, last, now))
 
 
-def cookie_status_payload(
-    user: User,
-    profile: CookieFactoryProfile,
-    now: int,
-    settlement: Optional[Dict[str, Any]] = None,
-    feature_enabled: bool = True,
-    cultivation_enabled: bool = True,
-) -> Dict[str, Any]:
-    counts = cookie_building_counts(profile)
-    cps, effective_cps = cookie_cps(profile, counts)
-    mini_state = cookie_mini_games_state(profile)
-    (
-        base_bricks,
-        active_brick,
-        login_brick,
-        streak_bonus,
-        projected,
-        claimed,
-        claimable,
-        active_points,
-        login_days,
-    ) = cookie_weekly_progress(profile)
-    today = cookie_day_key(now)
-    daily_claimed = today in login_days
-    last_report = None
-    if profile.last_report:
-        try:
-            last_report = json.loads(profile.last_report)
-        except Exception:
-            last_report = None
+def cookie_offline_output(effective_cps: float, since: int, until: int) -> float:
+    """离线产量的闭式解：有效产量在两次活跃之间恒定，直接乘以经过的秒数。"""
+    return max(0.0, float(effective_cps)) * max(0, int(until) - int(since))
+
+
+def cookie_fill_production_cps(db: Session, user_ids: Optional[List[int]] = None) -> int:
+    """批量补算 production_cps 为空的档案：子表各一次查询，结果按主键批量 UPDATE。"""
+    missing = db.query(CookieFactoryProfile.user_id).filter(CookieFactoryProfile.production_cps.is_(None))
+    if user_ids is not None:
+        missing = missing.filter(CookieFactoryProfile.user_id.in_(list(user_ids)))
+    missing_ids = select(missing.subquery().c.user_id)
+    profiles = db.query(
+        CookieFactoryProfile.user_id, CookieFactoryProfile.prestige, CookieFactoryProfile.prestige_points
+    ).filter(CookieFactoryProfile.user_id.in_(missing_ids)).all()
+    if not profiles:
+        return 0
+    counts: Dict[int, Dict[str, int]] = {}
+    for uid, building, count in db.query(
+        CookieFactoryBuilding.user_id, CookieFactoryBuilding.building, CookieFactoryBuilding.count
+    ).filter(CookieFactoryBuilding.user_id.in_(missing_ids)):
+        counts.setdefault(uid, {})[building] = int(count or 0)
+    levels: Dict[int, Dict[str, int]] = {}
+    for uid, mini, level in db.query(
+        CookieFactoryMiniGame.user_id, CookieFactoryMiniGame.mini, CookieFactoryMiniGame.level
+    ).filter(CookieFactoryMiniGame.user_id.in_(missing_ids)):
+        levels.setdefault(uid, {})[mini] = int(level or 0)
+    db.execute(
+        update(CookieFactoryProfile),
+        [
+            {
+                "user_id": uid,
+                "production_cps": cookie_production_coefficient(
+                    counts.get(uid, {}), levels.get(uid, {}), int(prestige or 0), int(points or 0)
+                ),
+            }
+            for uid, prestige, points in profiles
+        ],
+    )
+    # 按主键批量 UPDATE 不会同步会话里已加载的档案：过期这一列，下次访问时重新读库
+    filled = {int(uid) for uid, _prestige, _points in profiles}
+    for obj in list(db.identity_map.values()):
+        if isinstance(obj, CookieFactoryProfile) and int(obj.user_id) in filled:
+            db.expire(obj, ["production_cps"])
+    return len(profiles)
+
+
+def cookie_project_weekly_output(
+    db: Session,
+    now: Optional[int] = None,
+    user_ids: Optional[List[int]] = None,
+) -> Dict[int, Dict[str, Any]]:
+    """按列批量估算各档案到本周结束时的饼干产量与基础砖数，供周结算等批处理使用。
+
+    假设玩家从最后活跃时刻起一直离线挂机：本周已产 + 有效产量 × 剩余秒数（闭式解，不逐个 tick）。
+    """
+    if now is None:
+        now = int(time.time())
+    cookie_fill_production_cps(db, user_ids)
+    query = db.query(
+        CookieFactoryProfile.user_id,
+        CookieFactoryProfile.cookies_this_week,
+        CookieFactoryProfile.production_cps,
+        CookieFactoryProfile.production_bonus_multiplier,
+        CookieFactoryProfile.penalty_multiplier,
+        CookieFactoryProfile.last_active_ts,
+        CookieFactoryProfile.week_start_ts,
+    )
+    if user_ids is not None:
+        query = query.filter(CookieFactoryProfile.user_id.in_(list(user_ids)))
+    rows = query.all()
+    if not rows:
+        return {}
+    uids, cookies, coeffs, bonuses, penalties, lasts, starts = zip(*rows)
+    fallback_start = cookie_week_start(now)
+    week_ends = [(int(start or 0) if int(start or 0) > 0 else fallback_start) + 7 * 86400 for start in starts]
+    effective = [cookie_effective_cps(c, b, p) for c, b, p in zip(coeffs, bonuses, penalties)]
+    projected = [
+        float(done or 0.0) + cookie_offline_output(eff, max(int(last or 0), end - 7 * 86400), end)
+        for done, eff, last, end in zip(cookies, effective, lasts, week_ends)
+    ]
+    return {
+        int(uid): {
+            "effective_cps": eff,
+            "week_end": end,
+            "projected_cookies": total,
+            "projected_base_bricks": cookie_calculate_base_bricks(total),
+        }
+        for uid, eff, end, total in zip(uids, effective, week_ends, projected)
+    }
+
+
+def cookie_settlement_pending(db: Session, week_start: int) -> bool:
+    """是否还有停留在 week_start 之前的档案；走 (week_start_ts, user_id) 索引，结算完后只读一页。"""
+    return db.query(CookieFactoryProfile.user_id).filter(
+        CookieFactoryProfile.week_start_ts > 0,
+        CookieFactoryProfile.week_start_ts < week_start,
+    ).first() is not None
+
+
+def cookie_settle_chunk(db: Session, week_start: int, after_user_id: int, limit: int, now: int) -> Tuple[int, int, int]:
+    """把 user_id > after_user_id 的一批旧周档案结算到 week_start，返回 (档案数, 最后 user_id, 自动发放砖数)。
+
+    与 cookie_finalize_week 结果一致，但不加载 ORM 对象：日表按 user_id 聚合一次，
+    档案按主键批量 UPDATE，用户砖数与日表清零各一条集合语句。调用方负责提交。
+    """
+    # 先写进度行拿到写锁，之后读到的档案不会再被请求路径的就地结算改动，避免重复发砖
+    db.execute(
+        update(CookieSettlementRun).where(CookieSettlementRun.week_start == week_start).values(updated_at=now)
+    )
+    rows = db.query(
+        CookieFactoryProfile.user_id,
+        CookieFactoryProfile.week_start_ts,
+        CookieFactoryProfile.cookies_this_week,
+        CookieFactoryProfile.login_streak,
+        CookieFactoryProfile.claimed_bricks_this_week,
+        CookieFactoryProfile.total_bricks_earned,
+        CookieFactoryProfile.production_bonus_multiplier,
+        CookieFactoryProfile.penalty_multiplier,
+        CookieFactoryProfile.pending_bonus_multiplier,
+        CookieFactoryProfile.pending_penalty_multiplier,
+    ).filter(
+        CookieFactoryProfile.week_start_ts > 0,
+        CookieFactoryProfile.week_start_ts < week_start,
+        CookieFactoryProfile.user_id > after_user_id,
+    ).order_by(CookieFactoryProfile.user_id).limit(limit).all()
+    if not rows:
+        return 0, after_user_id, 0
+    ids = [int(row.user_id) for row in rows]
+    day_totals = {
+        int(uid): (int(active or 0), int(logins or 0))
+        for uid, active, logins in db.query(
+            CookieFactoryDay.user_id,
+            func.sum(func.min(10, CookieFactoryDay.active_points // 10)),
+            func.count(CookieFactoryDay.login_ts),
+        ).filter(CookieFactoryDay.user_id.in_(ids)).group_by(CookieFactoryDay.user_id)
+    }
+    profile_updates: List[Dict[str, Any]] = []
+    brick_updates: List[Dict[str, int]] = []
+    for row in rows:
+        active_bricks, login_days = day_totals.get(int(row.user_id), (0, 0))
+        report = cookie_week_report(
+            int(row.week_start_ts),
+            float(row.cookies_this_week or 0.0),
+            active_bricks,
+            login_days,
+            int(row.login_streak or 0),
+            int(row.claimed_bricks_this_week or 0),
+            row.penalty_multiplier,
+            row.production_bonus_multiplier,
+            now,
+        )
+        gained = int(report["auto_claimed"])
+        if gained > 0:
+            brick_updates.append({"uid": int(row.user_id), "gained": gained})
+        profile_updates.append({
+            "user_id": int(row.user_id),
+            "week_start_ts": week_start,
+            "weekly_bricks_awarded": int(report["awarded"]),
+            "last_report": json.dumps(report, ensure_ascii=False),
+            "cookies_this_week": 0.0,
+            "claimed_bricks_this_week": 0,
+            "total_bricks_earned": int(row.total_bricks_earned or 0) + gained,
+            "production_bonus_multiplier": float(row.pending_bonus_multiplier or 1.0),
+            "penalty_multiplier": float(row.pending_penalty_multiplier or 1.0),
+            "pending_bonus_multiplier": 1.0,
+            "pending_penalty_multiplier": 1.0,
+        })
+    db.execute(update(CookieFactoryProfile), profile_updates)
+    if brick_updates:
+        users = User.__table__
+        db.execute(
+            update(users).where(users.c.id == bindparam("uid"))
+            .values(unopened_bricks=users.c.unopened_bricks + bindparam("gained")),
+            brick_updates,
+        )
+    db.query(CookieFactoryDay).filter(
+        CookieFactoryDay.user_id.in_(ids),
+        or_(CookieFactoryDay.active_points != 0, CookieFactoryDay.login_ts.isnot(None)),
+    ).update({CookieFactoryDay.active_points: 0, CookieFactoryDay.login_ts: None}, synchronize_session=False)
+    bricks = sum(item["gained"] for item in brick_updates)
+    db.execute(
+        update(CookieSettlementRun).where(CookieSettlementRun.week_start == week_start).values(
+            last_user_id=ids[-1],
+            settled=CookieSettlementRun.settled + len(ids),
+            bricks=CookieSettlementRun.bricks + bricks,
+        )
+    )
+    return len(ids), ids[-1], bricks
+
+
+class CookieWeeklySettlement:
+    """后台周结算：跨周后分批把全部档案结算到本周，每批一次提交并记录断点（cookie_settlement_runs）。
+
+    请求路径只需比较 week_start_ts；批处理尚未覆盖的档案由 cookie_maybe_settle 就地结算。
+    多 worker 时由租约持有者执行；即使两个进程同时跑，写锁与 week_start_ts 过滤也保证每个档案只结算一次。
+    """
+
+    def __init__(self, interval: int = COOKIE_SETTLEMENT_INTERVAL, chunk_size: int = COOKIE_SETTLEMENT_CHUNK):
+        self.interval = interval
+        self.chunk_size = chunk_size
+        self._lock = threading.Lock()
+        self._run_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="cookie-weekly-settlement", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _run(self) -> None:
+        while True:
+            try:
+                if acquire_worker_lease("cookie_weekly_settlement", self.interval * 3):
+                    self.run()
+            except Exception as exc:
+                print(f"[cookie-settlement] 周结算失败：{exc}")
+            if self._stop.wait(self.interval):
+                return
+
+    def run(self, now: Optional[int] = None, progress=None) -> int:
+        """结算所有停留在旧周的档案，返回本次结算的档案数；中断后再次调用会从断点继续。"""
+        if now is None:
+            now = int(time.time())
+        week_start = cookie_week_start(now)
+        settled = 0
+        with self._run_lock, SessionLocal() as db:
+            if not cookie_settlement_pending(db, week_start):
+                return 0
+            # 其他进程可能同时建了这一行，用 OR IGNORE 避免主键冲突
+            db.execute(
+                insert(CookieSettlementRun).prefix_with("OR IGNORE").values(
+                    week_start=week_start, last_user_id=0, settled=0, bricks=0, started_at=now, updated_at=now
+                )
+            )
+            db.commit()
+            run = db.get(CookieSettlementRun, week_start)
+            # 本周已跑完却仍有旧档案（如恢复了备份），从头再扫一遍
+            after = 0 if run.finished_at else int(run.last_user_id or 0)
+            rescanned = after == 0
+            while True:
+                count, after, bricks = cookie_settle_chunk(db, week_start, after, self.chunk_size, now)
+                if count:
+                    db.commit()
+                    settled += count
+                    if progress:
+                        progress(after, count, bricks)
+                    continue
+                # 扫到末尾；断点之前若还有漏网的档案（断点之后才导入的数据等），再从头补扫一次
+                if rescanned or not cookie_settlement_pending(db, week_start):
+                    break
+                after, rescanned = 0, True
+            db.execute(
+                update(CookieSettlementRun).where(CookieSettlementRun.week_start == week_start)
+                .values(finished_at=now)
+            )
+            db.commit()
+        return settled
+
+
+    def forecast(self, db: Session, now: Optional[int] = None) -> Dict[str, Any]:
+        """本周结算预估与上次批处理进度，供管理后台展示；预估按离线挂机到周末的闭式解批量计算。"""
+        if now is None:
+            now = int(time.time())
+        week_start = cookie_week_start(now)
+        projection = cookie_project_weekly_output(db, now)
+        db.commit()  # 保存顺带补算的 production_cps
+        last_run = db.query(CookieSettlementRun).order_by(CookieSettlementRun.week_start.desc()).first()
+        return {
+            "week_start": week_start,
+            "week_end": week_start + 7 * 86400,
+            "projected_cookies": round(sum(v["projected_cookies"] for v in projection.values()), 2),
+            "projected_base_bricks": sum(
+                min(COOKIE_WEEKLY_CAP, v["projected_base_bricks"]) for v in projection.values()
+            ),
+            "last_run": {
+                "week_start": int(last_run.week_start),
+                "settled": int(last_run.settled or 0),
+                "bricks": int(last_run.bricks or 0),
+                "finished_at": last_run.finished_at,
+            } if last_run else None,
+        }
+
+
+COOKIE_SETTLEMENT = CookieWeeklySettlement()
+
+
+@app.on_event("startup")
+def _start_cookie_settlement():
+    COOKIE_SETTLEMENT.start()
+
+
+def _cookie_profile_payload(profile: CookieFactoryProfile, cps: float, effective_cps: float) -> Dict[str, Any]:
+    return {
+        "cookies": round(float(profile.banked_cookies or 0.0), 2),
+        "cookies_this_week": round(float(profile.cookies_this_week or 0.0), 2),
+        "total_cookies": round(float(profile.total_cookies or 0.0), 2),
+        "prestige_cycle_cookies": round(float(profile.prestige_cycle_cookies or 0.0), 2),
+        "manual_clicks": int(profile.manual_clicks or 0),
+        "golden_cookies": int(profile.golden_cookies or 0),
+        "prestige": int(profile.prestige or 0),
+        "prestige_points": int(profile.prestige_points or 0),
+        "sugar_lumps": int(profile.sugar_lumps or 0),
+        "cps": round(cps, 3),
+        "effective_cps": round(effective_cps, 3),
+        "bonus_multiplier": round(float(profile.production_bonus_multiplier or 1.0), 3),
+        "penalty_multiplier": round(float(profile.penalty_multiplier or 1.0), 3),
+        "next_bonus_multiplier": round(float(profile.pending_bonus_multiplier or 1.0), 3),
+        "next_penalty_multiplier": round(float(profile.pending_penalty_multiplier or 1.0), 3),
+        "next_prestige_requirement": round(float(cookie_prestige_requirement(profile)), 2),
+    }
+
+
+def _cookie_buildings_payload(counts: Dict[str, int]) -> List[Dict[str, Any]]:
     buildings_payload = []
     for cfg in COOKIE_BUILDINGS:
         key = cfg["key"]
@@ -8836,12 +10257,16 @@ def cookie_status_payload(
             "next_cost": cookie_building_cost(key, count),
             "desc": cfg["desc"],
         })
+    return buildings_payload
+
+
+def _cookie_minis_payload(mini_state: Dict[str, Dict[str, int]]) -> List[Dict[str, Any]]:
     mini_payload = []
     for key, cfg in COOKIE_MINI_GAMES.items():
         if key == COOKIE_CULTIVATION_KEY:
             continue
         node = mini_state.get(key, {})
-        item = {
+        mini_payload.append({
             "key": key,
             "name": cfg["name"],
             "icon": cfg["icon"],
@@ -8852,57 +10277,77 @@ def cookie_status_payload(
             "sugar_cost": int(cfg.get("sugar_cost", 0)),
             "points": int(cfg.get("points", 0)),
             "cps_bonus": float(cfg.get("cps_bonus", 0.0)),
-        }
-        if key == COOKIE_CULTIVATION_KEY:
-            last_result = node.get("last_result") if isinstance(node.get("last_result"), dict) else {}
-            item.update(
-                {
-                    "mode": "cultivation",
-                    "best_score": int(node.get("best_score") or last_result.get("best") or 0),
-                    "play_count": int(node.get("play_count") or 0),
-                    "score_threshold": int(cfg.get("score_threshold", 0) or 0),
-                    "last_result": last_result or None,
-                }
-            )
-        mini_payload.append(item)
-    active_breakdown = [
-        {"day": day, "points": int(val)} for day, val in sorted(active_points.items())
-    ]
-    login_list = [
-        {"day": day, "ts": info.get("ts", 0)} for day, info in sorted(login_days.items())
-    ]
-    challenge_map = cookie_challenge_map(profile)
-    challenge_list = [
-        {"day": day, "clicks": int(val)} for day, val in sorted(challenge_map.items())
-    ]
-    sugar_ready_in = max(0, (int(profile.last_sugar_ts or 0) + COOKIE_SUGAR_COOLDOWN) - now)
+        })
+    return mini_payload
+
+
+def _cookie_timers_payload(profile: CookieFactoryProfile, now: int) -> Dict[str, Any]:
+    sugar_ready_in = max(0, (int(profile.last_sugar_ts or 0) + COOKIE_SUGAR_COOLDOWN) - now)
     golden_ready_in = max(0, int(profile.golden_ready_ts or 0) - now)
+    return {
+        "golden": {
+            "available": golden_ready_in <= 0,
+            "cooldown": int(profile.golden_cooldown or 0),
+            "ready_in": golden_ready_in,
+        },
+        "sugar": {
+            "available": sugar_ready_in <= 0,
+            "ready_in": sugar_ready_in,
+            "cooldown": COOKIE_SUGAR_COOLDOWN,
+        },
+    }
+
+
+def cookie_status_payload(
+    user: User,
+    profile: CookieFactoryProfile,
+    now: int,
+    settlement: Optional[Dict[str, Any]] = None,
+    feature_enabled: bool = True,
+    cultivation_enabled: bool = True,
+) -> Dict[str, Any]:
+    counts = cookie_building_counts(profile)
+    cps, effective_cps = cookie_cps(profile)
+    mini_state = cookie_mini_games_state(profile)
+    (
+        base_bricks,
+        active_brick,
+        login_brick,
+        streak_bonus,
+        projected,
+        claimed,
+        claimable,
+        active_points,
+        login_days,
+    ) = cookie_weekly_progress(profile)
+    today = cookie_day_key(now)
+    daily_claimed = today in login_days
+    last_report = None
+    if profile.last_report:
+        try:
+            last_report = json.loads(profile.last_report)
+        except Exception:
+            last_report = None
+    buildings_payload = _cookie_buildings_payload(counts)
+    mini_payload = _cookie_minis_payload(mini_state)
+    active_breakdown = [
+        {"day": day, "points": int(val)} for day, val in sorted(active_points.items())
+    ]
+    login_list = [
+        {"day": day, "ts": info.get("ts", 0)} for day, info in sorted(login_days.items())
+    ]
+    challenge_map = cookie_challenge_map(profile)
+    challenge_list = [
+        {"day": day, "clicks": int(val)} for day, val in sorted(challenge_map.items())
+    ]
     today_challenge = int(challenge_map.get(today, 0) or 0)
-    requirement = cookie_prestige_requirement(profile)
     week_start = _coerce_int(getattr(profile, "week_start_ts", 0), 0)
     if week_start <= 0:
         week_start = cookie_week_start(now)
     return {
         "enabled": bool(feature_enabled),
         "now": now,
-        "profile": {
-            "cookies": round(float(profile.banked_cookies or 0.0), 2),
-            "cookies_this_week": round(float(profile.cookies_this_week or 0.0), 2),
-            "total_cookies": round(float(profile.total_cookies or 0.0), 2),
-            "prestige_cycle_cookies": round(float(profile.prestige_cycle_cookies or 0.0), 2),
-            "manual_clicks": int(profile.manual_clicks or 0),
-            "golden_cookies": int(profile.golden_cookies or 0),
-            "prestige": int(profile.prestige or 0),
-            "prestige_points": int(profile.prestige_points or 0),
-            "sugar_lumps": int(profile.sugar_lumps or 0),
-            "cps": round(cps, 3),
-            "effective_cps": round(effective_cps, 3),
-            "bonus_multiplier": round(float(profile.production_bonus_multiplier or 1.0), 3),
-            "penalty_multiplier": round(float(profile.penalty_multiplier or 1.0), 3),
-            "next_bonus_multiplier": round(float(profile.pending_bonus_multiplier or 1.0), 3),
-            "next_penalty_multiplier": round(float(profile.pending_penalty_multiplier or 1.0), 3),
-            "next_prestige_requirement": round(float(requirement), 2),
-        },
+        "profile": _cookie_profile_payload(profile, cps, effective_cps),
         "buildings": buildings_payload,
         "mini_games": mini_payload,
         "weekly": {
@@ -8929,16 +10374,7 @@ def cookie_status_payload(
             "completed": today_challenge >= COOKIE_DAILY_CHALLENGE_TARGET,
             "history": challenge_list,
         },
-        "golden": {
-            "available": golden_ready_in <= 0,
-            "cooldown": int(profile.golden_cooldown or 0),
-            "ready_in": golden_ready_in,
-        },
-        "sugar": {
-            "available": sugar_ready_in <= 0,
-            "ready_in": sugar_ready_in,
-            "cooldown": COOKIE_SUGAR_COOLDOWN,
-        },
+        **_cookie_timers_payload(profile, now),
         "settlement": settlement,
         "last_report": last_report,
         "features": {
@@ -8947,17 +10383,174 @@ def cookie_status_payload(
     }
 
 
+def cookie_delta_payload(
+    profile: CookieFactoryProfile,
+    now: int,
+    touched: Set[str],
+    settlement: Optional[Dict[str, Any]] = None,
+) -> Dict[str, Any]:
+    """批量操作后的精简状态：结构与 cookie_status_payload 的同名字段一致，前端直接合并。
+
+    建筑/小游戏列表只在相应操作发生过时返回；出现周结算时前端应重新拉取完整状态。
+    """
+    cps, effective_cps = cookie_cps(profile)
+    _, _, _, _, projected, claimed, claimable, _, _ = cookie_weekly_progress(profile)
+    today_challenge = cookie_challenge_today(profile, now)
+    delta: Dict[str, Any] = {
+        "now": now,
+        "profile": _cookie_profile_payload(profile, cps, effective_cps),
+        "weekly": {
+            "projected_bricks": projected,
+            "cap_remaining": max(0, COOKIE_WEEKLY_CAP - projected),
+            "claimed_bricks": claimed,
+            "claimable_bricks": claimable,
+        },
+        "challenge": {
+            "today": today_challenge,
+            "remaining": max(0, COOKIE_DAILY_CHALLENGE_TARGET - today_challenge),
+            "completed": today_challenge >= COOKIE_DAILY_CHALLENGE_TARGET,
+        },
+        **_cookie_timers_payload(profile, now),
+    }
+    if touched & {"buy_building", "prestige"}:
+        delta["buildings"] = _cookie_buildings_payload(cookie_building_counts(profile))
+    if touched & {"mini", "prestige"}:
+        delta["mini_games"] = _cookie_minis_payload(cookie_mini_games_state(profile))
+    if settlement:
+        delta["settlement"] = settlement
+    return delta
+
+
+class CookieActivityQueue:
+    """三角洲活动（开砖、出售砖）事件队列：只在内存里记 (user_id, ts)，后台线程每隔几秒批量
+    给对应档案加下周产量加成（每次 COOKIE_DELTA_BONUS，封顶 COOKIE_DELTA_BONUS_CAP）。
+
+    加成是带上限的累加，各 worker 各自写库也不会冲突，无需租约。事件发生在上一周、
+    档案却已被周结算推进到本周时，加成记到本周倍率上，与结算前就写入的效果相同。
+    """
+
+    flush_interval = 2.0
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._events: List[Tuple[int, int]] = []
+        self._thread: Optional[threading.Thread] = None
+
+    def _start(self) -> None:
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="cookie-activity-flush", daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as exc:
+                print(f"[cookie-activity] 写入失败：{exc}")
+
+    def record(self, events: Iterable[Tuple[int, int]]) -> None:
+        self._start()
+        with self._lock:
+            self._events.extend(events)
+
+    def flush(self) -> int:
+        """把积压的事件写入档案，返回处理的事件数；写库失败时事件放回队列等下次重试。"""
+        with self._lock:
+            events, self._events = self._events, []
+        if not events:
+            return 0
+        try:
+            self._apply(events)
+        except Exception:
+            with self._lock:
+                self._events[:0] = events
+            raise
+        return len(events)
+
+    @staticmethod
+    def _apply(events: List[Tuple[int, int]]) -> None:
+        counts: Dict[Tuple[int, int], int] = {}
+        for user_id, ts in events:
+            key = (user_id, cookie_week_start(ts))
+            counts[key] = counts.get(key, 0) + 1
+        now = int(time.time())
+        with SessionLocal() as db:
+            user_ids = {user_id for user_id, _week in counts}
+            existing = {
+                uid for (uid,) in db.query(CookieFactoryProfile.user_id).filter(
+                    CookieFactoryProfile.user_id.in_(user_ids)
+                )
+            }
+            missing = user_ids - existing
+            if missing:
+                for user in db.query(User).filter(User.id.in_(missing)):
+                    ensure_cookie_profile(db, user, now)
+                db.flush()
+            params = [
+                {
+                    "uid": user_id,
+                    "week": week,
+                    "next_week": cookie_week_start(week + 7 * 86400 + 3600),
+                    "bump": COOKIE_DELTA_BONUS * n,
+                }
+                for (user_id, week), n in counts.items()
+            ]
+            profiles = CookieFactoryProfile.__table__
+
+            def bumped(column):
+                current = func.coalesce(column, 1.0)
+                return func.max(current, func.min(COOKIE_DELTA_BONUS_CAP, current + bindparam("bump")))
+
+            # 档案仍在事件所在周（或更早）：加到下周待生效倍率
+            db.execute(
+                update(profiles)
+                .where(profiles.c.user_id == bindparam("uid"), profiles.c.week_start_ts <= bindparam("week"))
+                .values(pending_bonus_multiplier=bumped(profiles.c.pending_bonus_multiplier)),
+                params,
+            )
+            # 档案已结算到下一周：待生效倍率已转正，直接加到本周倍率
+            db.execute(
+                update(profiles)
+                .where(profiles.c.user_id == bindparam("uid"), profiles.c.week_start_ts == bindparam("next_week"))
+                .values(production_bonus_multiplier=bumped(profiles.c.production_bonus_multiplier)),
+                params,
+            )
+            db.commit()
+
+
+COOKIE_ACTIVITY = CookieActivityQueue()
+
+
+@app.on_event("shutdown")
+def _flush_cookie_activity():
+    COOKIE_ACTIVITY.flush()
+
+
 def mark_cookie_delta_activity(db: Session, user_id: int) -> None:
+    """记录一次三角洲活动；只追加到会话内列表，提交成功后才进入 COOKIE_ACTIVITY，回滚则丢弃。
+
+    开砖与交易事务里不再读写饼干工坊的表。
+    """
     if not user_id:
         return
-    user = db.query(User).filter_by(id=user_id).first()
-    if not user:
-        return
-    profile = ensure_cookie_profile(db, user)
-    current = float(profile.pending_bonus_multiplier or 1.0)
-    bonus = min(COOKIE_DELTA_BONUS_CAP, current + COOKIE_DELTA_BONUS)
-    if bonus > current:
-        profile.pending_bonus_multiplier = bonus
+    db.info.setdefault("cookie_activity", []).append((int(user_id), int(time.time())))
+
+
+@event.listens_for(SessionLocal, "after_commit")
+def _queue_cookie_activity_after_commit(session):
+    events = session.info.pop("cookie_activity", None)
+    if events:
+        COOKIE_ACTIVITY.record(events)
+
+
+@event.listens_for(SessionLocal, "after_rollback")
+def _drop_cookie_activity(session):
+    session.info.pop("cookie_activity", None)
+
 
 def _clamp_brick_price(val: float) -> float:
     try:
@@ -8984,7 +10577,7 @@ def _sync_cfg_price(cfg: PoolConfig, state: BrickMarketState) -> int:
         cfg.brick_price = unit
     return unit
 
-def apply_brick_market_influence(db: Session, cfg: PoolConfig, results: List[Dict[str, Any]]):
+def apply_brick_market_influence(db: Session, cfg: PoolConfig, results: List[Dict[str, Any]]) -> BrickMarketState:
     state = ensure_brick_market_state(db, cfg)
     bricks = [r for r in results if str(r.get("rarity", "")).upper() == "BRICK"]
     score = 0.0
@@ -9004,6 +10597,7 @@ def apply_brick_market_influence(db: Session, cfg: PoolConfig, results: List[Dic
     state.price = _clamp_brick_price(new_price)
     state.last_update = int(time.time())
     _sync_cfg_price(cfg, state)
+    return state
 
 def brick_price_snapshot(db: Session, cfg: PoolConfig) -> Dict[str, float]:
     state = ensure_brick_market_state(db, cfg)
@@ -9031,12 +10625,10 @@ def _season_brick_price(base_price: int, season: Optional[str]) -> int:
     return price
 
 
-def official_sell_layers(cfg: PoolConfig, state: BrickMarketState) -> List[Dict[str, Any]]:
-    base_price = _sync_cfg_price(cfg, state)
-    seed_val = int((state.last_update or int(time.time())) / 600) or 1
+def _generate_official_layers(base_price: int, seed_val: int, season_ids: Tuple[str, ...]) -> List[Dict[str, Any]]:
     rng = random.Random(seed_val)
     target_total = rng.randint(3000, 5000)
-    seasons = list(SEASON_IDS) or [BRICK_SEASON_FALLBACK]
+    seasons = list(season_ids) or [BRICK_SEASON_FALLBACK]
     layers: List[Dict[str, Any]] = []
     remaining = target_total
     rng.shuffle(seasons)
@@ -9063,26 +10655,218 @@ def official_sell_layers(cfg: PoolConfig, state: BrickMarketState) -> List[Dict[
     layers.sort(key=lambda x: (x["price"], x.get("priority", 0)))
     return layers
 
-def build_brick_histogram(layers: List[Dict[str, Any]], player_orders: List[BrickSellOrder], bucket_size: int = 10) -> List[Dict[str, Any]]:
-    entries: List[Tuple[int, int]] = []
-    for layer in layers:
-        entries.append((int(layer.get("price", 0)), int(layer.get("quantity", 0))))
-    for order in player_orders:
-        entries.append((int(order.price), int(order.remaining)))
-    entries = [(p, q) for (p, q) in entries if q > 0]
-    if not entries:
+
+OFFICIAL_LAYER_WINDOW_SEC = 600
+
+
+class OfficialLayerProvider:
+    """官方砖挂单按 (10 分钟种子窗口, 基准价, 赛季列表) 记忆化，并记录窗口内已售出的数量。
+
+    同一窗口内重复购买看到的是逐步减少的同一份官方挂单；消耗量在会话提交后才计入
+    （见 consume_official_bricks），未提交的消耗只对本会话可见。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cache: Dict[Tuple[int, int, Tuple[str, ...]], List[Dict[str, Any]]] = {}
+        self._window = None
+        self._consumed: Dict[str, int] = {}
+        self.revision = 0
+
+    def _roll_window(self, window: int) -> None:
+        # 只向前滚动：本进程的行情快照稍旧时，不能把其他 worker 已进入的新窗口消耗清掉
+        if self._window is None or window > self._window:
+            self._window = window
+            self._consumed = {}
+            self.revision += 1
+            self._cache = {k: v for k, v in self._cache.items() if k[0] == window}
+
+    def layers(self, base_price: int, last_update: Optional[int], pending: Optional[Dict[str, int]] = None) -> List[Dict[str, Any]]:
+        window = int((last_update or int(time.time())) / OFFICIAL_LAYER_WINDOW_SEC) or 1
+        key = (window, int(base_price), tuple(SEASON_IDS))
+        with self._lock:
+            self._roll_window(window)
+            base = self._cache.get(key)
+            if base is None:
+                base = _generate_official_layers(int(base_price), window, key[2])
+                self._cache[key] = base
+            consumed = dict(self._consumed) if self._window == window else {}
+        for season, qty in (pending or {}).items():
+            consumed[season] = consumed.get(season, 0) + qty
+        result: List[Dict[str, Any]] = []
+        for layer in base:
+            entry = dict(layer)
+            used = consumed.get(_brick_season_key(entry.get("season")), 0)
+            entry["quantity"] = max(0, int(entry["quantity"]) - used)
+            result.append(entry)
+        return result
+
+    def consume(self, window: int, consumed: Dict[str, int]) -> None:
+        with self._lock:
+            if self._window is not None and window < self._window:
+                return
+            # 其他 worker 先进入了新窗口：本进程跟着滚动，而不是把这笔消耗丢掉
+            self._roll_window(window)
+            for season, qty in consumed.items():
+                self._consumed[season] = self._consumed.get(season, 0) + qty
+            self.revision += 1
+
+    def prime(self) -> None:
+        """进程启动时从缓存通道回放各 worker 已提交的消耗，重建当前窗口的 _consumed。"""
+        for key in CACHE_BUS.replay("official_layers"):
+            consumed = json.loads(key)
+            self.consume(int(consumed["window"]), consumed["seasons"])
+
+
+OFFICIAL_LAYERS = OfficialLayerProvider()
+
+
+def official_sell_layers(cfg: PoolConfig, state: BrickMarketState, db: Optional[Session] = None) -> List[Dict[str, Any]]:
+    base_price = _sync_cfg_price(cfg, state)
+    pending = None
+    if db is not None:
+        pending = db.info.get("official_brick_consumed", {}).get("seasons")
+    return OFFICIAL_LAYERS.layers(base_price, state.last_update, pending)
+
+
+def consume_official_bricks(db: Session, state: BrickMarketState, plan: List[Dict[str, Any]]) -> None:
+    """登记本会话从官方挂单买走的数量，提交后计入当前窗口。"""
+    window = int((state.last_update or int(time.time())) / OFFICIAL_LAYER_WINDOW_SEC) or 1
+    pending = db.info.setdefault("official_brick_consumed", {"window": window, "seasons": {}})
+    if pending["window"] != window:
+        pending["window"] = window
+        pending["seasons"] = {}
+    for item in plan:
+        if item["type"] != "official":
+            continue
+        season = _brick_season_key(item.get("season"))
+        pending["seasons"][season] = pending["seasons"].get(season, 0) + int(item["quantity"])
+
+
+def aggregate_brick_depth(entries: Iterable[Tuple[int, int]]) -> Dict[int, int]:
+    """按价格汇总挂单数量（单次遍历），histogram 与 depth 共用。"""
+    depth: Dict[int, int] = {}
+    for price, qty in entries:
+        if qty > 0:
+            depth[int(price)] = depth.get(int(price), 0) + int(qty)
+    return depth
+
+
+def _window_depth(depth: Dict[int, int], price_min: Optional[int], price_max: Optional[int]) -> List[Tuple[int, int]]:
+    return sorted(
+        (p, q) for p, q in depth.items()
+        if (price_min is None or p >= price_min) and (price_max is None or p <= price_max)
+    )
+
+
+def brick_depth_levels(depth: Dict[int, int], price_min: Optional[int] = None, price_max: Optional[int] = None) -> List[Dict[str, int]]:
+    levels: List[Dict[str, int]] = []
+    cumulative = 0
+    for price, qty in _window_depth(depth, price_min, price_max):
+        cumulative += qty
+        levels.append({"price": price, "quantity": qty, "cumulative": cumulative})
+    return levels
+
+
+BRICK_HISTOGRAM_MAX_BUCKETS = 500
+
+
+def brick_histogram_bucket(low: int, high: int, bucket_size: int) -> int:
+    """[low, high] 按 bucket_size 分桶超过 BRICK_HISTOGRAM_MAX_BUCKETS 个时，放宽到刚好不超过的桶宽。"""
+    bucket_size = max(1, int(bucket_size))
+    while (high // bucket_size) - (low // bucket_size) + 1 > BRICK_HISTOGRAM_MAX_BUCKETS:
+        bucket_size = max(bucket_size + 1, -(-(high - low + 1) // (BRICK_HISTOGRAM_MAX_BUCKETS - 1)))
+    return bucket_size
+
+
+def build_brick_histogram(
+    depth: Dict[int, int],
+    bucket_size: int = 10,
+    price_min: Optional[int] = None,
+    price_max: Optional[int] = None,
+) -> List[Dict[str, Any]]:
+    levels = _window_depth(depth, price_min, price_max)
+    if not levels:
         return []
-    prices = [p for p, _ in entries]
-    min_price = max(0, (min(prices) // bucket_size) * bucket_size)
-    max_price = ((max(prices) // bucket_size) + 1) * bucket_size
-    buckets: List[Dict[str, Any]] = []
-    cur = min_price
-    while cur < max_price:
-        upper = cur + bucket_size
-        total_qty = sum(q for p, q in entries if p >= cur and (p < upper or (cur == max_price - bucket_size and p <= upper)))
-        buckets.append({"min": cur, "max": upper, "count": total_qty})
-        cur = upper
-    return buckets
+    # 区间只取盘口里真实存在的价格，桶数再按 BRICK_HISTOGRAM_MAX_BUCKETS 放宽桶宽，
+    # 分配多大的列表不由客户端传的 price_min/price_max 决定
+    low, high = levels[0][0], levels[-1][0]
+    bucket_size = brick_histogram_bucket(low, high, bucket_size)
+    start = max(0, (low // bucket_size) * bucket_size)
+    counts = [0] * ((high // bucket_size) - (start // bucket_size) + 1)
+    for price, qty in levels:
+        counts[(price - start) // bucket_size] += qty
+    return [
+        {"min": start + idx * bucket_size, "max": start + (idx + 1) * bucket_size, "count": count}
+        for idx, count in enumerate(counts)
+    ]
+
+
+class BrickDepthCache:
+    """按赛季缓存卖盘深度（玩家 GROUP BY + 官方层），撮合簿或官方层版本变化后失效。"""
+
+    max_entries = 256
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._depth: Dict[Tuple[Any, ...], Dict[int, int]] = {}
+        self._views: Dict[Tuple[Any, ...], Dict[str, Any]] = {}
+
+    def _depth_for(self, db: Session, season_key: Optional[str], layers: List[Dict[str, Any]], version: Tuple[Any, ...]) -> Dict[int, int]:
+        key = (season_key,) + version
+        with self._lock:
+            cached = self._depth.get(key)
+        if cached is not None:
+            return cached
+        q = db.query(BrickSellOrder.price, func.sum(BrickSellOrder.remaining)).filter(
+            BrickSellOrder.active == True, BrickSellOrder.source == "player", BrickSellOrder.remaining > 0
+        )
+        if season_key:
+            q = q.filter(func.upper(BrickSellOrder.season) == season_key)
+        entries: List[Tuple[int, int]] = [(int(p), int(qty or 0)) for p, qty in q.group_by(BrickSellOrder.price).all()]
+        entries.extend((int(layer["price"]), int(layer.get("quantity", 0))) for layer in layers)
+        depth = aggregate_brick_depth(entries)
+        with self._lock:
+            if len(self._depth) >= self.max_entries:
+                self._depth.clear()
+                self._views.clear()
+            self._depth[key] = depth
+        return depth
+
+    def view(
+        self,
+        db: Session,
+        season_key: Optional[str],
+        layers: List[Dict[str, Any]],
+        version: Tuple[Any, ...],
+        bucket_size: int,
+        price_min: Optional[int],
+        price_max: Optional[int],
+    ) -> Dict[str, Any]:
+        depth = self._depth_for(db, season_key, layers, version)
+        # 缓存键用收窄到盘口真实价格范围后的区间与实际桶宽，任意大的请求参数不会各占一格缓存
+        levels = _window_depth(depth, price_min, price_max)
+        if levels:
+            price_min, price_max = levels[0][0], levels[-1][0]
+            bucket_size = brick_histogram_bucket(price_min, price_max, bucket_size)
+        else:
+            price_min = price_max = None
+        key = (season_key, bucket_size, price_min, price_max) + version
+        with self._lock:
+            cached = self._views.get(key)
+        if cached is not None:
+            return cached
+        result = {
+            "histogram": build_brick_histogram(depth, bucket_size, price_min, price_max),
+            "depth": brick_depth_levels(depth, price_min, price_max),
+            "bucket": bucket_size,
+        }
+        with self._lock:
+            self._views[key] = result
+        return result
+
+
+BRICK_DEPTH_CACHE = BrickDepthCache()
 
 
 def record_trade(
@@ -9113,6 +10897,191 @@ def record_trade(
     )
     db.add(log)
 
+class BrickOrderBook:
+    """砖交易撮合簿：按赛季维护玩家卖单/收购委托的价格-时间优先有序索引。
+
+    簿里只存排序键，剩余数量以数据库为准：撮合时逐单 db.get 校验，发现失效的
+    条目顺手剔除。会话提交成功后才把挂单变动同步进簿（见 track_brick_order）。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.version = 0
+        self._loaded_version = -1
+        # 簿内容每次变化递增，供深度/直方图缓存判断失效
+        self.revision = 0
+        # season -> 升序 [(price, created_at, id)]
+        self._asks: Dict[str, List[Tuple[int, int, int]]] = {}
+        # season -> 升序 [(-target_price, created_at, id)]
+        self._bids: Dict[str, List[Tuple[int, int, int]]] = {}
+        # id -> (season, 排序键)
+        self._ask_index: Dict[int, Tuple[str, Tuple[int, int, int]]] = {}
+        self._bid_index: Dict[int, Tuple[str, Tuple[int, int, int]]] = {}
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self.version += 1
+
+    def _ensure_loaded(self) -> None:
+        if self._loaded_version == self.version:
+            return
+        target_version = self.version
+        with SessionLocal() as db:
+            asks = db.query(BrickSellOrder).filter(
+                BrickSellOrder.active == True,
+                BrickSellOrder.source == "player",
+                BrickSellOrder.remaining > 0,
+            ).all()
+            bids = db.query(BrickBuyOrder).filter(
+                BrickBuyOrder.active == True, BrickBuyOrder.remaining > 0
+            ).all()
+        with self._lock:
+            if self._loaded_version == self.version:
+                return
+            self._asks, self._bids, self._ask_index, self._bid_index = {}, {}, {}, {}
+            for order in asks:
+                self._put(self._asks, self._ask_index, order.id, _brick_season_key(order.season),
+                          (int(order.price), int(order.created_at or 0), int(order.id)))
+            for order in bids:
+                self._put(self._bids, self._bid_index, order.id, _brick_season_key(order.season),
+                          (-int(order.target_price), int(order.created_at or 0), int(order.id)))
+            self._loaded_version = target_version
+            self.revision += 1
+
+    @staticmethod
+    def _put(book, index, order_id: int, season: str, key: Tuple[int, int, int]) -> None:
+        BrickOrderBook._drop(book, index, order_id)
+        bisect.insort(book.setdefault(season, []), key)
+        index[order_id] = (season, key)
+
+    @staticmethod
+    def _drop(book, index, order_id: int) -> None:
+        hit = index.pop(order_id, None)
+        if not hit:
+            return
+        season, key = hit
+        side = book.get(season) or []
+        pos = bisect.bisect_left(side, key)
+        if pos < len(side) and side[pos] == key:
+            del side[pos]
+
+    def sync(self, order: Any) -> None:
+        """按挂单当前状态更新簿：仍可成交则插入/更新，否则剔除。"""
+        self._ensure_loaded()
+        order_id = int(order.id)
+        live = bool(order.active) and int(order.remaining or 0) > 0
+        season = _brick_season_key(order.season)
+        with self._lock:
+            self.revision += 1
+            if isinstance(order, BrickBuyOrder):
+                if live:
+                    key = (-int(order.target_price), int(order.created_at or 0), order_id)
+                    self._put(self._bids, self._bid_index, order_id, season, key)
+                else:
+                    self._drop(self._bids, self._bid_index, order_id)
+            elif live and (order.source or "player") == "player":
+                key = (int(order.price), int(order.created_at or 0), order_id)
+                self._put(self._asks, self._ask_index, order_id, season, key)
+            else:
+                self._drop(self._asks, self._ask_index, order_id)
+
+    def discard_ask(self, order_id: int) -> None:
+        with self._lock:
+            self.revision += 1
+            self._drop(self._asks, self._ask_index, order_id)
+
+    def discard_bid(self, order_id: int) -> None:
+        with self._lock:
+            self.revision += 1
+            self._drop(self._bids, self._bid_index, order_id)
+
+    def best_ask(self, season: str) -> Optional[int]:
+        self._ensure_loaded()
+        with self._lock:
+            side = self._asks.get(season)
+            return side[0][0] if side else None
+
+    def ask_ids(self, season: Optional[str], max_price: Optional[int] = None) -> List[int]:
+        """按价格-时间优先返回不高于 max_price 的卖单 id；season 为空时合并全部赛季。"""
+        self._ensure_loaded()
+        with self._lock:
+            sides = [self._asks.get(season, [])] if season else list(self._asks.values())
+            if max_price is not None:
+                bound = (int(max_price) + 1, -1, -1)
+                sides = [side[:bisect.bisect_left(side, bound)] for side in sides]
+            else:
+                sides = [list(side) for side in sides]
+        return [key[2] for key in heapq.merge(*sides)]
+
+    def bid_seasons(self) -> List[str]:
+        self._ensure_loaded()
+        with self._lock:
+            return [season for season, side in self._bids.items() if side]
+
+    def crossing_bids(self, season: str, price: int) -> List[int]:
+        """出价不低于 price 的收购委托 id，按出价高→低、时间先→后排列。"""
+        self._ensure_loaded()
+        with self._lock:
+            side = self._bids.get(season) or []
+            cut = bisect.bisect_left(side, (-int(price) + 1, -1, -1))
+            return [key[2] for key in side[:cut]]
+
+
+BRICK_BOOK = BrickOrderBook()
+
+
+def track_brick_order(db: Session, order: Any) -> None:
+    """登记本会话改动过的砖挂单，提交成功后同步进撮合簿，回滚则丢弃。"""
+    db.info.setdefault("brick_book_orders", []).append(order)
+
+
+@event.listens_for(SessionLocal, "after_commit")
+def _sync_brick_book_after_commit(session):
+    orders = session.info.pop("brick_book_orders", None)
+    for order in orders or []:
+        BRICK_BOOK.sync(order)
+    if orders:
+        changed = sorted({("bid" if isinstance(o, BrickBuyOrder) else "ask", int(o.id)) for o in orders})
+        CACHE_BUS.broadcast("brick_book", json.dumps(changed, separators=(",", ":")))
+    consumed = session.info.pop("official_brick_consumed", None)
+    if consumed and consumed["seasons"]:
+        OFFICIAL_LAYERS.consume(consumed["window"], consumed["seasons"])
+        CACHE_BUS.broadcast("official_layers", json.dumps(consumed, separators=(",", ":")))
+
+
+def _apply_remote_official_consumption(key: str) -> None:
+    consumed = json.loads(key)
+    OFFICIAL_LAYERS.consume(int(consumed["window"]), consumed["seasons"])
+
+
+def _apply_remote_brick_book(key: str) -> None:
+    """其他 worker 改动了哪些挂单：逐个读库后同步进本进程的簿；没有明细时整簿重载。"""
+    changed = json.loads(key) if key else None
+    if not changed:
+        BRICK_BOOK.invalidate()
+        return
+    with SessionLocal() as db:
+        for kind, order_id in changed:
+            order = db.get(BrickBuyOrder if kind == "bid" else BrickSellOrder, int(order_id))
+            if order is not None:
+                BRICK_BOOK.sync(order)
+            elif kind == "bid":
+                BRICK_BOOK.discard_bid(int(order_id))
+            else:
+                BRICK_BOOK.discard_ask(int(order_id))
+
+
+CACHE_BUS.subscribe("brick_book", _apply_remote_brick_book)
+CACHE_BUS.subscribe("official_layers", _apply_remote_official_consumption)
+OFFICIAL_LAYERS.prime()
+
+
+@event.listens_for(SessionLocal, "after_rollback")
+def _drop_brick_book_changes(session):
+    session.info.pop("brick_book_orders", None)
+    session.info.pop("official_brick_consumed", None)
+
+
 def brick_purchase_plan(
     db: Session,
     cfg: PoolConfig,
@@ -9120,45 +11089,40 @@ def brick_purchase_plan(
     max_price: Optional[int] = None,
     exclude_user_id: Optional[int] = None,
     season: Optional[str] = None,
+    layers: Optional[List[Dict[str, Any]]] = None,
 ) -> tuple[List[Dict[str, Any]], int]:
     remaining = int(count or 0)
     if remaining <= 0:
         return [], 0
     plan: List[Dict[str, Any]] = []
     season_key = _normalize_season(season)
-    player_orders = db.query(BrickSellOrder).filter(
-        BrickSellOrder.active == True,
-        BrickSellOrder.source == "player",
-        BrickSellOrder.remaining > 0,
-    ).order_by(BrickSellOrder.price.asc(), BrickSellOrder.created_at.asc(), BrickSellOrder.id.asc()).all()
-    for order in player_orders:
-        if exclude_user_id is not None and order.user_id == exclude_user_id:
+    book_season = _brick_season_key(season_key) if season_key else None
+    for order_id in BRICK_BOOK.ask_ids(book_season, max_price):
+        order = db.get(BrickSellOrder, order_id)
+        if not order or not order.active or int(order.remaining or 0) <= 0:
+            BRICK_BOOK.discard_ask(order_id)
             continue
-        order_season = _brick_season_key(order.season)
-        if season_key and _brick_season_key(season_key) != order_season:
+        if exclude_user_id is not None and order.user_id == exclude_user_id:
             continue
-        if max_price is not None and order.price > max_price:
-            break
         take = min(remaining, order.remaining)
-        if take <= 0:
-            continue
         plan.append({
             "type": "player",
             "order": order,
             "price": int(order.price),
             "quantity": take,
-            "season": order_season,
+            "season": _brick_season_key(order.season),
         })
         remaining -= take
         if remaining <= 0:
             break
     if remaining > 0:
-        state = ensure_brick_market_state(db, cfg)
-        layers = official_sell_layers(cfg, state)
+        if layers is None:
+            state = ensure_brick_market_state(db, cfg)
+            layers = official_sell_layers(cfg, state, db)
         for layer in layers:
             price = int(layer["price"])
             layer_season = _brick_season_key(layer.get("season"))
-            if season_key and _brick_season_key(season_key) != layer_season:
+            if book_season and book_season != layer_season:
                 continue
             if max_price is not None and price > max_price:
                 continue
@@ -9178,187 +11142,318 @@ def brick_purchase_plan(
                 break
     return plan, remaining
 
-def process_brick_buy_orders(db: Session, cfg: PoolConfig) -> List[Dict[str, Any]]:
-    events: List[Dict[str, Any]] = []
-    buy_orders = db.query(BrickBuyOrder).filter(BrickBuyOrder.active == True, BrickBuyOrder.remaining > 0)\
-        .order_by(BrickBuyOrder.target_price.desc(), BrickBuyOrder.created_at.asc(), BrickBuyOrder.id.asc()).all()
-    if not buy_orders:
-        return events
-    for order in buy_orders:
-        buyer = db.query(User).filter_by(id=order.user_id).first()
-        if not buyer:
-            order.active = False
+def _settle_brick_buy_order(db: Session, order: BrickBuyOrder, buyer: User, plan: List[Dict[str, Any]]) -> Dict[str, Any]:
+    total_qty = sum(item["quantity"] for item in plan)
+    total_cost = sum(item["price"] * item["quantity"] for item in plan)
+    gift_locked_before = int(order.gift_coin_locked or 0)
+    gift_coin_spent = min(gift_locked_before, total_cost)
+    gift_remaining = gift_coin_spent
+    season_stats: Dict[str, Dict[str, int]] = {}
+    for item in plan:
+        price = int(item["price"])
+        qty = int(item["quantity"])
+        if qty <= 0:
             continue
-        plan, leftover = brick_purchase_plan(
+        season_key = _brick_season_key(item.get("season"))
+        stats = season_stats.setdefault(season_key, {"qty": 0, "cost": 0, "gift": 0})
+        stats["qty"] += qty
+        stats["cost"] += price * qty
+        if price > 0 and gift_remaining > 0:
+            take = min(qty, gift_remaining // price)
+            if take > 0:
+                stats["gift"] += take
+                gift_remaining -= take * price
+    for item in plan:
+        if item["type"] == "player" and item.get("order"):
+            sell_order: BrickSellOrder = item["order"]
+            seller = db.query(User).filter_by(id=sell_order.user_id).first()
+            if seller and seller.id == buyer.id:
+                continue
+            if seller:
+                gross = item["price"] * item["quantity"]
+                net = (gross * 95) // 100
+                seller.coins += net
+                mark_cookie_delta_activity(db, seller.id)
+                record_trade(
+                    db,
+                    seller.id,
+                    "brick",
+                    "sell",
+                    "未开砖",
+                    item["quantity"],
+                    item["price"],
+                    gross,
+                    net,
+                    season=sell_order.season or "",
+                )
+            sell_order.remaining -= item["quantity"]
+            if sell_order.remaining <= 0:
+                sell_order.active = False
+            track_brick_order(db, sell_order)
+    for season_key, stats in season_stats.items():
+        qty = stats.get("qty", 0)
+        if qty <= 0:
+            continue
+        gift_take = stats.get("gift", 0)
+        season_param = None if season_key == BRICK_SEASON_FALLBACK else season_key
+        grant_user_bricks(
             db,
-            cfg,
-            order.remaining,
-            max_price=order.target_price,
-            exclude_user_id=order.user_id,
-            season=order.season,
+            buyer,
+            season_param,
+            qty,
+            gift_locked=gift_take,
+            lock_quota=gift_take > 0,
+        )
+    order.remaining = 0
+    order.active = False
+    locked_before = order.locked_coins
+    order.locked_coins = max(0, locked_before - total_cost)
+    order.gift_coin_locked = max(0, gift_locked_before - gift_coin_spent)
+    refund = order.locked_coins
+    gift_refund = min(refund, order.gift_coin_locked)
+    if refund > 0:
+        buyer.coins += refund
+    if gift_refund > 0:
+        buyer.gift_coin_balance += gift_refund
+    order.locked_coins = 0
+    order.gift_coin_locked = 0
+    for season_key, stats in season_stats.items():
+        qty = stats.get("qty", 0)
+        cost = stats.get("cost", 0)
+        if qty <= 0 or cost <= 0:
+            continue
+        avg_price = cost // qty if qty else cost
+        record_trade(
+            db,
+            buyer.id,
+            "brick",
+            "buy",
+            "未开砖",
+            qty,
+            avg_price,
+            cost,
+            0,
+            season="" if season_key == BRICK_SEASON_FALLBACK else season_key,
         )
-        total_qty = sum(item["quantity"] for item in plan)
-        if total_qty < order.remaining:
+    track_brick_order(db, order)
+    return {
+        "order_id": order.id,
+        "filled": total_qty,
+        "avg_price": round(total_cost / total_qty, 2) if total_qty else 0,
+        "refund": refund,
+    }
+
+
+def process_brick_buy_orders(db: Session, cfg: PoolConfig, seasons: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+    """撮合可能成交的收购委托。
+
+    每个赛季先取最低卖价（玩家卖单与官方层取小），只检查出价不低于它的委托；
+    价格没有交叉的赛季只需一次查表。委托仍需整单成交，凑不满的继续挂着。
+    """
+    events: List[Dict[str, Any]] = []
+    targets = seasons if seasons is not None else BRICK_BOOK.bid_seasons()
+    if not targets:
+        return events
+    state = ensure_brick_market_state(db, cfg)
+    layers = official_sell_layers(cfg, state, db)
+    official_floor: Dict[str, int] = {}
+    for layer in layers:
+        if int(layer.get("quantity", 0)) <= 0:
             continue
-        total_cost = sum(item["price"] * item["quantity"] for item in plan)
-        if total_cost > order.locked_coins:
+        key = _brick_season_key(layer.get("season"))
+        price = int(layer["price"])
+        official_floor[key] = min(price, official_floor.get(key, price))
+    for season in targets:
+        season_key = _brick_season_key(season)
+        floors = [p for p in (official_floor.get(season_key), BRICK_BOOK.best_ask(season_key)) if p is not None]
+        if not floors:
             continue
-        gift_locked_before = int(order.gift_coin_locked or 0)
-        gift_coin_spent = min(gift_locked_before, total_cost)
-        gift_remaining = gift_coin_spent
-        season_stats: Dict[str, Dict[str, int]] = {}
-        for item in plan:
-            price = int(item["price"])
-            qty = int(item["quantity"])
-            if qty <= 0:
+        for order_id in BRICK_BOOK.crossing_bids(season_key, min(floors)):
+            order = db.get(BrickBuyOrder, order_id)
+            if not order or not order.active or int(order.remaining or 0) <= 0:
+                BRICK_BOOK.discard_bid(order_id)
                 continue
-            season_key = _brick_season_key(item.get("season"))
-            stats = season_stats.setdefault(season_key, {"qty": 0, "cost": 0, "gift": 0})
-            stats["qty"] += qty
-            stats["cost"] += price * qty
-            if price > 0 and gift_remaining > 0:
-                take = min(qty, gift_remaining // price)
-                if take > 0:
-                    stats["gift"] += take
-                    gift_remaining -= take * price
-        for item in plan:
-            if item["type"] == "player" and item.get("order"):
-                sell_order: BrickSellOrder = item["order"]
-                seller = db.query(User).filter_by(id=sell_order.user_id).first()
-                if seller and seller.id == buyer.id:
-                    continue
-                if seller:
-                    gross = item["price"] * item["quantity"]
-                    net = (gross * 95) // 100
-                    seller.coins += net
-                    mark_cookie_delta_activity(db, seller.id)
-                    record_trade(
-                        db,
-                        seller.id,
-                        "brick",
-                        "sell",
-                        "未开砖",
-                        item["quantity"],
-                        item["price"],
-                        gross,
-                        net,
-                        season=sell_order.season or "",
-                    )
-                sell_order.remaining -= item["quantity"]
-                if sell_order.remaining <= 0:
-                    sell_order.active = False
-        for season_key, stats in season_stats.items():
-            qty = stats.get("qty", 0)
-            if qty <= 0:
+            buyer = db.get(User, order.user_id)
+            if not buyer:
+                order.active = False
+                track_brick_order(db, order)
                 continue
-            gift_take = stats.get("gift", 0)
-            season_param = None if season_key == BRICK_SEASON_FALLBACK else season_key
-            grant_user_bricks(
+            plan, leftover = brick_purchase_plan(
                 db,
-                buyer,
-                season_param,
-                qty,
-                gift_locked=gift_take,
-                lock_quota=gift_take > 0,
+                cfg,
+                order.remaining,
+                max_price=order.target_price,
+                exclude_user_id=order.user_id,
+                season=order.season,
+                layers=layers,
             )
-        order.remaining = 0
-        order.active = False
-        locked_before = order.locked_coins
-        order.locked_coins = max(0, locked_before - total_cost)
-        order.gift_coin_locked = max(0, gift_locked_before - gift_coin_spent)
-        refund = order.locked_coins
-        gift_refund = min(refund, order.gift_coin_locked)
-        if refund > 0:
-            buyer.coins += refund
-        if gift_refund > 0:
-            buyer.gift_coin_balance += gift_refund
-        order.locked_coins = 0
-        order.gift_coin_locked = 0
-        for season_key, stats in season_stats.items():
-            qty = stats.get("qty", 0)
-            cost = stats.get("cost", 0)
-            if qty <= 0 or cost <= 0:
+            total_qty = sum(item["quantity"] for item in plan)
+            if total_qty < order.remaining:
                 continue
-            avg_price = cost // qty if qty else cost
-            record_trade(
-                db,
-                buyer.id,
-                "brick",
-                "buy",
-                "未开砖",
-                qty,
-                avg_price,
-                cost,
-                0,
-                season="" if season_key == BRICK_SEASON_FALLBACK else season_key,
-            )
-        events.append({
-            "order_id": order.id,
-            "filled": total_qty,
-            "avg_price": round(total_cost / total_qty, 2) if total_qty else 0,
-            "refund": refund,
-        })
+            total_cost = sum(item["price"] * item["quantity"] for item in plan)
+            if total_cost > order.locked_coins:
+                continue
+            events.append(_settle_brick_buy_order(db, order, buyer, plan))
+            consume_official_bricks(db, state, plan)
+            layers = official_sell_layers(cfg, state, db)
     db.flush()
     return events
 
-from pydantic import BaseModel as _BM
-class OddsOut(_BM):
-    brick: float; purple: float; blue: float; green: float
-    force_brick_next: bool; force_purple_next: bool
-    pity_brick: int; pity_purple: int
+BRICK_PRICE_TICK_SEC = 15
+SHOP_PRICES_MAX_AGE = 5
 
 
-def pick_skin(db: Session, rarity: str, season: Optional[str] = None, preferred_skin_id: Optional[str] = None) -> Skin:
-    q = db.query(Skin).filter_by(rarity=rarity, active=True)
-    season_key = _normalize_season(season)
-    if season_key:
-        q = q.filter(func.upper(Skin.season) == season_key)
-    rows = q.all()
-    if preferred_skin_id:
-        for row in rows:
-            if str(row.skin_id) == str(preferred_skin_id):
-                return row
-        pref = db.query(Skin).filter_by(skin_id=preferred_skin_id, active=True).first()
-        if pref and pref.rarity == rarity:
-            pref_season = _normalize_season(pref.season)
-            if not season_key or pref_season == season_key:
-                return pref
+class BrickPriceTicker:
+    """后台定时推进砖价（情绪衰减 + 漂移）并撮合委托，发布不可变的价格快照。
+
+    /shop/prices 只读快照，不再逐次写库；开砖等改价操作提交后调用 publish 刷新。
+    """
+
+    def __init__(self, interval: int = BRICK_PRICE_TICK_SEC):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._snapshot: Optional[Dict[str, Any]] = None
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="brick-price-ticker", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                # 多 worker 时只有租约持有者推进价格，其余进程靠 brick_price 事件刷新快照
+                if acquire_worker_lease("brick_price_ticker", self.interval * 3):
+                    self.tick()
+            except Exception as exc:
+                print(f"[brick-price-ticker] 价格推进失败：{exc}")
+
+    def tick(self) -> List[Dict[str, Any]]:
+        with SessionLocal() as db:
+            cfg = db.query(PoolConfig).first()
+            brick_price_snapshot(db, cfg)
+            fills = process_brick_buy_orders(db, cfg)
+            db.commit()
+            self.publish(cfg, ensure_brick_market_state(db, cfg))
+        return fills
+
+    def invalidate(self) -> None:
+        self._snapshot = None
+
+    def publish(self, cfg: PoolConfig, state: BrickMarketState) -> Dict[str, Any]:
+        """刷新本进程快照并通知其他 worker 重新读取。"""
+        snapshot = self._build(cfg, state)
+        CACHE_BUS.broadcast("brick_price")
+        return snapshot
+
+    def _build(self, cfg: PoolConfig, state: BrickMarketState) -> Dict[str, Any]:
+        unit = int(cfg.brick_price)
+        payload: Dict[str, Any] = {
+            "brick_price": unit,
+            "brick_price_raw": round(float(state.price), 2),
+            "key_price": cfg.key_price,
+        }
+        season_prices = [
+            {
+                "season": sid,
+                "name": _season_display_name(sid),
+                "price": _season_brick_price(unit, sid),
+            }
+            for sid in SEASON_IDS
+        ]
+        if season_prices:
+            payload["season_prices"] = season_prices
+        body = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        snapshot = {
+            "payload": payload,
+            "body": body,
+            "etag": '"' + hashlib.sha1(body).hexdigest()[:20] + '"',
+            "generated_at": int(time.time()),
+        }
+        self._snapshot = snapshot
+        return snapshot
+
+    def snapshot(self) -> Dict[str, Any]:
+        self.start()
+        snapshot = self._snapshot
+        if snapshot is None:
+            with SessionLocal() as db:
+                cfg = db.query(PoolConfig).first()
+                state = db.query(BrickMarketState).first()
+                if state is None:
+                    state = ensure_brick_market_state(db, cfg)
+                    db.commit()
+                snapshot = self._build(cfg, state)
+        return snapshot
+
+
+PRICE_TICKER = BrickPriceTicker()
+CACHE_BUS.subscribe("brick_price", lambda _key: PRICE_TICKER.invalidate())
+
+
+@app.on_event("startup")
+def _start_price_ticker():
+    PRICE_TICKER.start()
+
+
+def pick_skin(rarity: str, season: Optional[str] = None, preferred_skin_id: Optional[str] = None) -> Skin:
+    return SKIN_CATALOG.pool().draw(rarity, season=season, preferred_skin_id=preferred_skin_id)
+
+
+_ODDS_TABLE: Optional[OddsTable] = None
+
+
+def odds_table(cfg: PoolConfig, rebuild: bool = False) -> OddsTable:
+    global _ODDS_TABLE
+    table = _ODDS_TABLE
+    if rebuild or table is None or table.key != odds_config_key(cfg):
+        table = OddsTable(cfg)
+        _ODDS_TABLE = table
+    return table
+
+
+def roll_rarity(pity_brick: int, pity_purple: int, cfg: PoolConfig) -> str:
+    return odds_table(cfg).roll(pity_brick, pity_purple)
+
+
+def resolve_pull_rarities(cfg: PoolConfig, pity_brick: int, pity_purple: int, count: int) -> Tuple[List[str], int, int]:
+    """整批预先决定稀有度，返回 (稀有度列表, 批次结束后的砖保底, 紫保底)。"""
+    rarities: List[str] = []
+    for _ in range(max(0, int(count or 0))):
+        rarity = roll_rarity(pity_brick, pity_purple, cfg)
+        pity_brick, pity_purple = advance_pity(rarity, pity_brick, pity_purple)
+        rarities.append(rarity)
+    return rarities, pity_brick, pity_purple
+
+
+def mint_inventory_batch(db: Session, rows: List[Dict[str, Any]]) -> List[int]:
+    """一条 INSERT 写入整批背包物品，再用一条 UPDATE 按 id 回填 8 位编号。"""
     if not rows:
-        rows = db.query(Skin).filter_by(rarity=rarity, active=True).all()
-    if not rows: raise HTTPException(500, f"当前没有可用的 {rarity} 皮肤")
-    return secrets.choice(rows)
-
-
-def compute_odds(pity_brick: int, pity_purple: int, cfg: PoolConfig) -> OddsOut:
-    n = max(0, int(pity_brick or 0))
-    m = max(0, int(pity_purple or 0))
-    p_brick = cfg.p_brick_base; p_purple = cfg.p_purple_base
-    p_blue = cfg.p_blue_base;   p_green = cfg.p_green_base
-    # 65~75 抽动态提升砖皮 & 压缩其他
-    if n >= cfg.brick_ramp_start and n < cfg.brick_pity_max:
-        p_brick = p_brick + (100.0 - p_brick) * ((n - cfg.brick_ramp_start + 1) / (cfg.brick_pity_max - cfg.brick_ramp_start))
-        step = min(cfg.brick_pity_max - 1, n) - cfg.brick_ramp_start
-        if step > 0:
-            frac = max(0.0, min(1.0, step / (cfg.brick_pity_max - cfg.brick_ramp_start)))
-            c = 1.0 - cfg.compression_alpha * frac
-            p_purple_c = p_purple * c; p_blue_c = p_blue * c; p_green_c = p_green * c
-            delta = (p_purple + p_blue + p_green) - (p_purple_c + p_blue_c + p_green_c)
-            p_brick = min(100.0, p_brick + delta)
-            p_purple, p_blue, p_green = p_purple_c, p_blue_c, p_green_c
-    total = p_brick + p_purple + p_blue + p_green
-    if abs(total - 100.0) > 1e-9:
-        scale = 100.0 / total
-        p_brick *= scale; p_purple *= scale; p_blue *= scale; p_green *= scale
-    force_brick = (n + 1) >= cfg.brick_pity_max
-    force_purple = (m + 1) >= cfg.purple_pity_max
-    return OddsOut(brick=round(p_brick,6), purple=round(p_purple,6),
-                   blue=round(p_blue,6), green=round(p_green,6),
-                   force_brick_next=force_brick, force_purple_next=force_purple,
-                   pity_brick=n, pity_purple=m)
+        return []
+    inserted = db.execute(
+        insert(Inventory).returning(Inventory.id, sort_by_parameter_order=True),
+        rows,
+    )
+    inv_ids = [int(inv_id) for inv_id in inserted.scalars().all()]
+    db.execute(
+        update(Inventory)
+        .where(Inventory.id.in_(inv_ids))
+        .values(serial=func.printf("%08d", Inventory.id))
+        .execution_options(synchronize_session=False)
+    )
+    return inv_ids
 
 # ------------------ Auth ------------------
 @app.post("/auth/register")
-def register(data: RegisterIn, db: Session = Depends(get_db)):
+def register(data: RegisterIn, request: Request, db: Session = Depends(get_db)):
     username = (data.username or "").strip()
     if not username:
         raise HTTPException(400, "用户名不能为空")
@@ -9410,7 +11505,7 @@ def register(data: RegisterIn, db: Session = Depends(get_db)):
     # 若申请管理员：下发管理员验证码（写入 admin_pending）
     try:
         if data.want_admin:
-            put_admin_pending(username)
+            put_admin_pending(username, client_ip(request))
             return {"ok": True, "admin_verify_required": True, "msg": "已申请管理员，请查看 sms_codes.txt 并在登录页验证"}
     except NameError:
         pass
@@ -9421,24 +11516,55 @@ def register(data: RegisterIn, db: Session = Depends(get_db)):
 
 
 @app.post("/auth/login/start")
-def login_start(data: LoginStartIn, db: Session = Depends(get_db)):
+async def login_start(data: LoginStartIn, request: Request):
+    # 查库与收尾写库走数据库线程池，bcrypt 在进程池里算，等待期间不占请求线程
+    ip = client_ip(request)
+    fail_checks = _login_fail_checks(data.username, ip)
+    wait = RATE_LIMITER.hit(fail_checks, consume=False)
+    if wait > 0:
+        raise HTTPException(429, f"密码错误次数过多，请 {max(int(math.ceil(wait)), 1)} 秒后再试")
+    stored_hash = await run_db(_login_password_hash, username=data.username)
+    if stored_hash is None:
+        RATE_LIMITER.hit(fail_checks)
+        raise HTTPException(401, "用户不存在")
+    if not await verify_pw_async(data.password, stored_hash):
+        RATE_LIMITER.hit(fail_checks)
+        raise HTTPException(401, "密码错误")
+    # 只清账号维度；IP 维度不清，免得持有一个账号就能反复重置整段 IP 的失败计数
+    RATE_LIMITER.reset("login-fail", data.username)
+    new_hash = None
+    if password_needs_rehash(stored_hash):
+        # 调整 DELTA_BCRYPT_ROUNDS 后，老哈希在下次登录时按新 cost 重算
+        new_hash = await hash_pw_async(data.password)
+    return await run_db(login_start_view, data=data, ip=ip, new_hash=new_hash)
+
+
+def _login_password_hash(db: Session, username: str) -> Optional[str]:
+    row = db.query(User.password_hash).filter_by(username=username).first()
+    return row[0] if row else None
+
+
+def login_start_view(db: Session, data: LoginStartIn, ip: Optional[str], new_hash: Optional[str]):
     u = db.query(User).filter_by(username=data.username).first()
     if not u:
         raise HTTPException(401, "用户不存在")
-    if not verify_pw(data.password, u.password_hash):
-        raise HTTPException(401, "密码错误")
     # 记录最新的明文密码，便于管理员在验证后查看。
     new_plain = str(data.password or "")
     plain_changed = False
     if str(u.password_plain or "") != new_plain:
         u.password_plain = new_plain
         plain_changed = True
+    if new_hash is not None:
+        u.password_hash = new_hash
+        plain_changed = True
     free_mode = get_auth_free_mode(db)
     if free_mode:
         u.last_login_ts = int(time.time())
         u.session_ver = int(u.session_ver or 0) + 1
         db.commit()
-        token = mk_jwt(u.username, u.session_ver)
+        SESSION_CACHE.remember(u.id, u.username, u.session_ver, u.is_admin)
+        CACHE_BUS.broadcast("sessions", u.username)
+        token = mk_jwt(u.username, u.session_ver, user_id=u.id)
         return {"ok": True, "token": token, "msg": "登录成功"}
 
     if plain_changed:
@@ -9447,7 +11573,7 @@ def login_start(data: LoginStartIn, db: Session = Depends(get_db)):
     phone = u.phone or ""
     if not PHONE_RE.fullmatch(phone):
         raise HTTPException(400, "账号未绑定有效手机号，请联系管理员")
-    _sms_rate_guard("login2", phone)
+    _sms_rate_guard("login2", phone, ip)
     code = f"{secrets.randbelow(1_000_000):06d}"
     write_sms_line(phone, code, "login2")
     save_otp(db, phone, "login2", code)
@@ -9468,7 +11594,9 @@ def login_verify(data: LoginVerifyIn, db: Session = Depends(get_db)):
     u.last_login_ts = int(time.time())
     u.session_ver = int(u.session_ver or 0) + 1
     db.commit()
-    token = mk_jwt(u.username, u.session_ver)
+    SESSION_CACHE.remember(u.id, u.username, u.session_ver, u.is_admin)
+    CACHE_BUS.broadcast("sessions", u.username)
+    token = mk_jwt(u.username, u.session_ver, user_id=u.id)
     return {"ok": True, "token": token, "msg": "登录成功"}
 
 @app.post("/auth/login/verify")
@@ -9511,7 +11639,7 @@ def auth_mode(db: Session = Depends(get_db)):
 
 
 @app.post("/auth/send-code")
-def send_code(inp: SendCodeIn, db: Session = Depends(get_db)):
+def send_code(inp: SendCodeIn, request: Request, db: Session = Depends(get_db)):
     phone = inp.phone
     purpose = inp.purpose  # "login" | "reset" | "register"
 
@@ -9536,8 +11664,8 @@ def send_code(inp: SendCodeIn, db: Session = Depends(get_db)):
         raise HTTPException(400, "不支持的验证码用途")
     else:
         raise HTTPException(400, "当前模式无需该验证码")
-    # 60s 限流：同一手机号+用途
-    _sms_rate_guard(purpose, phone)
+    # 限流：同一手机号+用途 60s 一次，另有每小时/每 IP 上限
+    _sms_rate_guard(purpose, phone, client_ip(request))
 
 
     # 生成并写入
@@ -9560,7 +11688,12 @@ def reset_password(inp: ResetPwdIn, db: Session = Depends(get_db)):
     return {"ok": True, "msg": "密码已重置，请使用新密码登录"}
 
 @app.get("/me")
-def me(user: User = Depends(user_from_token), db: Session = Depends(get_db)):
+async def me(auth: AuthSession = Depends(auth_session_async)):
+    return await run_db(me_view, auth=auth)
+
+
+def me_view(db: Session, auth: AuthSession):
+    user = load_session_user(db, auth)
     phone = user.phone or ""
     if phone.startswith(VIRTUAL_PHONE_PREFIX):
         phone = ""
@@ -9598,7 +11731,7 @@ def me(user: User = Depends(user_from_token), db: Session = Depends(get_db)):
 @app.get("/me/mailbox")
 def me_mailbox(
     limit: int = Query(20, ge=1, le=100),
-    user: User = Depends(user_from_token),
+    user: AuthSession = Depends(auth_session),
     db: Session = Depends(get_db),
 ):
     logs = (
@@ -9632,7 +11765,11 @@ def me_mailbox(
 
 
 @app.get("/friends")
-def friends_list(user: User = Depends(user_from_token), db: Session = Depends(get_db)):
+async def friends_list(user: AuthSession = Depends(auth_session_async)):
+    return await run_db(friends_list_view, user=user)
+
+
+def friends_list_view(db: Session, user: AuthSession):
     relations = (
         db.query(Friendship)
         .filter_by(user_id=user.id)
@@ -9760,7 +11897,7 @@ def friends_list(user: User = Depends(user_from_token), db: Session = Depends(ge
 def friends_search(
     q: str = Query(..., min_length=1, max_length=50),
     limit: int = Query(10, ge=1, le=50),
-    user: User = Depends(user_from_token),
+    user: AuthSession = Depends(auth_session),
     db: Session = Depends(get_db),
 ):
     keyword = (q or "").strip()
@@ -10021,7 +12158,7 @@ def friends_unblock(
 def friends_conversation(
     friend_id: int = Path(..., ge=1),
     limit: int = Query(50, ge=1, le=200),
-    user: User = Depends(user_from_token),
+    user: AuthSession = Depends(auth_session),
     db: Session = Depends(get_db),
 ):
     relation = db.query(Friendship).filter_by(user_id=user.id, friend_id=friend_id).first()
@@ -10100,7 +12237,13 @@ def friends_send_message(
 
 
 @app.get("/cookie-factory/status")
-def cookie_factory_status(user: User = Depends(user_from_token), db: Session = Depends(get_db)):
+async def cookie_factory_status(auth: AuthSession = Depends(auth_session_async)):
+    # 状态接口会结算并推进饼干进度（有写入），同样交给数据库线程池
+    return await run_db(cookie_factory_status_view, auth=auth)
+
+
+def cookie_factory_status_view(db: Session, auth: AuthSession):
+    user = load_session_user(db, auth)
     now = int(time.time())
     enabled = cookie_factory_enabled(db)
     cultivation_enabled = cookie_cultivation_enabled(db)
@@ -10152,32 +12295,54 @@ def cookie_factory_login(user: User = Depends(user_from_token), db: Session = De
     return payload
 
 
-@app.post("/cookie-factory/act")
-def cookie_factory_act(inp: CookieActIn, user: User = Depends(user_from_token), db: Session = Depends(get_db)):
-    now = int(time.time())
-    enabled = cookie_factory_enabled(db)
-    cultivation_enabled = cookie_cultivation_enabled(db)
-    if not enabled and not getattr(user, "is_admin", False):
-        raise HTTPException(404, "小游戏未开启")
-    profile = ensure_cookie_profile(db, user, now)
-    settlement = cookie_maybe_settle(db, profile, user, now)
-    cookie_tick(profile, now)
+COOKIE_CLICK_CAP = 200  # 单个点击操作最多计入的点击数
+COOKIE_BATCH_CLICK_CAP = COOKIE_CLICK_CAP  # 一批操作合计最多计入的点击数，与单次 /act 的上限相同
+COOKIE_BATCH_MAX_ACTIONS = 50
+COOKIE_BATCH_MAX_AGE = 120  # 批量操作的客户端时间最多可回溯的秒数
+
+
+def cookie_apply_clicks(
+    profile: CookieFactoryProfile,
+    amounts: List[int],
+    at: int,
+    counts: Optional[Dict[str, int]] = None,
+) -> Dict[str, Any]:
+    """结算一串连续的点击操作：每个操作各自按 COOKIE_CLICK_CAP 截断、各自折算活跃度，产量合并一次计算。"""
+    amounts = [max(1, min(int(a or 1), COOKIE_CLICK_CAP)) for a in amounts]
+    total = sum(amounts)
+    gained = cookie_click_gain(profile, total, counts)
+    cookie_add(profile, gained)
+    profile.manual_clicks = int(profile.manual_clicks or 0) + total
+    cookie_add_active_points(profile, at, sum(max(1, a // 5) for a in amounts))
+    today_clicks = cookie_challenge_increment(profile, at, total)
+    return {
+        "gained": round(gained, 2),
+        "clicks": total,
+        "challenge_today": today_clicks,
+        "challenge_completed": today_clicks >= COOKIE_DAILY_CHALLENGE_TARGET,
+    }
+
+
+def cookie_apply_action(
+    db: Session,
+    user: User,
+    profile: CookieFactoryProfile,
+    inp: CookieActIn,
+    now: int,
+    cultivation_enabled: bool,
+    at: Optional[int] = None,
+) -> Dict[str, Any]:
+    """执行一个工坊操作并返回 action_result。校验不通过时抛 HTTPException，此前不会改动任何状态。
+
+    at 是操作实际发生的时间（批量提交时取钳制后的客户端时间），只决定活跃度/挑战记到哪一天；冷却一律按 now 判断。
+    """
+    if at is None:
+        at = now
     counts = cookie_building_counts(profile)
     result: Dict[str, Any] = {}
     action = inp.type
     if action == "click":
-        amount = max(1, min(int(inp.amount or 1), 200))
-        gained = cookie_click_gain(profile, amount, counts)
-        cookie_add(profile, gained)
-        profile.manual_clicks = int(profile.manual_clicks or 0) + amount
-        cookie_add_active_points(profile, now, max(1, amount // 5))
-        today_clicks = cookie_challenge_increment(profile, now, amount)
-        result = {
-            "gained": round(gained, 2),
-            "clicks": amount,
-            "challenge_today": today_clicks,
-            "challenge_completed": today_clicks >= COOKIE_DAILY_CHALLENGE_TARGET,
-        }
+        result = cookie_apply_clicks(profile, [inp.amount], at, counts)
     elif action == "buy_building":
         key = (inp.building or "").strip()
         if not key or key not in {cfg["key"] for cfg in COOKIE_BUILDINGS}:
@@ -10186,25 +12351,23 @@ def cookie_factory_act(inp: CookieActIn, user: User = Depends(user_from_token),
         cookie_spend(profile, cost)
         counts[key] = counts.get(key, 0) + 1
         cookie_store_buildings(profile, counts)
-        cookie_add_active_points(profile, now, 8)
+        cookie_add_active_points(profile, at, 8)
         result = {"building": key, "cost": cost, "count": counts[key]}
     elif action == "golden":
         if int(profile.golden_ready_ts or 0) > now:
             raise HTTPException(400, "黄金饼干尚未出现")
-        cps, effective_cps = cookie_cps(profile, counts)
+        cps, effective_cps = cookie_cps(profile)
         burst = effective_cps * 60 + cookie_click_gain(profile, 40, counts)
         cookie_add(profile, burst)
         profile.golden_cookies = int(profile.golden_cookies or 0) + 1
         profile.golden_cooldown = 300
         profile.golden_ready_ts = now + profile.golden_cooldown
-        cookie_add_active_points(profile, now, 12)
+        cookie_add_active_points(profile, at, 12)
         result = {"bonus": round(burst, 2)}
     elif action == "mini":
         mini_key = (inp.mini or "").strip()
         if not mini_key or mini_key not in COOKIE_MINI_GAMES:
             raise HTTPException(400, "未知小游戏")
-        state = cookie_mini_games_state(profile)
-        node = state.get(mini_key, {"level": 0, "progress": 0})
         if mini_key == COOKIE_CULTIVATION_KEY:
             if not cultivation_enabled and not getattr(user, "is_admin", False):
                 raise HTTPException(404, "小游戏未开启")
@@ -10215,22 +12378,22 @@ def cookie_factory_act(inp: CookieActIn, user: User = Depends(user_from_token),
                 if int(profile.sugar_lumps or 0) < sugar_cost:
                     raise HTTPException(400, f"糖块不足，需要 {sugar_cost} 颗糖块才能开展 {COOKIE_MINI_GAMES[mini_key]['name']}")
                 profile.sugar_lumps = int(profile.sugar_lumps or 0) - sugar_cost
-            node["progress"] = int(node.get("progress", 0)) + 1
+            node = cookie_state(profile).mini(mini_key)
+            node.progress = int(node.progress or 0) + 1
             threshold = int(COOKIE_MINI_GAMES[mini_key].get("threshold", 1))
             leveled = False
-            if node["progress"] >= threshold:
-                node["progress"] = 0
-                node["level"] = int(node.get("level", 0)) + 1
+            if node.progress >= threshold:
+                node.progress = 0
+                node.level = int(node.level or 0) + 1
                 leveled = True
-            state[mini_key] = node
-            profile.mini_games = _json_dump(state)
-            cookie_add_active_points(profile, now, int(COOKIE_MINI_GAMES[mini_key].get("points", 3)))
+                cookie_invalidate_production(profile)
+            cookie_add_active_points(profile, at, int(COOKIE_MINI_GAMES[mini_key].get("points", 3)))
             if leveled:
                 current = float(profile.pending_bonus_multiplier or 1.0)
                 profile.pending_bonus_multiplier = min(COOKIE_DELTA_BONUS_CAP, current + 0.01)
             result = {
                 "mini": mini_key,
-                "level": int(node.get("level", 0)),
+                "level": int(node.level or 0),
                 "leveled": leveled,
                 "sugar_lumps": int(profile.sugar_lumps or 0),
             }
@@ -10284,17 +12447,17 @@ def cookie_factory_act(inp: CookieActIn, user: User = Depends(user_from_token),
         profile.golden_cooldown = 180
         counts = {cfg["key"]: 0 for cfg in COOKIE_BUILDINGS}
         cookie_store_buildings(profile, counts)
-        reset_state = {
-            k: {"level": 0, "progress": 0, "last_action": now}
-            for k in COOKIE_MINI_GAMES
-            if k != COOKIE_CULTIVATION_KEY
-        }
-        _, cultivation_node = _cultivation_node(profile)
-        reset_state[COOKIE_CULTIVATION_KEY] = cultivation_node
-        profile.mini_games = _json_dump(reset_state)
+        for key in COOKIE_MINI_GAMES:
+            if key == COOKIE_CULTIVATION_KEY:
+                continue
+            node = cookie_state(profile).mini(key)
+            node.level = 0
+            node.progress = 0
+            node.last_action = now
+        cookie_invalidate_production(profile)
         profile.last_active_ts = now
         profile.pending_bonus_multiplier = min(COOKIE_DELTA_BONUS_CAP, float(profile.pending_bonus_multiplier or 1.0) + 0.02)
-        cookie_add_active_points(profile, now, 20)
+        cookie_add_active_points(profile, at, 20)
         result = {"prestige": int(profile.prestige or 0), "points_gained": points}
     elif action == "sugar":
         ready_at = int(profile.last_sugar_ts or 0) + COOKIE_SUGAR_COOLDOWN
@@ -10302,10 +12465,24 @@ def cookie_factory_act(inp: CookieActIn, user: User = Depends(user_from_token),
             raise HTTPException(400, "糖块尚未成熟")
         profile.last_sugar_ts = now
         profile.sugar_lumps = int(profile.sugar_lumps or 0) + 1
-        cookie_add_active_points(profile, now, 5)
+        cookie_add_active_points(profile, at, 5)
         result = {"sugar_lumps": int(profile.sugar_lumps or 0)}
     else:
         raise HTTPException(400, "不支持的操作")
+    return result
+
+
+@app.post("/cookie-factory/act")
+def cookie_factory_act(inp: CookieActIn, user: User = Depends(user_from_token), db: Session = Depends(get_db)):
+    now = int(time.time())
+    enabled = cookie_factory_enabled(db)
+    cultivation_enabled = cookie_cultivation_enabled(db)
+    if not enabled and not getattr(user, "is_admin", False):
+        raise HTTPException(404, "小游戏未开启")
+    profile = ensure_cookie_profile(db, user, now)
+    settlement = cookie_maybe_settle(db, profile, user, now)
+    cookie_tick(profile, now)
+    result = cookie_apply_action(db, user, profile, inp, now, cultivation_enabled)
 
     db.flush()
     payload = cookie_status_payload(
@@ -10321,6 +12498,87 @@ def cookie_factory_act(inp: CookieActIn, user: User = Depends(user_from_token),
     return payload
 
 
+@app.post("/cookie-factory/act/batch")
+def cookie_factory_act_batch(inp: CookieBatchIn, user: User = Depends(user_from_token), db: Session = Depends(get_db)):
+    """按顺序执行一批操作：一次周结算检查、一次产量推进、一次提交，返回精简的增量状态。
+
+    相邻的点击操作（同一天内）合并结算，整批点击合计不超过 COOKIE_BATCH_CLICK_CAP，超出部分截断并记入 errors；
+    未知操作类型或单个操作校验失败也只记入 errors，不影响其余操作（字段类型错误仍整批 422）。
+    """
+    now = int(time.time())
+    enabled = cookie_factory_enabled(db)
+    cultivation_enabled = cookie_cultivation_enabled(db)
+    if not enabled and not getattr(user, "is_admin", False):
+        raise HTTPException(404, "小游戏未开启")
+    actions = inp.actions
+    if not actions:
+        raise HTTPException(400, "没有待提交的操作")
+    if len(actions) > COOKIE_BATCH_MAX_ACTIONS:
+        raise HTTPException(400, f"单次最多提交 {COOKIE_BATCH_MAX_ACTIONS} 个操作")
+    profile = ensure_cookie_profile(db, user, now)
+    settlement = cookie_maybe_settle(db, profile, user, now)
+    cookie_tick(profile, now)
+
+    def clamp(ts: Optional[int], floor: int) -> int:
+        # 客户端时间只能单调不减，且落在 [now - COOKIE_BATCH_MAX_AGE, now] 内
+        return min(now, max(floor, int(ts or now)))
+
+    results: List[Dict[str, Any]] = []
+    errors: List[Dict[str, Any]] = []
+    touched: Set[str] = set()
+    click_budget = COOKIE_BATCH_CLICK_CAP
+    at = now - COOKIE_BATCH_MAX_AGE
+    idx = 0
+    while idx < len(actions):
+        action = actions[idx]
+        at = clamp(action.ts, at)
+        if action.type not in COOKIE_ACTION_TYPES:
+            errors.append({"index": idx, "type": action.type, "detail": "未知操作"})
+            idx += 1
+            continue
+        if action.type == "click":
+            day = cookie_day_key(at)
+            run = [idx]
+            end = idx + 1
+            while end < len(actions) and actions[end].type == "click":
+                nxt = clamp(actions[end].ts, at)
+                if cookie_day_key(nxt) != day:
+                    break
+                at = nxt
+                run.append(end)
+                end += 1
+            amounts = []
+            for pos in run:
+                take = min(max(1, min(int(actions[pos].amount or 1), COOKIE_CLICK_CAP)), click_budget)
+                if take < int(actions[pos].amount or 1):
+                    errors.append({"index": pos, "type": "click", "detail": f"本批点击已达上限 {COOKIE_BATCH_CLICK_CAP} 次"})
+                if take > 0:
+                    amounts.append(take)
+                    click_budget -= take
+            if amounts:
+                result = cookie_apply_clicks(profile, amounts, at)
+                result["actions"] = len(amounts)
+                results.append({"index": idx, "type": "click", "result": result})
+                touched.add("click")
+            idx = end
+            continue
+        try:
+            result = cookie_apply_action(db, user, profile, action, now, cultivation_enabled, at)
+        except HTTPException as exc:
+            errors.append({"index": idx, "type": action.type, "detail": exc.detail})
+        else:
+            results.append({"index": idx, "type": action.type, "result": result})
+            touched.add(action.type)
+        idx += 1
+
+    db.flush()
+    payload = cookie_delta_payload(profile, now, touched, settlement)
+    payload["results"] = results
+    payload["errors"] = errors
+    db.commit()
+    return payload
+
+
 @app.get("/cultivation/status")
 def cultivation_status(user: User = Depends(user_from_token), db: Session = Depends(get_db)):
     now = int(time.time())
@@ -10329,7 +12587,7 @@ def cultivation_status(user: User = Depends(user_from_token), db: Session = Depe
     if not enabled and not is_admin:
         return {"enabled": False, "now": now}
     profile = ensure_cookie_profile(db, user, now)
-    state, node = _cultivation_node(profile)
+    node = _cultivation_node(profile)
     run = node.get("active_run") if isinstance(node.get("active_run"), dict) else None
     if run and run.get("finished"):
         node.pop("active_run", None)
@@ -10354,8 +12612,7 @@ def cultivation_status(user: User = Depends(user_from_token), db: Session = Depe
     }
     if not enabled and is_admin:
         payload["admin_preview"] = True
-    state[COOKIE_CULTIVATION_KEY] = node
-    profile.mini_games = _json_dump(state)
+    _cultivation_save(profile, node)
     db.commit()
     return payload
 
@@ -10364,7 +12621,7 @@ def cultivation_status(user: User = Depends(user_from_token), db: Session = Depe
 def cultivation_leaderboard(
     limit: int = Query(20, ge=1, le=100),
     db: Session = Depends(get_db),
-    user: User = Depends(user_from_token),
+    user: AuthSession = Depends(auth_session),
 ):
     rows = (
         db.query(CultivationLeaderboardEntry)
@@ -10440,7 +12697,7 @@ def cultivation_refresh(user: User = Depends(user_from_token), db: Session = Dep
     if not enabled and not getattr(user, "is_admin", False):
         raise HTTPException(404, "小游戏未开启")
     profile = ensure_cookie_profile(db, user, now)
-    state, node = _cultivation_node(profile)
+    node = _cultivation_node(profile)
     run = node.get("active_run") if isinstance(node.get("active_run"), dict) else None
     if run and not run.get("finished"):
         raise HTTPException(400, "历练进行中，无法刷新天赋")
@@ -10452,8 +12709,7 @@ def cultivation_refresh(user: User = Depends(user_from_token), db: Session = Dep
     rng = random.Random(secrets.randbits(64))
     lobby["talents"] = _cultivation_pick_talents(rng)
     node["lobby"] = lobby
-    state[COOKIE_CULTIVATION_KEY] = node
-    profile.mini_games = _json_dump(state)
+    _cultivation_save(profile, node)
     db.commit()
     return {"lobby": lobby}
 
@@ -10469,7 +12725,7 @@ def cultivation_begin(
     if not enabled and not getattr(user, "is_admin", False):
         raise HTTPException(404, "小游戏未开启")
     profile = ensure_cookie_profile(db, user, now)
-    state, node = _cultivation_node(profile)
+    node = _cultivation_node(profile)
     run = node.get("active_run") if isinstance(node.get("active_run"), dict) else None
     if run and not run.get("finished"):
         raise HTTPException(400, "仍有历练尚未结束")
@@ -10588,8 +12844,7 @@ def cultivation_begin(
         starting_coins,
     )
     _cultivation_generate_event(run)
-    state[COOKIE_CULTIVATION_KEY] = node
-    profile.mini_games = _json_dump(state)
+    _cultivation_save(profile, node)
     db.commit()
     is_admin = bool(getattr(user, "is_admin", False))
     return {
@@ -10611,7 +12866,7 @@ def cultivation_advance(
     if not enabled and not is_admin:
         raise HTTPException(404, "小游戏未开启")
     profile = ensure_cookie_profile(db, user, now)
-    state, node = _cultivation_node(profile)
+    node = _cultivation_node(profile)
     run = node.get("active_run") if isinstance(node.get("active_run"), dict) else None
     if not run or run.get("finished"):
         raise HTTPException(400, "当前没有进行中的历练")
@@ -10624,10 +12879,9 @@ def cultivation_advance(
         outcome.pop("success_rate", None)
         outcome.pop("crit_rate", None)
     if run.get("finished"):
-        result = _cultivation_finalize(db, profile, user, now, state, node, run)
+        result = _cultivation_finalize(db, profile, user, now, node, run)
         _cultivation_prepare_lobby(node)
-        state[COOKIE_CULTIVATION_KEY] = node
-        profile.mini_games = _json_dump(state)
+        _cultivation_save(profile, node)
         db.commit()
         return {
             "finished": True,
@@ -10637,8 +12891,7 @@ def cultivation_advance(
         }
     if not run.get("pending_event"):
         _cultivation_generate_event(run)
-    state[COOKIE_CULTIVATION_KEY] = node
-    profile.mini_games = _json_dump(state)
+    _cultivation_save(profile, node)
     db.commit()
     return {
         "finished": False,
@@ -10665,6 +12918,7 @@ def admin_cookie_factory_status(user: User = Depends(user_from_token), db: Sessi
         "enabled": bool(enabled),
         "profiles": total_profiles,
         "total_bricks": total_bricks,
+        "settlement": COOKIE_SETTLEMENT.forecast(db),
         "cultivation_enabled": bool(cultivation_enabled),
         "cultivation_runs": int(cultivation_runs),
         "cultivation_best": int(cultivation_best),
@@ -10725,6 +12979,27 @@ def admin_presence(user: User = Depends(user_from_token), db: Session = Depends(
     return {"now": int(time.time()), "online": data}
 
 
+@app.get("/admin/metrics")
+def admin_metrics(
+    format: Literal["json", "prometheus"] = Query("json"),
+    user: User = Depends(user_from_token),
+):
+    """各路由耗时分位数与每请求 SQL 条数/耗时、载入行数、提交次数（仅本 worker）。
+
+    format=prometheus 输出 Prometheus 文本格式，便于抓取。
+    """
+    if not getattr(user, "is_admin", False):
+        raise HTTPException(403, "需要管理员权限")
+    if format == "prometheus":
+        return Response(ROUTE_METRICS.prometheus(), media_type="text/plain; version=0.0.4; charset=utf-8")
+    return {
+        "worker": WORKER_ID,
+        "since": ROUTE_METRICS.started_at,
+        "sample_size": ROUTE_METRICS.sample_size,
+        "routes": ROUTE_METRICS.snapshot(),
+    }
+
+
 
 # ------------------ Wallet / Shop ------------------
 @app.post("/wallet/topup")
@@ -10824,6 +13099,7 @@ def buy_bricks(inp: CountIn, user: User = Depends(user_from_token), db: Session
                 gross = item["price"] * item["quantity"]
                 net = (gross * 95) // 100
                 seller.coins += net
+                mark_cookie_delta_activity(db, seller.id)
                 record_trade(
                     db,
                     seller.id,
@@ -10839,6 +13115,7 @@ def buy_bricks(inp: CountIn, user: User = Depends(user_from_token), db: Session
             sell_order.remaining -= item["quantity"]
             if sell_order.remaining <= 0:
                 sell_order.active = False
+            track_brick_order(db, sell_order)
     for season_key, stats in season_stats.items():
         qty = stats.get("qty", 0)
         if qty <= 0:
@@ -10871,10 +13148,10 @@ def buy_bricks(inp: CountIn, user: User = Depends(user_from_token), db: Session
             0,
             season="" if season_key == BRICK_SEASON_FALLBACK else season_key,
         )
-    db.commit()
-    process_brick_buy_orders(db, cfg)
-    db.commit()
     brick_state = ensure_brick_market_state(db, cfg)
+    consume_official_bricks(db, brick_state, plan)
+    # 只消耗了挂单、价格未变，不会产生新的可成交委托，无需撮合
+    db.commit()
     return {
         "ok": True,
         "coins": user.coins,
@@ -10894,34 +13171,22 @@ def buy_bricks(inp: CountIn, user: User = Depends(user_from_token), db: Session
     }
 
 @app.get("/shop/prices")
-def shop_prices(user: User = Depends(user_from_token), db: Session = Depends(get_db)):
-    cfg = db.query(PoolConfig).first()
-    snapshot = brick_price_snapshot(db, cfg)
-    fills = process_brick_buy_orders(db, cfg)
-    db.commit()
-    resp = {
-        "brick_price": snapshot["unit"],
-        "brick_price_raw": snapshot["raw"],
-        "key_price": cfg.key_price
+def shop_prices(request: Request, user: AuthSession = Depends(auth_session)):
+    # 价格由 PRICE_TICKER 定时推进，这里只返回共享快照，不读写数据库
+    snapshot = PRICE_TICKER.snapshot()
+    headers = {
+        "ETag": snapshot["etag"],
+        "Cache-Control": f"private, max-age={SHOP_PRICES_MAX_AGE}",
     }
-    season_prices = []
-    for sid in SEASON_IDS:
-        season_prices.append({
-            "season": sid,
-            "name": _season_display_name(sid),
-            "price": _season_brick_price(snapshot["unit"], sid),
-        })
-    if season_prices:
-        resp["season_prices"] = season_prices
-    if fills:
-        resp["buy_orders_filled"] = fills
-    return resp
+    if request.headers.get("if-none-match") == snapshot["etag"]:
+        return Response(status_code=304, headers=headers)
+    return Response(content=snapshot["body"], media_type="application/json", headers=headers)
 
 @app.get("/shop/brick-quote")
 def shop_brick_quote(
     count: int = Query(..., ge=1),
     season: Optional[str] = Query(None),
-    user: User = Depends(user_from_token),
+    user: AuthSession = Depends(auth_session),
     db: Session = Depends(get_db)
 ):
     cfg = db.query(PoolConfig).first()
@@ -10956,10 +13221,10 @@ def odds(
     cfg = db.query(PoolConfig).first()
     pity_row = get_user_season_pity(db, user, season)
     season_key = pity_row.season or BRICK_SEASON_FALLBACK
-    od = compute_odds(pity_row.pity_brick, pity_row.pity_purple, cfg)
+    od = odds_table(cfg).odds(pity_row.pity_brick, pity_row.pity_purple)
     sync_user_global_pity(user, season_key, pity_row)
     return {
-        "odds": od.dict(),
+        "odds": od,
         "limits": {"brick_pity_max": cfg.brick_pity_max, "purple_pity_max": cfg.purple_pity_max},
         "season": season_key,
         "season_label": _season_display_name(season_key),
@@ -10993,65 +13258,54 @@ def gacha_open(inp: CountIn, user: User = Depends(user_from_token), db: Session
     results = []
     target_skin = (inp.target_skin_id or "").strip()
     pity_row = get_user_season_pity(db, user, season_key)
+    rarities, pity_row.pity_brick, pity_row.pity_purple = resolve_pull_rarities(
+        cfg, pity_row.pity_brick, pity_row.pity_purple, inp.count
+    )
+    pool = SKIN_CATALOG.pool()
+    acquired_at = int(time.time())
+    gift_quota = int(user.gift_brick_quota or 0)
+    rows: List[Dict[str, Any]] = []
+    pulls: List[Tuple[Skin, Dict[str, Any]]] = []
 
-    for _ in range(inp.count):
-        od = compute_odds(pity_row.pity_brick, pity_row.pity_purple, cfg)
-        # 决定稀有度
-        if od.force_brick_next:
-            rarity = "BRICK"
-        else:
-            r = rng_ppm()
-            if r < ppm(od.brick):
-                rarity = "BRICK"
-            else:
-                r2 = rng_ppm()
-                if r2 < ppm(od.purple) or od.force_purple_next:
-                    rarity = "PURPLE"
-                else:
-                    r3 = rng_ppm()
-                    rarity = "BLUE" if r3 < ppm(od.blue) else "GREEN"
-
-        if rarity == "BRICK":
-            pity_row.pity_brick = 0
-            pity_row.pity_purple = int(pity_row.pity_purple or 0) + 1
-        elif rarity == "PURPLE":
-            pity_row.pity_brick = int(pity_row.pity_brick or 0) + 1
-            pity_row.pity_purple = 0
-        else:
-            pity_row.pity_brick = int(pity_row.pity_brick or 0) + 1
-            pity_row.pity_purple = int(pity_row.pity_purple or 0) + 1
-
+    for rarity in rarities:
         preferred = target_skin if rarity == "BRICK" and target_skin else None
-        skin = pick_skin(db, rarity, season=season_key, preferred_skin_id=preferred)
+        skin = pool.draw(rarity, season=season_key, preferred_skin_id=preferred)
         exquisite = (secrets.randbelow(100) < 15) if rarity == "BRICK" else False
         wear_bp = wear_random_bp()
         grade = grade_from_wear_bp(wear_bp)
-        profile = generate_visual_profile(skin.rarity, exquisite, model_key=skin.model_key, skin=skin)
-
-        result_season = _brick_season_key(skin.season or season_key)
-        inv = Inventory(
-            user_id=user.id, skin_id=skin.skin_id, name=skin.name, rarity=skin.rarity,
-            exquisite=exquisite, wear_bp=wear_bp, grade=grade, serial="",
-            acquired_at=int(time.time()),
-            body_colors=json.dumps(profile["body"], ensure_ascii=False),
-            attachment_colors=json.dumps(profile["attachments"], ensure_ascii=False),
-            template_name=profile["template"],
-            effect_tags=json.dumps(profile["effects"], ensure_ascii=False),
-            hidden_template=profile["hidden_template"],
-            season=result_season,
-            model_key=profile.get("model", skin.model_key or ""),
+        profile = generate_visual_profile(
+            skin.rarity, exquisite, model_key=skin.model_key, skin=skin, meta=pool.meta(skin)
         )
-        if int(user.gift_brick_quota or 0) > 0:
-            inv.sell_locked = True
-            inv.lock_reason = "由赠送资金购得，暂不可交易"
-            user.gift_brick_quota = max(0, int(user.gift_brick_quota or 0) - 1)
-        db.add(inv); db.flush()
-        inv.serial = f"{inv.id:08d}"
-
+        sell_locked = False
+        lock_reason = ""
+        if gift_quota > 0:
+            sell_locked = True
+            lock_reason = "由赠送资金购得，暂不可交易"
+            gift_quota -= 1
+        rows.append(prerender_inventory_row({
+            "user_id": user.id, "skin_id": skin.skin_id, "name": skin.name, "rarity": skin.rarity,
+            "exquisite": exquisite, "wear_bp": wear_bp, "grade": grade, "serial": "",
+            "acquired_at": acquired_at, "on_market": False,
+            "body_colors": json.dumps(profile["body"], ensure_ascii=False),
+            "attachment_colors": json.dumps(profile["attachments"], ensure_ascii=False),
+            "template_name": profile["template"],
+            "effect_tags": json.dumps(profile["effects"], ensure_ascii=False),
+            "hidden_template": profile["hidden_template"],
+            "sell_locked": sell_locked,
+            "lock_reason": lock_reason,
+            "season": _brick_season_key(skin.season or season_key),
+            "model_key": profile.get("model", skin.model_key or ""),
+        }, skin))
+        pulls.append((skin, profile))
+    user.gift_brick_quota = gift_quota
+
+    inv_ids = mint_inventory_batch(db, rows)
+    for inv_id, row, (skin, profile) in zip(inv_ids, rows, pulls):
         results.append({
-            "inv_id": inv.id,
+            "inv_id": inv_id,
             "skin_id": skin.skin_id, "name": skin.name, "rarity": skin.rarity,
-            "exquisite": exquisite, "wear": f"{wear_bp/100:.2f}", "grade": grade, "serial": inv.serial,
+            "exquisite": row["exquisite"], "wear": f"{row['wear_bp']/100:.2f}", "grade": row["grade"],
+            "serial": f"{inv_id:08d}",
             "template": profile["template"],
             "template_label": profile.get("template_label", ""),
             "hidden_template": profile["hidden_template"],
@@ -11060,10 +13314,10 @@ def gacha_open(inp: CountIn, user: User = Depends(user_from_token), db: Session
             "affinity": profile.get("affinity", {}),
             "affinity_label": profile.get("affinity_label", ""),
             "affinity_tag": profile.get("affinity_tag", ""),
-            "season": result_season,
-            "model": profile.get("model", skin.model_key or ""),
-            "sell_locked": bool(inv.sell_locked),
-            "lock_reason": inv.lock_reason or "",
+            "season": row["season"],
+            "model": row["model_key"],
+            "sell_locked": row["sell_locked"],
+            "lock_reason": row["lock_reason"],
             "visual": {
                 "body": profile["body"],
                 "attachments": profile["attachments"],
@@ -11075,25 +13329,29 @@ def gacha_open(inp: CountIn, user: User = Depends(user_from_token), db: Session
                 "affinity": profile.get("affinity", {}),
                 "affinity_label": profile.get("affinity_label", ""),
                 "affinity_tag": profile.get("affinity_tag", ""),
-                "model": profile.get("model", skin.model_key or ""),
+                "model": row["model_key"],
             },
         })
 
-    apply_brick_market_influence(db, cfg, results)
+    brick_state = apply_brick_market_influence(db, cfg, results)
     process_brick_buy_orders(db, cfg)
     sync_user_global_pity(user, season_key, pity_row)
     db.commit()
+    PRICE_TICKER.publish(cfg, brick_state)
     return {"ok": True, "results": results}
 
 # ------------------ Inventory ------------------
 # —— 背包平铺列表：默认隐藏已上架（on_market=True）的物品
 @app.get("/inventory")
-def inventory(
+async def inventory(
     rarity: Optional[RarityT] = None,
     show_on_market: bool = False,     # 新增：默认 False => 隐藏在交易行中的物品
-    user: User = Depends(user_from_token),
-    db: Session = Depends(get_db)
+    user: AuthSession = Depends(auth_session_async),
 ):
+    return await run_db(inventory_view, rarity=rarity, show_on_market=show_on_market, user=user)
+
+
+def inventory_view(db: Session, user: AuthSession, rarity: Optional[str] = None, show_on_market: bool = False):
     q = db.query(Inventory).filter_by(user_id=user.id)
     if rarity:
         q = q.filter(Inventory.rarity == rarity)
@@ -11102,15 +13360,10 @@ def inventory(
 
     rows = q.order_by(Inventory.id.desc()).all()
     skin_ids = {r.skin_id for r in rows if r.skin_id}
-    skin_map = {}
-    if skin_ids:
-        for s in db.query(Skin).filter(Skin.skin_id.in_(skin_ids)).all():
-            skin_map[s.skin_id] = s
+    skin_map = SKIN_CATALOG.skin_map(skin_ids)
     items = []
-    changed = False
     for x in rows:
-        vis = ensure_visual(x, skin_map.get(x.skin_id))
-        changed = changed or vis["changed"]
+        vis = load_visual(x, skin_map.get(x.skin_id))
         visual_payload = {
             "body": vis["body"],
             "attachments": vis["attachments"],
@@ -11127,9 +13380,6 @@ def inventory(
 
         season_source = x.season or (skin_map.get(x.skin_id).season if skin_map.get(x.skin_id) else "")
         season_key = _brick_season_key(season_source)
-        if season_key and (x.season or "") != season_key:
-            x.season = season_key
-            changed = True
         items.append({
             "inv_id": x.id,
             "skin_id": x.skin_id, "name": x.name, "rarity": x.rarity,
@@ -11154,8 +13404,6 @@ def inventory(
             "sell_locked": bool(getattr(x, "sell_locked", False)),
             "lock_reason": x.lock_reason or "",
         })
-    if changed:
-        db.commit()
     return {"count": len(items), "items": items}
 
 
@@ -11163,7 +13411,7 @@ def inventory(
 @app.get("/inventory/by-color")
 def inventory_by_color(
     show_on_market: bool = False,     # 新增参数，默认隐藏已上架
-    user: User = Depends(user_from_token),
+    user: AuthSession = Depends(auth_session),
     db: Session = Depends(get_db)
 ):
     q = db.query(Inventory).filter_by(user_id=user.id)
@@ -11173,14 +13421,9 @@ def inventory_by_color(
 
     grouped = {"BRICK": [], "PURPLE": [], "BLUE": [], "GREEN": []}
     skin_ids = {r.skin_id for r in rows if r.skin_id}
-    skin_map = {}
-    if skin_ids:
-        for s in db.query(Skin).filter(Skin.skin_id.in_(skin_ids)).all():
-            skin_map[s.skin_id] = s
-    changed = False
+    skin_map = SKIN_CATALOG.skin_map(skin_ids)
     for x in rows:
-        vis = ensure_visual(x, skin_map.get(x.skin_id))
-        changed = changed or vis["changed"]
+        vis = load_visual(x, skin_map.get(x.skin_id))
         visual_payload = {
             "body": vis["body"],
             "attachments": vis["attachments"],
@@ -11197,9 +13440,6 @@ def inventory_by_color(
 
         season_source = x.season or (skin_map.get(x.skin_id).season if skin_map.get(x.skin_id) else "")
         season_key = _brick_season_key(season_source)
-        if season_key and (x.season or "") != season_key:
-            x.season = season_key
-            changed = True
         grouped[x.rarity].append({
             "inv_id": x.id,
             "skin_id": x.skin_id, "name": x.name, "rarity": x.rarity,
@@ -11225,8 +13465,6 @@ def inventory_by_color(
             "lock_reason": x.lock_reason or "",
         })
     summary = {r: len(v) for r, v in grouped.items()}
-    if changed:
-        db.commit()
     return {"summary": summary, "buckets": grouped}
 
 # ------------------ Crafting ------------------
@@ -11252,10 +13490,7 @@ def craft_compose(inp: ComposeIn,
 
     avg_bp = round(sum(r.wear_bp for r in rows) / 20)
     skin_ids = {r.skin_id for r in rows if r.skin_id}
-    skin_map = {}
-    if skin_ids:
-        for s in db.query(Skin).filter(Skin.skin_id.in_(skin_ids)).all():
-            skin_map[s.skin_id] = s
+    skin_map = SKIN_CATALOG.skin_map(skin_ids)
     season_counter: Dict[str, int] = {}
     for r in rows:
         season_id = _normalize_season(r.season)
@@ -11280,10 +13515,10 @@ def craft_compose(inp: ComposeIn,
     else:
         target_season = LATEST_SEASON
 
-    skin = pick_skin(db, to_rarity, season=target_season)
+    skin = pick_skin(to_rarity, season=target_season)
     exquisite = (secrets.randbelow(100) < 15) if to_rarity == "BRICK" else False
     grade = grade_from_wear_bp(avg_bp)
-    profile = generate_visual_profile(skin.rarity, exquisite, model_key=skin.model_key, skin=skin)
+    profile = generate_visual_profile(skin.rarity, exquisite, model_key=skin.model_key, skin=skin, meta=SKIN_CATALOG.meta(skin))
 
     inv = Inventory(
         user_id=user.id, skin_id=skin.skin_id, name=skin.name, rarity=skin.rarity,
@@ -11297,6 +13532,7 @@ def craft_compose(inp: ComposeIn,
         season=skin.season or target_season,
         model_key=profile.get("model", skin.model_key or ""),
     )
+    render_visual_payload(inv, skin)
     db.add(inv); db.flush()
     inv.serial = f"{inv.id:08d}"
     db.commit()
@@ -11333,11 +13569,29 @@ class MarketBrowseParams(BaseModel):
 from sqlalchemy.exc import IntegrityError
 
 @app.get("/market/bricks/book")
-def brick_order_book(
+async def brick_order_book(
     season: Optional[str] = Query(None),
-    user: User = Depends(user_from_token),
-    db: Session = Depends(get_db),
+    bucket: int = Query(10, ge=1, le=1000),
+    price_min: Optional[int] = Query(None, ge=0),
+    price_max: Optional[int] = Query(None, ge=0),
+    user: AuthSession = Depends(auth_session_async),
 ):
+    return await run_db(
+        brick_order_book_view, season=season, bucket=bucket,
+        price_min=price_min, price_max=price_max, user=user,
+    )
+
+
+def brick_order_book_view(
+    db: Session,
+    user: AuthSession,
+    season: Optional[str] = None,
+    bucket: int = 10,
+    price_min: Optional[int] = None,
+    price_max: Optional[int] = None,
+):
+    if price_min is not None and price_max is not None and price_min > price_max:
+        raise HTTPException(400, "价格区间无效")
     cfg = db.query(PoolConfig).first()
     state = ensure_brick_market_state(db, cfg)
     layers = official_sell_layers(cfg, state)
@@ -11345,8 +13599,12 @@ def brick_order_book(
     if season_raw and season_raw.upper() == "ALL":
         season_raw = ""
     season_key = _normalize_season(season_raw)
+    is_admin = bool(getattr(user, "is_admin", False))
     player_query = db.query(BrickSellOrder, User).join(User, BrickSellOrder.user_id == User.id, isouter=True)\
         .filter(BrickSellOrder.active == True, BrickSellOrder.source == "player", BrickSellOrder.remaining > 0)
+    if not is_admin:
+        # 普通玩家只看得到自己的挂单，盘口分布走深度缓存
+        player_query = player_query.filter(BrickSellOrder.user_id == user.id)
     if season_key:
         player_query = player_query.filter(func.upper(BrickSellOrder.season) == season_key)
     player_rows = player_query\
@@ -11369,7 +13627,10 @@ def brick_order_book(
             my_sell.append(entry)
         if getattr(user, "is_admin", False):
             player_sell_view.append(entry)
-    buy_orders = db.query(BrickBuyOrder).filter(BrickBuyOrder.active == True, BrickBuyOrder.remaining > 0)\
+    buy_query = db.query(BrickBuyOrder).filter(BrickBuyOrder.active == True, BrickBuyOrder.remaining > 0)
+    if not is_admin:
+        buy_query = buy_query.filter(BrickBuyOrder.user_id == user.id)
+    buy_orders = buy_query\
         .order_by(BrickBuyOrder.target_price.desc(), BrickBuyOrder.created_at.asc(), BrickBuyOrder.id.asc()).all()
     my_buy = []
     player_buy_view = []
@@ -11395,7 +13656,15 @@ def brick_order_book(
         if season_key and layer_key != season_key:
             continue
         filtered_layers.append(layer)
-    histogram = build_brick_histogram(filtered_layers, [row[0] for row in player_rows])
+    depth_version = (
+        BRICK_BOOK.revision,
+        OFFICIAL_LAYERS.revision,
+        int((state.last_update or 0) / OFFICIAL_LAYER_WINDOW_SEC),
+        cfg.brick_price,
+    )
+    book_view = BRICK_DEPTH_CACHE.view(
+        db, season_key, filtered_layers, depth_version, bucket, price_min, price_max
+    )
     for layer in layers:
         layer["season_name"] = _season_display_name(layer.get("season") or BRICK_SEASON_FALLBACK)
     resp = {
@@ -11405,7 +13674,9 @@ def brick_order_book(
         "player_buys": player_buy_view if getattr(user, "is_admin", False) else [],
         "my_sells": my_sell,
         "my_buys": my_buy,
-        "histogram": histogram,
+        "histogram": book_view["histogram"],
+        "depth": book_view["depth"],
+        "bucket": book_view["bucket"],
         "timestamp": int(time.time()),
     }
     if season_key:
@@ -11438,9 +13709,10 @@ def brick_sell(inp: BrickSellIn, user: User = Depends(user_from_token), db: Sess
         season=season_key,
     )
     db.add(order)
+    track_brick_order(db, order)
     db.commit()
     cfg = db.query(PoolConfig).first()
-    fills = process_brick_buy_orders(db, cfg)
+    fills = process_brick_buy_orders(db, cfg, seasons=[season_key])
     db.commit()
     db.refresh(order)
     resp = {"ok": True, "order_id": order.id, "remaining": order.remaining}
@@ -11456,6 +13728,7 @@ def brick_sell_cancel(order_id: int = Path(..., ge=1), user: User = Depends(user
     release_reserved_bricks(db, user, order.season or None, order.remaining)
     order.active = False
     order.remaining = 0
+    track_brick_order(db, order)
     db.commit()
     return {"ok": True, "msg": "已撤销砖挂单"}
 
@@ -11488,9 +13761,10 @@ def brick_buy_order(inp: BrickBuyOrderIn, user: User = Depends(user_from_token),
         season=season_key,
     )
     db.add(order)
+    track_brick_order(db, order)
     db.commit()
     cfg = db.query(PoolConfig).first()
-    fills = process_brick_buy_orders(db, cfg)
+    fills = process_brick_buy_orders(db, cfg, seasons=[season_key])
     db.commit()
     db.refresh(order)
     resp = {
@@ -11522,6 +13796,7 @@ def brick_buy_order_cancel(order_id: int = Path(..., ge=1), user: User = Depends
     order.remaining = 0
     order.locked_coins = 0
     order.gift_coin_locked = 0
+    track_brick_order(db, order)
     db.commit()
     return {"ok": True, "msg": "已撤销砖收购委托"}
 
@@ -11575,20 +13850,15 @@ def market_list(inp: MarketListIn, user: User = Depends(user_from_token), db: Se
 
 
 @app.get("/market/my")
-def market_my(user: User = Depends(user_from_token), db: Session = Depends(get_db)):
+def market_my(user: AuthSession = Depends(auth_session), db: Session = Depends(get_db)):
     q = db.query(MarketItem, Inventory).join(Inventory, MarketItem.inv_id==Inventory.id)\
         .filter(MarketItem.active==True, MarketItem.user_id==user.id, Inventory.on_market==True)
     rows = q.all()
     skin_ids = {inv.skin_id for _, inv in rows if inv.skin_id}
-    skin_map = {}
-    if skin_ids:
-        for s in db.query(Skin).filter(Skin.skin_id.in_(skin_ids)).all():
-            skin_map[s.skin_id] = s
+    skin_map = SKIN_CATALOG.skin_map(skin_ids)
     items = []
-    changed = False
     for mi, inv in rows:
-        vis = ensure_visual(inv, skin_map.get(inv.skin_id))
-        changed = changed or vis["changed"]
+        vis = load_visual(inv, skin_map.get(inv.skin_id))
         visual_payload = {
             "body": vis["body"],
             "attachments": vis["attachments"],
@@ -11619,8 +13889,6 @@ def market_my(user: User = Depends(user_from_token), db: Session = Depends(get_d
             "season": inv.season or (skin_map.get(inv.skin_id).season if skin_map.get(inv.skin_id) else ""),
             "visual": visual_payload,
         })
-    if changed:
-        db.commit()
     return {"count": len(items), "items": items}
 
 @app.post("/market/delist/{market_id}")
@@ -11635,16 +13903,74 @@ def market_delist(market_id: int = Path(..., ge=1),
     db.commit()
     return {"ok": True, "msg": "已撤下架"}
 
+# 排序方式 -> (排序列, 是否降序)；同值按 MarketItem.id 同向排序，保证游标唯一
+MARKET_BROWSE_SORTS = {
+    "wear_asc": (Inventory.wear_bp, False),
+    "wear_desc": (Inventory.wear_bp, True),
+    "price_asc": (MarketItem.price, False),
+    "price_desc": (MarketItem.price, True),
+    "oldest": (MarketItem.created_at, False),
+    "newest": (MarketItem.created_at, True),
+}
+MARKET_BROWSE_TOTAL_TTL = 10
+_MARKET_BROWSE_TOTALS: Dict[Tuple[Any, ...], Tuple[float, int]] = {}
+_MARKET_BROWSE_TOTALS_LOCK = threading.Lock()
+
+
+def _market_browse_cursor(sort: str, value: int, market_id: int) -> str:
+    return f"{sort}:{int(value)}:{int(market_id)}"
+
+
+def _parse_market_browse_cursor(cursor: str, sort: str) -> Tuple[int, int]:
+    try:
+        cursor_sort, value, market_id = cursor.split(":")
+        if cursor_sort != sort:
+            raise ValueError(cursor_sort)
+        return int(value), int(market_id)
+    except ValueError:
+        raise HTTPException(400, "分页游标无效，请重新加载")
+
+
+def _market_browse_total(q, key: Tuple[Any, ...]) -> int:
+    """同一筛选条件的总数缓存若干秒，翻页时不必每次全量 COUNT。"""
+    now = time.time()
+    with _MARKET_BROWSE_TOTALS_LOCK:
+        hit = _MARKET_BROWSE_TOTALS.get(key)
+        if hit and now - hit[0] < MARKET_BROWSE_TOTAL_TTL:
+            return hit[1]
+    total = int(q.with_entities(func.count(MarketItem.id)).order_by(None).scalar() or 0)
+    with _MARKET_BROWSE_TOTALS_LOCK:
+        if len(_MARKET_BROWSE_TOTALS) > 512:
+            _MARKET_BROWSE_TOTALS.clear()
+        _MARKET_BROWSE_TOTALS[key] = (now, total)
+    return total
+
+
 @app.get("/market/browse")
-def market_browse(rarity: Optional[RarityT] = None,
-                  skin_id: Optional[str] = None,
-                  is_exquisite: Optional[bool] = None,
-                  grade: Optional[Literal["S","A","B","C"]] = None,
-                  sort: Optional[str] = "newest",
-                  season: Optional[str] = None,
-                  db: Session = Depends(get_db)):
-    q = db.query(MarketItem, Inventory, User).join(Inventory, MarketItem.inv_id==Inventory.id)\
-        .join(User, MarketItem.user_id==User.id)\
+async def market_browse(rarity: Optional[RarityT] = None,
+                        skin_id: Optional[str] = None,
+                        is_exquisite: Optional[bool] = None,
+                        grade: Optional[Literal["S","A","B","C"]] = None,
+                        sort: Optional[str] = "newest",
+                        season: Optional[str] = None,
+                        cursor: Optional[str] = None,
+                        limit: int = Query(100, ge=1, le=200)):
+    return await run_db(
+        market_browse_view, rarity=rarity, skin_id=skin_id, is_exquisite=is_exquisite,
+        grade=grade, sort=sort, season=season, cursor=cursor, limit=limit,
+    )
+
+
+def market_browse_view(db: Session,
+                       rarity: Optional[str] = None,
+                       skin_id: Optional[str] = None,
+                       is_exquisite: Optional[bool] = None,
+                       grade: Optional[str] = None,
+                       sort: Optional[str] = "newest",
+                       season: Optional[str] = None,
+                       cursor: Optional[str] = None,
+                       limit: int = 100):
+    q = db.query(MarketItem).join(Inventory, MarketItem.inv_id==Inventory.id)\
         .filter(MarketItem.active==True, Inventory.on_market==True)
     if rarity:
         q = q.filter(Inventory.rarity==rarity)
@@ -11657,31 +13983,35 @@ def market_browse(rarity: Optional[RarityT] = None,
     season_key = _normalize_season(season)
     if season_key:
         q = q.filter(func.upper(Inventory.season) == season_key)
-
-    if sort == "wear_asc":
-        q = q.order_by(Inventory.wear_bp.asc())
-    elif sort == "wear_desc":
-        q = q.order_by(Inventory.wear_bp.desc())
-    elif sort == "price_asc":
-        q = q.order_by(MarketItem.price.asc())
-    elif sort == "price_desc":
-        q = q.order_by(MarketItem.price.desc())
-    elif sort == "oldest":
-        q = q.order_by(MarketItem.created_at.asc())
-    else:  # newest
-        q = q.order_by(MarketItem.created_at.desc())
-
-    rows = q.all()
+    total = _market_browse_total(q, (rarity, skin_id, is_exquisite, grade, season_key))
+
+    sort = sort if sort in MARKET_BROWSE_SORTS else "newest"
+    sort_col, descending = MARKET_BROWSE_SORTS[sort]
+    if cursor:
+        after_value, after_id = _parse_market_browse_cursor(cursor, sort)
+        key_cols = tuple_(sort_col, MarketItem.id)
+        if descending:
+            q = q.filter(key_cols < tuple_(after_value, after_id))
+        else:
+            q = q.filter(key_cols > tuple_(after_value, after_id))
+    if descending:
+        q = q.order_by(sort_col.desc(), MarketItem.id.desc())
+    else:
+        q = q.order_by(sort_col.asc(), MarketItem.id.asc())
+
+    q = q.join(User, MarketItem.user_id==User.id).with_entities(MarketItem, Inventory, User)
+    rows = q.limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last_mi, last_inv, _ = rows[-1]
+        last_value = getattr(last_inv if sort_col.class_ is Inventory else last_mi, sort_col.key)
+        next_cursor = _market_browse_cursor(sort, last_value, last_mi.id)
     skin_ids = {inv.skin_id for _, inv, _ in rows if inv.skin_id}
-    skin_map = {}
-    if skin_ids:
-        for s in db.query(Skin).filter(Skin.skin_id.in_(skin_ids)).all():
-            skin_map[s.skin_id] = s
+    skin_map = SKIN_CATALOG.skin_map(skin_ids)
     out: List[MarketBrowseOut] = []
-    changed = False
     for mi, inv, seller in rows:
-        vis = ensure_visual(inv, skin_map.get(inv.skin_id))
-        changed = changed or vis["changed"]
+        vis = load_visual(inv, skin_map.get(inv.skin_id))
         visual_payload = {
             "body": vis["body"],
             "attachments": vis["attachments"],
@@ -11704,14 +14034,17 @@ def market_browse(rarity: Optional[RarityT] = None,
             template=vis["template"], template_label=vis.get("template_label", ""),
             hidden_template=vis["hidden_template"],
             effects=vis["effects"], effect_labels=vis.get("effect_labels", []),
-            affinity=vis.get("affinity", {}), affinity_label=vis.get("affinity_label", ""),
-            affinity_tag=vis.get("affinity_tag", ""), visual=visual_payload,
+            affinity=vis.get("affinity") or {}, affinity_label=vis.get("affinity_label") or "",
+            affinity_tag=vis.get("affinity_tag") or "", visual=visual_payload,
             season=inv.season or (skin_map.get(inv.skin_id).season if skin_map.get(inv.skin_id) else ""),
             model=vis.get("model", ""),
         ))
-    if changed:
-        db.commit()
-    return {"count": len(out), "items": [o.dict() for o in out]}
+    return {
+        "count": len(out),
+        "total": total,
+        "next_cursor": next_cursor,
+        "items": [o.dict() for o in out],
+    }
 
 @app.post("/market/buy/{market_id}")
 def market_buy(market_id: int = Path(..., ge=1),
@@ -11782,7 +14115,10 @@ def admin_set_config(inp: PoolConfigIn, db: Session = Depends(get_db), _: None =
     cfg = db.query(PoolConfig).first()
     for k, v in inp.dict().items():
         setattr(cfg, k, v)
-    db.commit(); return {"ok": True}
+    db.commit()
+    odds_table(cfg, rebuild=True)
+    PRICE_TICKER.publish(cfg, ensure_brick_market_state(db, cfg))
+    return {"ok": True}
 
 @app.post("/admin/skins/upsert")
 def admin_upsert_skins(skins: List[SkinIn], db: Session = Depends(get_db), _: None = Depends(require_admin)):
@@ -11792,17 +14128,21 @@ def admin_upsert_skins(skins: List[SkinIn], db: Session = Depends(get_db), _: No
             row.name = s.name; row.rarity = s.rarity; row.active = s.active
         else:
             db.add(Skin(skin_id=s.skin_id, name=s.name, rarity=s.rarity, active=s.active))
-    db.commit(); return {"ok": True}
+    db.commit()
+    CACHE_BUS.publish("skins")
+    return {"ok": True}
 
 @app.post("/admin/skins/activate")
 def admin_activate_skin(s: SkinIn, db: Session = Depends(get_db), _: None = Depends(require_admin)):
     row = db.query(Skin).filter_by(skin_id=s.skin_id).first()
     if not row: raise HTTPException(404, "皮肤不存在")
-    row.active = s.active; db.commit(); return {"ok": True, "active": row.active}
+    row.active = s.active; db.commit()
+    CACHE_BUS.publish("skins")
+    return {"ok": True, "active": row.active}
 
 # ======== 追加：管理员/充值扩展（JWT 管理员 + 充值两段式 + 管理员发放法币 + 充值申请查看） ========
 from fastapi import APIRouter
-import sqlite3, time as _time, os as _os, jwt as _jwt
+import sqlite3, time as _time, os as _os
 from typing import Optional as _Optional
 
 try:
@@ -11818,26 +14158,15 @@ DB_PATH = _os.path.join(_os.path.dirname(__file__), "delta_brick.db")
 SMS_FILE = _os.path.join(_os.path.dirname(__file__), "sms_codes.txt")
 
 def _conn():
-    c = sqlite3.connect(DB_PATH)
-    c.row_factory = sqlite3.Row
-    return c
+    return raw_connection(row_factory=sqlite3.Row)
 
 def _get_auth_mode_flag() -> bool:
-    con = _conn(); cur = con.cursor()
-    cur.execute("SELECT value FROM system_settings WHERE key=?", (AUTH_MODE_KEY,))
-    row = cur.fetchone()
-    con.close()
-    if not row:
-        return True
-    return str(row["value"]) != "0"
+    return SYSTEM_SETTINGS.flag(AUTH_MODE_KEY, True)
 
 def _set_auth_mode_flag(flag: bool):
-    con = _conn(); cur = con.cursor()
-    cur.execute(
-        "REPLACE INTO system_settings(key, value) VALUES (?, ?)",
-        (AUTH_MODE_KEY, "1" if flag else "0")
-    )
-    con.commit(); con.close()
+    with SessionLocal() as db:
+        SYSTEM_SETTINGS.set(db, AUTH_MODE_KEY, "1" if flag else "0")
+        db.commit()
 
 def _ts(): return int(_time.time())
 
@@ -11852,54 +14181,15 @@ def _write_sms(tag, code, purpose, **extra):
         if parts:
             extra_text = "\t" + "&".join(parts)
     line = f"{_ts()}\t{purpose}\t{tag}\t{code}{extra_text}\n"
-    with open(SMS_FILE, "a", encoding="utf-8") as f:
-        f.write(line)
+    append_sms_file(SMS_FILE, line)
+    amount = extra.get("amount")
+    log_otp_event(purpose, tag, code, _ts() + OTP_LOG_LIVE_SEC,
+                  amount=int(amount) if amount is not None else None, extra=extra_text.strip())
 
 def _gen_code(n=6):
     import random
     return "".join([str(random.randint(0,9)) for _ in range(n)])
 
-# 幂等迁移：users.is_admin、admin_pending、topup_codes
-def _migrate_ext():
-    con=_conn(); cur=con.cursor()
-    # users 增加 is_admin（如果不存在）
-    cur.execute("PRAGMA table_info(users)")
-    cols = [row["name"] for row in cur.fetchall()]
-    if "is_admin" not in cols:
-        cur.execute("ALTER TABLE users ADD COLUMN is_admin INTEGER NOT NULL DEFAULT 0")
-    if "last_login_ts" not in cols:
-        cur.execute("ALTER TABLE users ADD COLUMN last_login_ts INTEGER NOT NULL DEFAULT 0")
-    if "admin_note" not in cols:
-        cur.execute("ALTER TABLE users ADD COLUMN admin_note TEXT NOT NULL DEFAULT ''")
-    # admin_pending
-    cur.execute("""CREATE TABLE IF NOT EXISTS admin_pending(
-      username TEXT PRIMARY KEY,
-      code TEXT NOT NULL,
-      expire_at INTEGER NOT NULL
-    )""")
-    # topup_codes
-    cur.execute("""CREATE TABLE IF NOT EXISTS topup_codes(
-      username TEXT NOT NULL,
-      code TEXT NOT NULL,
-      amount INTEGER NOT NULL,
-      expire_at INTEGER NOT NULL
-    )""")
-    # + 新增：管理员删号验证码表
-    cur.execute("""CREATE TABLE IF NOT EXISTS admin_deluser_codes(
-      target_username TEXT NOT NULL,
-      code TEXT NOT NULL,
-      requested_by TEXT NOT NULL,
-      expire_at INTEGER NOT NULL
-    )""")
-    cur.execute("""CREATE TABLE IF NOT EXISTS admin_password_codes(
-      target_id INTEGER NOT NULL,
-      code TEXT NOT NULL,
-      requested_by TEXT NOT NULL,
-      expire_at INTEGER NOT NULL
-    )""")
-
-    con.commit(); con.close()
-_migrate_ext()
 
 ext = APIRouter()
 
@@ -11911,32 +14201,24 @@ _auth = _HTTPBearer(auto_error=False)
 def _require_user(cred: _Creds = _Depends(_auth)):
     if not cred:
         raise _HTTPException(401, "Unauthorized")
+    # 与主路由共用会话版本缓存，命中时不查 users 表
     try:
-        data = _jwt.decode(cred.credentials, JWT_SECRET, algorithms=[JWT_ALGO])
-        username = data.get("sub")
-        token_sv = int(data.get("sv", -1))
-    except Exception:
-        raise _HTTPException(401, "Unauthorized")
-
-    if not username:
+        auth = resolve_session_token(cred.credentials)
+    except HTTPException as exc:
+        if exc.detail == "SESSION_REVOKED":
+            raise
         raise _HTTPException(401, "Unauthorized")
+    return {"id": auth.id, "username": auth.username, "is_admin": auth.is_admin}
 
+def _require_admin(u=_Depends(_require_user)):
+    # 管理员身份以数据库为准（缓存里的 is_admin 可能早于提权/降权）
     con=_conn(); cur=con.cursor()
-    cur.execute("SELECT * FROM users WHERE username=?", (username,))
-    u=cur.fetchone()
+    cur.execute("SELECT is_admin FROM users WHERE id=?", (u["id"],))
+    row=cur.fetchone()
     con.close()
-    if not u:
-        raise _HTTPException(401, "Unauthorized")
-
-    # ★ 单点登录校验
-    if int(u["session_ver"] or 0) != token_sv:
-        raise _HTTPException(status_code=401, detail="SESSION_REVOKED")
-
-    return u
-
-def _require_admin(u=_Depends(_require_user)):
-    if not bool(u["is_admin"]):
+    if not row or not bool(row["is_admin"]):
         raise _HTTPException(403, "Forbidden")
+    u["is_admin"] = True
     return u
 
 # 注册 want_admin=true 之后，前端可调用此接口提交验证码成为管理员
@@ -11957,11 +14239,12 @@ def admin_verify(payload: dict):
     cur.execute("UPDATE users SET is_admin=1 WHERE username=?", (username,))
     cur.execute("DELETE FROM admin_pending WHERE username=?", (username,))
     con.commit(); con.close()
+    CACHE_BUS.publish("sessions", username)
     return {"ok":True}
 
 # 提供给 /auth/register 调用：把申请管理员的验证码写入 admin_pending
-def put_admin_pending(username: str):
-    _sms_rate_guard("admin-verify", username)
+def put_admin_pending(username: str, ip: Optional[str] = None):
+    _sms_rate_guard("admin-verify", username, ip)
     con=_conn(); cur=con.cursor()
     code = _gen_code(6); exp = _ts()+15*60
     cur.execute("REPLACE INTO admin_pending(username, code, expire_at) VALUES (?,?,?)", (username, code, exp))
@@ -11985,11 +14268,11 @@ def admin_set_auth_mode(payload: dict, admin=_Depends(_require_admin)):
 
 # 充值两段式：请求验证码（携带金额）
 @ext.post("/wallet/topup/request")
-def topup_request(payload: dict, u=_Depends(_require_user)):
+def topup_request(payload: dict, request: Request, u=_Depends(_require_user)):
     amount = int((payload or {}).get("amount_fiat", 0) or 0)
     if amount <= 0:
         raise _HTTPException(400, "amount_fiat required")
-    _sms_rate_guard("wallet-topup", u["username"])
+    _sms_rate_guard("wallet-topup", u["username"], client_ip(request))
     code = _gen_code(6)
     con=_conn(); cur=con.cursor()
     cur.execute("DELETE FROM topup_codes WHERE username=?", (u["username"],))
@@ -12032,132 +14315,42 @@ def admin_topup_requests(admin=_Depends(_require_admin)):
     con.close()
     return {"items": items}
 
-# 管理员：读取短信验证码日志（来自 sms_codes.txt）
+# 管理员：读取短信验证码日志（来自 otp_events 表）
 @ext.get("/admin/sms-log")
 def admin_sms_log(limit: int = 200, admin=_Depends(_require_admin)):
     """
     仅返回：未过期 + 未使用（库中仍存在）+ 对应（phone,purpose）的“当前最新”验证码。
     - wallet-topup：匹配 topup_codes 表（仍存在且未过期即未使用；request 时会清旧，confirm/使用后会删）
-    - admin-verify：匹配 admin_pending 表（同上）
     - login / login2 / reset / register：匹配 sms_code 表（save_otp 现在会清旧、verify_otp 成功会删）
+    - admin-deluser / admin-verify 的验证码只允许后端可见，不在前端列表展示
     """
-    items = []
-    try:
-        with open(SMS_FILE, "r", encoding="utf-8") as f:
-            lines = f.readlines()
-    except FileNotFoundError:
-        lines = []
-
     now = _ts()
-
-    # 预取三张表的“当前有效”索引，方便 O(1) 判断
-    # 1) topup_codes：username -> {code, expire_at}
     con = _conn(); cur = con.cursor()
-    cur.execute("SELECT username, code, expire_at FROM topup_codes WHERE expire_at > ?", (now,))
-    alive_topup = {}
-    for r in cur.fetchall():
-        alive_topup[r["username"]] = {"code": r["code"], "expire_at": r["expire_at"]}
-    # 2) admin_pending：username -> {code, expire_at}
-    cur.execute("SELECT username, code, expire_at FROM admin_pending WHERE expire_at > ?", (now,))
-    alive_admin = {}
-
-    for r in cur.fetchall():
-        alive_admin[r["username"]] = {"code": r["code"], "expire_at": r["expire_at"]}
-    # 2.5) admin_deluser_codes：target_username -> {code, expire_at}
-    cur.execute("SELECT target_username, code, expire_at FROM admin_deluser_codes WHERE expire_at > ?", (now,))
-    alive_deluser = {}
-    for r in cur.fetchall():
-        alive_deluser[r["target_username"]] = {"code": r["code"], "expire_at": r["expire_at"]}
-
+    cur.execute(
+        """SELECT e.purpose, e.tag, e.code, e.created_at AS ts, e.amount
+           FROM otp_events e
+           WHERE e.expire_at > :now
+             AND e.id = (SELECT MAX(x.id) FROM otp_events x WHERE x.purpose = e.purpose AND x.tag = e.tag)
+             AND (
+               (e.purpose = 'wallet-topup' AND EXISTS (
+                  SELECT 1 FROM topup_codes t
+                  WHERE t.username = e.tag AND t.code = e.code AND t.expire_at > :now))
+               OR (e.purpose IN ('login', 'login2', 'reset', 'register') AND EXISTS (
+                  SELECT 1 FROM sms_code s
+                  WHERE s.phone = e.tag AND s.purpose = e.purpose AND s.expire_ts > :now))
+             )
+           ORDER BY e.id DESC
+           LIMIT :limit""",
+        {"now": now, "limit": max(1, min(limit, 1000))},
+    )
+    items = [
+        {"purpose": r["purpose"], "tag": r["tag"], "code": r["code"], "ts": int(r["ts"]), "amount": r["amount"]}
+        for r in cur.fetchall()
+    ]
     con.close()
-
-    # 3) sms_code（哈希无法直接比对 code，本函数只需要“是否有有效记录”即可；
-    #    因为 save_otp 发送前会把旧记录全部清掉，所以存在即代表“最新”）
-    from sqlalchemy import and_
-    with SessionLocal() as db:
-        alive_sms = {}  # key=(phone,purpose) -> True
-        rows = db.query(SmsCode.phone, SmsCode.purpose).filter(SmsCode.expire_ts > now).all()
-        for ph, pc in rows:
-            alive_sms[(ph, pc)] = True
-
-    def parse_line(line: str):
-        # 返回 (purpose, tag, code, ts_int, amount)
-        line = line.strip()
-        if not line:
-            return None
-        # 老格式：phone=... purpose=... code=... ts=...
-        if "phone=" in line and "purpose=" in line and "code=" in line:
-            parts = {}
-            for tok in line.replace("\t", " ").split():
-                if "=" in tok:
-                    k, v = tok.split("=", 1)
-                    parts[k] = v
-            purpose = parts.get("purpose", "")
-            tag = parts.get("phone", "")      # 老格式 tag=手机号
-            code = parts.get("code", "")
-            # ts 为人类时间，这里不依赖它做有效性判断
-            return purpose, tag, code, now, None
-        # 新格式：ts \t purpose \t tag \t code [\t amount=xxx]
-        cols = line.split("\t")
-        if len(cols) < 4:
-            return None
-        ts_int = int(cols[0]) if cols[0].isdigit() else now
-        purpose = cols[1]; tag = cols[2]; code = cols[3]
-        amount = None
-        if len(cols) >= 5 and cols[4].startswith("amount="):
-            try: amount = int(cols[4].split("=",1)[1])
-            except: pass
-        return purpose, tag, code, ts_int, amount
-
-    seen_keys = set()  # 新增：去重 (purpose, tag)
-
-    for line in reversed(lines):
-        parsed = parse_line(line)
-        if not parsed:
-            continue
-        purpose, tag, code, ts_int, amount = parsed
-        # 隐藏：删号验证码只允许后端可见，不在前端“短信验证码日志”里展示
-        # 隐藏：删号/管理员验证 的验证码只允许后端可见，不在前端列表展示
-        if purpose in ("admin-deluser", "admin-verify"):
-            continue
-
-        keep = False
-        if purpose == "wallet-topup":
-            # 仅当数据库里“当前有效”的那条 code 与文件行一致才保留
-            info = alive_topup.get(tag)
-            keep = bool(info and info["code"] == code and info["expire_at"] > now)
-        elif purpose == "admin-verify":
-            info = alive_admin.get(tag)
-            keep = bool(info and info["code"] == code and info["expire_at"] > now)
-        elif purpose in ("login", "login2", "reset", "register"):
-            # 有效即代表“最新”（save_otp 已清旧）
-            keep = alive_sms.get((tag, purpose), False)
-        elif purpose == "admin-deluser":
-            info = alive_deluser.get(tag)
-            keep = bool(info and info["code"] == code and info["expire_at"] > now)
-        else:
-            keep = False
-
-        if keep:
-            key = (purpose, tag)
-            if key in seen_keys:
-                continue  # 同一 purpose+tag 已收录过（最新一条），跳过旧的
-            seen_keys.add(key)
-
-            items.append({
-                "purpose": purpose,
-                "tag": tag,
-                "code": code,
-                "ts": ts_int,
-                "amount": amount
-            })
-            if len(items) >= max(1, min(limit, 1000)):
-                break
-
     return {"items": items}
 
 
-
 # 管理员：搜索用户
 @ext.get("/admin/users")
 def admin_users(q: _Optional[str]=None, page: int=1, page_size: int=20, admin=_Depends(_require_admin)):
@@ -12208,11 +14401,9 @@ def admin_user_inventory(username: str, admin=_Depends(_require_admin)):
         bricks = db.query(Inventory).filter_by(user_id=user.id, rarity="BRICK").order_by(Inventory.acquired_at.desc()).all()
         exquisite = 0
         premium = 0
-        changed = False
         items: List[Dict[str, Any]] = []
         for inv in bricks:
-            vis = ensure_visual(inv)
-            changed = changed or vis.get("changed")
+            vis = load_visual(inv)
             is_exquisite = bool(inv.exquisite)
             if is_exquisite:
                 exquisite += 1
@@ -12245,8 +14436,6 @@ def admin_user_inventory(username: str, admin=_Depends(_require_admin)):
                 "affinity_tag": vis.get("affinity_tag", ""),
                 "visual": visual_payload,
             })
-        if changed:
-            db.commit()
 
     return {
         "username": uname,
@@ -12483,6 +14672,7 @@ def admin_delete_user_confirm(payload: dict, admin=_Depends(_require_admin)):
     cur.execute("DELETE FROM users WHERE id=?", (uid,))
     cur.execute("DELETE FROM admin_deluser_codes WHERE target_username=?", (target,))
     con.commit(); con.close()
+    CACHE_BUS.publish("sessions", target)
 
     return {"ok": True, "msg": f"用户 {target} 已删除"}
 
@@ -5,17 +5,12 @@ from starlette.responses import FileResponse
 from starlette.exceptions import HTTPException as StarletteHTTPException
 from fastapi.middleware.gzip import GZipMiddleware
 from starlette.responses import RedirectResponse
+from contextlib import asynccontextmanager
 import os, sys
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(0, BASE_DIR)
 
-# 引入你原有的后端 app（保持不变）
-from server import app as api_app
-
-app = FastAPI(title="Delta Brick Web", version="1.0")
-app.add_middleware(GZipMiddleware, minimum_size=1024)
-
 FRONTEND_DIR = os.path.join(os.path.dirname(BASE_DIR), "frontend", "static")
 os.makedirs(FRONTEND_DIR, exist_ok=True)
 
@@ -42,19 +37,59 @@ class SPAStaticFiles(StaticFiles):
         return FileResponse(index_path, stat_result=stat_result, method=scope["method"])
 
 
-# ① 先挂静态前端到 /web（一定要在 "/" 之前），并让未知路径回退到 index
-app.mount("/web", SPAStaticFiles(directory=FRONTEND_DIR, html=True), name="web")
+def create_app() -> FastAPI:
+    # 引入你原有的后端 app（保持不变）
+    from server import app as api_app
+
+    @asynccontextmanager
+    async def lifespan(_app: FastAPI):
+        # 挂载的子应用收不到 lifespan 事件：server 里 on_event 注册的后台任务（价格、外观回填、
+        # 饼干周结算）和退出时的落库（限流、活跃度、bcrypt 进程池）由这里转发
+        await api_app.router.startup()
+        try:
+            yield
+        finally:
+            await api_app.router.shutdown()
+
+    app = FastAPI(title="Delta Brick Web", version="1.0", lifespan=lifespan)
+    app.add_middleware(GZipMiddleware, minimum_size=1024)
+
+    # ① 先挂静态前端到 /web（一定要在 "/" 之前），并让未知路径回退到 index
+    app.mount("/web", SPAStaticFiles(directory=FRONTEND_DIR, html=True), name="web")
 
-# ② 根路径重定向到 /web/
-@app.middleware("http")
-async def _root_redirect(request: Request, call_next):
-    if request.url.path in ("", "/"):
-        return RedirectResponse(url="/web/", status_code=307)
-    return await call_next(request)
+    # ② 根路径重定向到 /web/
+    @app.middleware("http")
+    async def _root_redirect(request: Request, call_next):
+        if request.url.path in ("", "/"):
+            return RedirectResponse(url="/web/", status_code=307)
+        return await call_next(request)
 
-# ③ 最后把 API 挂到 "/"（路径保持不变）
-app.mount("/", api_app)
+    # ③ 最后把 API 挂到 "/"（路径保持不变）
+    app.mount("/", api_app)
+
+    return app
+
+
+# bcrypt 进程池与多 worker 的子进程都以 spawn 启动，会把本文件当作 __mp_main__ 再导入一遍；
+# 这时不构建应用，免得每个子进程都导入整个 server（连库、迁移、起后台线程）
+if __name__ != "__mp_main__":
+    app = create_app()
 
 if __name__ == "__main__":
+    import argparse
     import uvicorn
-    uvicorn.run("server_web:app", host="0.0.0.0", port=8000, reload=True)
+
+    parser = argparse.ArgumentParser(description="三角洲抽砖 Web 服务")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("DELTA_WORKERS", "1") or 1),
+                        help="worker 进程数；大于 1 时为生产模式（不热重载）")
+    args = parser.parse_args()
+
+    if args.workers > 1:
+        # 迁移/种子已在本进程 import server 时完成；子进程继承 DELTA_WORKERS，
+        # 开启基于 SQLite 的跨进程缓存失效与后台任务租约
+        os.environ["DELTA_WORKERS"] = str(args.workers)
+        uvicorn.run("server_web:app", host=args.host, port=args.port, workers=args.workers)
+    else:
+        uvicorn.run("server_web:app", host=args.host, port=args.port, reload=True)
@@ -0,0 +1,46 @@
+# backend/tests/conftest.py
+# server 在导入时就连库、迁移、写种子，所以环境变量必须在导入前设好：
+# 数据库放临时目录，bcrypt 在当前线程计算（不起 spawn 进程池），sms_codes.txt 也写到临时目录。
+import os, sys, tempfile, uuid
+
+import pytest
+
+_TMP_DIR = tempfile.mkdtemp(prefix="delta-brick-tests-")
+os.environ["DELTA_DB"] = "sqlite:///" + os.path.join(_TMP_DIR, "delta_brick.db")
+os.environ["DELTA_BCRYPT_WORKERS"] = "0"
+os.environ["DELTA_BCRYPT_ROUNDS"] = "4"
+os.environ.pop("DELTA_WORKERS", None)
+os.chdir(_TMP_DIR)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+
+
+@pytest.fixture
+def db():
+    session = server.SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+@pytest.fixture
+def make_user(db):
+    """建一个测试用户（用户名随机，互不冲突），返回 (User, Authorization 头)。"""
+
+    def make(**fields):
+        suffix = uuid.uuid4().hex[:10]
+        user = server.User(
+            username=f"t{suffix}",
+            phone=f"1{int(suffix, 16) % 10**10:010d}",
+            password_hash="x",
+            session_ver=0,
+            **fields,
+        )
+        db.add(user)
+        db.commit()
+        token = server.mk_jwt(user.username, 0, user_id=user.id)
+        return user, {"Authorization": "Bearer " + token}
+
+    return make
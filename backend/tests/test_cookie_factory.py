@@ -0,0 +1,131 @@
+# 饼干工坊：批量操作的整批点击上限，以及后台分批周结算与逐个 cookie_finalize_week 结果一致
+import json
+import random
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+import server
+from server import (
+    CookieFactoryDay, CookieFactoryProfile, CookieSettlementRun, CookieWeeklySettlement, User,
+    cookie_maybe_settle, cookie_settle_chunk, cookie_settlement_pending, cookie_week_start,
+    ensure_cookie_profile,
+)
+
+
+@pytest.fixture
+def client():
+    return TestClient(server.app)
+
+
+@pytest.fixture(autouse=True)
+def no_settlement_thread(monkeypatch):
+    # cookie_maybe_settle 会唤醒后台结算线程；测试里由用例自己驱动批处理
+    monkeypatch.setattr(server.COOKIE_SETTLEMENT, "start", lambda: None)
+
+
+def manual_clicks(db, user_id):
+    db.expire_all()
+    return int(db.get(CookieFactoryProfile, user_id).manual_clicks or 0)
+
+
+def test_batch_clicks_capped_per_batch(client, db, make_user):
+    user, headers = make_user(is_admin=True)
+    actions = [{"type": "click", "amount": 200}] * 48 + [{"type": "bogus"}, {"type": "click", "amount": 3}]
+    r = client.post("/cookie-factory/act/batch", json={"actions": actions}, headers=headers)
+    assert r.status_code == 200, r.text
+    body = r.json()
+    assert manual_clicks(db, user.id) == server.COOKIE_BATCH_CLICK_CAP
+    capped = [e["index"] for e in body["errors"] if e["type"] == "click"]
+    assert capped == list(range(1, 48)) + [49]
+    assert [e["index"] for e in body["errors"] if e["type"] == "bogus"] == [48]
+
+    # 下一批重新计额度；单个操作超过 COOKIE_CLICK_CAP 的部分同样截断
+    r = client.post("/cookie-factory/act/batch", json={"actions": [{"type": "click", "amount": 500}]}, headers=headers)
+    assert r.status_code == 200, r.text
+    assert manual_clicks(db, user.id) == 2 * server.COOKIE_BATCH_CLICK_CAP
+    assert [e["index"] for e in r.json()["errors"]] == [0]
+
+
+def test_batch_rejects_oversized_request(client, make_user):
+    _user, headers = make_user(is_admin=True)
+    actions = [{"type": "click", "amount": 1}] * (server.COOKIE_BATCH_MAX_ACTIONS + 1)
+    r = client.post("/cookie-factory/act/batch", json={"actions": actions}, headers=headers)
+    assert r.status_code == 400
+
+
+def seed_previous_week(db, make_user, count, now):
+    """在上一周建 count 个状态随机的档案，返回 user_id 列表。"""
+    rng = random.Random(20261018)
+    prev = cookie_week_start(now) - 7 * 86400
+    uids = []
+    for _ in range(count):
+        user, _ = make_user(unopened_bricks=3)
+        profile = ensure_cookie_profile(db, user, prev + 100)
+        profile.week_start_ts = prev
+        profile.cookies_this_week = rng.choice([0, 5e8, 3e9, 1e11])
+        profile.login_streak = rng.randint(0, 9)
+        profile.claimed_bricks_this_week = rng.randint(0, 20)
+        profile.pending_bonus_multiplier = rng.choice([1.0, 1.1])
+        profile.penalty_multiplier = rng.choice([1.0, 0.7])
+        profile.total_bricks_earned = 5
+        for d in range(rng.randint(0, 4)):
+            db.add(CookieFactoryDay(
+                user_id=user.id, day=f"2000-01-0{d + 1}", active_points=rng.randint(0, 150),
+                login_ts=rng.choice([None, prev + d * 86400]), challenge_clicks=3,
+            ))
+        uids.append(user.id)
+    db.commit()
+    return uids
+
+
+def snapshot(db, uid, report):
+    user, profile = db.get(User, uid), db.get(CookieFactoryProfile, uid)
+    report = dict(report)
+    report.pop("timestamp", None)
+    return (
+        report, int(user.unopened_bricks), int(profile.total_bricks_earned),
+        float(profile.production_bonus_multiplier), float(profile.penalty_multiplier),
+        int(profile.week_start_ts),
+    )
+
+
+def test_batch_settlement_matches_finalize_week_and_resumes(db, make_user):
+    # 用一个未来的周，避免和其他用例建的档案共用结算进度行
+    now = cookie_week_start(int(time.time())) + 70 * 86400 + 3600
+    week = cookie_week_start(now)
+    uids = seed_previous_week(db, make_user, 45, now)
+
+    # 期望值：请求路径上的就地结算（cookie_maybe_settle → cookie_finalize_week），算完回滚
+    expected = {}
+    for uid in uids:
+        report = cookie_maybe_settle(db, db.get(CookieFactoryProfile, uid), db.get(User, uid), now)
+        db.flush()
+        expected[uid] = snapshot(db, uid, report)
+    db.rollback()
+    db.expire_all()
+
+    pending = db.query(CookieFactoryProfile).filter(
+        CookieFactoryProfile.week_start_ts > 0, CookieFactoryProfile.week_start_ts < week
+    ).count()
+    # 模拟跑完第一批后进程退出：断点停在第一批末尾
+    db.add(CookieSettlementRun(week_start=week, last_user_id=0, settled=0, bricks=0, started_at=now, updated_at=now))
+    db.commit()
+    first, after, _bricks = cookie_settle_chunk(db, week, 0, 10, now)
+    db.commit()
+    assert first == 10
+
+    job = CookieWeeklySettlement(chunk_size=10)
+    assert job.run(now=now) == pending - first
+    assert job.run(now=now) == 0
+
+    db.expire_all()
+    for uid in uids:
+        profile = db.get(CookieFactoryProfile, uid)
+        assert snapshot(db, uid, json.loads(profile.last_report)) == expected[uid], uid
+        days = db.query(CookieFactoryDay).filter_by(user_id=uid).all()
+        assert not any(d.active_points or d.login_ts is not None for d in days)
+    assert not cookie_settlement_pending(db, week)
+    run = db.get(CookieSettlementRun, week)
+    assert run.settled == pending and run.finished_at == now
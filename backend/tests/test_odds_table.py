@@ -0,0 +1,65 @@
+# 预编译的 PPM 累积表必须与逐抽 compute_odds + 逐级判定的原分布一致
+from types import SimpleNamespace
+
+import pytest
+
+import gacha_core
+from gacha_core import OddsTable, compute_odds, ppm
+
+CFG = SimpleNamespace(
+    p_brick_base=0.3, p_purple_base=2.7, p_blue_base=20.0, p_green_base=77.0,
+    brick_pity_max=75, brick_ramp_start=65, purple_pity_max=20, compression_alpha=0.5,
+)
+
+
+def legacy_thresholds(n, m):
+    """原 roll 逻辑（砖 → 紫 → 蓝/绿 各掷一次）下各档累积概率，单位 ppm。"""
+    od = compute_odds(n, m, CFG)
+    if od.force_brick_next:
+        return 1e6, 1e6, 1e6
+    p_brick = ppm(od.brick) / 1e6
+    p_purple = 1.0 if od.force_purple_next else ppm(od.purple) / 1e6
+    p_blue = ppm(od.blue) / 1e6
+    brick = p_brick
+    purple = (1 - brick) * p_purple
+    blue = (1 - brick - purple) * p_blue
+    return brick * 1e6, (brick + purple) * 1e6, (brick + purple + blue) * 1e6
+
+
+def test_thresholds_match_legacy_cascade():
+    table = OddsTable(CFG)
+    for n in range(CFG.brick_pity_max + 3):
+        for m in range(CFG.purple_pity_max + 3):
+            got = table.cdf[min(n, CFG.brick_pity_max)][min(m, CFG.purple_pity_max)]
+            for have, want in zip(got, legacy_thresholds(n, m)):
+                # 表里逐级取整（向下），与精确分布相差不到 2 ppm
+                assert abs(have - want) < 2, (n, m, got)
+
+
+def test_odds_payload_matches_compute_odds():
+    table = OddsTable(CFG)
+    for n in (0, 1, 64, 65, 70, 74, 75, 90):
+        for m in (0, 5, 19, 20, 33):
+            assert table.odds(n, m) == compute_odds(n, m, CFG).dict()
+
+
+@pytest.mark.parametrize("n,m", [(0, 0), (70, 3), (10, 0)])
+def test_roll_uses_threshold_boundaries(monkeypatch, n, m):
+    table = OddsTable(CFG)
+    brick, purple, blue = table.cdf[n][m]
+    assert 0 < brick < purple < blue < 1_000_000
+    cases = [
+        (brick - 1, "BRICK"), (brick, "PURPLE"), (purple - 1, "PURPLE"),
+        (purple, "BLUE"), (blue - 1, "BLUE"), (blue, "GREEN"), (999_999, "GREEN"),
+    ]
+    for draw, rarity in cases:
+        monkeypatch.setattr(gacha_core, "rng_ppm", lambda d=draw: d)
+        assert table.roll(n, m) == rarity, (n, m, draw)
+
+
+def test_roll_forced_pity(monkeypatch):
+    table = OddsTable(CFG)
+    monkeypatch.setattr(gacha_core, "rng_ppm", lambda: 999_999)
+    assert table.roll(CFG.brick_pity_max - 1, 0) == "BRICK"
+    assert table.roll(CFG.brick_pity_max + 10, 0) == "BRICK"
+    assert table.roll(0, CFG.purple_pity_max - 1) == "PURPLE"
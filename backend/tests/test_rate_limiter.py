@@ -0,0 +1,93 @@
+# RATE_LIMIT_POLICIES 的限流语义，以及多 worker 合并时 reset 不被旧计数覆盖
+import uuid
+
+import pytest
+
+import server
+from server import RateLimitPolicy, RateLimiter, RATE_LIMIT_POLICIES
+
+
+@pytest.fixture
+def limiter():
+    lim = RateLimiter(RATE_LIMIT_POLICIES)
+    lim._start = lambda: None  # 不起后台写库线程，测试里手动 flush
+    return lim
+
+
+def key() -> str:
+    return uuid.uuid4().hex
+
+
+def test_window_policy_limits_and_expires():
+    policy = RateLimitPolicy("w", "window", 3, 60)
+    state = policy.fresh(0)
+    for t in (0, 10, 20):
+        assert policy.retry_after(state, t) == 0
+        policy.consume(state, t)
+    assert policy.retry_after(state, 30) == pytest.approx(30)
+    assert policy.retry_after(state, 60) == 0
+    assert not policy.idle(state, 70)
+    assert policy.idle(state, 80)
+
+
+def test_bucket_policy_refills():
+    policy = RateLimitPolicy("b", "bucket", 1, 60)
+    state = policy.fresh(0)
+    assert policy.retry_after(state, 0) == 0
+    policy.consume(state, 0)
+    assert policy.retry_after(state, 15) == pytest.approx(45)
+    assert policy.retry_after(state, 60) == 0
+
+
+def test_configured_policies():
+    otp = RATE_LIMIT_POLICIES["otp-cooldown"]
+    assert (otp.kind, otp.capacity, otp.period) == ("bucket", 1, 60)
+    login = RATE_LIMIT_POLICIES["login-fail"]
+    assert (login.kind, login.capacity, login.period) == ("window", 10, 900)
+
+
+def test_rejected_checks_consume_nothing(limiter):
+    tag, ip = key(), key()
+    checks = [("otp-cooldown", f"login2:{tag}"), ("otp-ip", ip)]
+    assert limiter.hit(checks) == 0
+    assert 0 < limiter.hit(checks) <= 60
+    # 冷却被拒的那次不计入 IP 窗口：换个手机号仍只算 1 条
+    assert len(limiter._state[("otp-ip", ip)]) == 1
+
+
+def test_login_fail_lock_and_reset(limiter):
+    name = key()
+    checks = [("login-fail", name)]
+    for _ in range(10):
+        assert limiter.hit(checks, consume=False) == 0
+        limiter.hit(checks)
+    assert limiter.hit(checks, consume=False) > 0
+    limiter.reset("login-fail", name)
+    assert limiter.hit(checks, consume=False) == 0
+
+
+@pytest.mark.parametrize("stale_first", [True, False])
+def test_reset_wins_over_stale_remote_counts(monkeypatch, stale_first):
+    monkeypatch.setattr(server.CACHE_BUS, "enabled", True)
+    a, b = RateLimiter(RATE_LIMIT_POLICIES), RateLimiter(RATE_LIMIT_POLICIES)
+    a._start = b._start = lambda: None
+    name = key()
+    checks = [("login-fail", name)]
+    for _ in range(10):
+        a.hit(checks)
+    a.flush()
+    b.flush()
+    assert b.hit(checks, consume=False) > 0
+
+    a.reset("login-fail", name)
+    b._dirty.add(("login-fail", name))  # b 手里还有重置前的计数待写
+    if stale_first:
+        b.flush()
+        a.flush()
+    else:
+        a.flush()
+        b.flush()
+    b.flush()
+    a.flush()
+    assert a.hit(checks, consume=False) == 0
+    assert b.hit(checks, consume=False) == 0
@@ -241,6 +241,7 @@ const API = {
   cookieStatus: () => API.json("/cookie-factory/status"),
   cookieLogin: () => API.json("/cookie-factory/login", "POST"),
   cookieAct: (payload) => API.json("/cookie-factory/act", "POST", payload || {}),
+  cookieActBatch: (actions) => API.json("/cookie-factory/act/batch", "POST", { actions: actions || [] }),
   cultivationStatus: () => API.json("/cultivation/status"),
   cultivationRefresh: () => API.json("/cultivation/refresh", "POST", {}),
   cultivationBegin: (payload) => API.json("/cultivation/begin", "POST", payload || {}),
@@ -207,8 +207,14 @@ const AdminPage = {
       const enabled = !!info.enabled;
       const profiles = info.profiles != null ? info.profiles : "-";
       const total = info.total_bricks != null ? info.total_bricks : "-";
+      const settlement = info.settlement || {};
+      const projected = settlement.projected_base_bricks != null ? settlement.projected_base_bricks : "-";
+      const lastRun = settlement.last_run;
+      const lastRunText = lastRun
+        ? ` · 上次周结算：${lastRun.settled} 个档案，补发砖 ${lastRun.bricks}${lastRun.finished_at ? "" : "（进行中）"}`
+        : "";
       cookieDesc.innerHTML = enabled
-        ? `当前已向玩家开放。参与玩家：<b>${profiles}</b> · 累计产出砖：<b>${total}</b>`
+        ? `当前已向玩家开放。参与玩家：<b>${profiles}</b> · 累计产出砖：<b>${total}</b> · 本周预计基础砖：<b>${projected}</b>${lastRunText}`
         : `当前为关闭状态，普通玩家无法看到该页面。`;
     };
 
@@ -6,6 +6,9 @@ const CookieFactoryPage = {
   _lastError: null,
   _errorTimer: null,
   _guideKey: "click",
+  _pendingClicks: [],
+  _clickTimer: null,
+  _flushing: null,
   funFacts: [
     { icon: "🥠", title: "幸运签", text: "今天的烤炉特别顺手，别忘了摸摸黄金饼干。" },
     { icon: "🚀", title: "增产计划", text: "科技加持！升级工厂可以显著提升每秒产量。" },
@@ -292,6 +295,7 @@ const CookieFactoryPage = {
     }, 4000);
   },
   async fetchStatus() {
+    await this.flushClicks();
     try {
       this._data = await API.cookieStatus();
       this.clearError();
@@ -701,7 +705,7 @@ const CookieFactoryPage = {
     if (big) {
       big.onclick = () => {
         window.AudioEngine?.playSfx?.('cookie-click');
-        this.handleAction({ type: 'click', amount: 1 });
+        this.queueClick();
       };
     }
     const goldenBtn = document.getElementById("cookie-golden");
@@ -844,10 +848,60 @@ const CookieFactoryPage = {
       window.AudioEngine.playSfx('cookie-click');
     }
   },
+  // 点击先攒在本地，停手片刻或攒满一批再一次性提交，服务端一个事务内结算
+  queueClick() {
+    this._pendingClicks.push({ type: 'click', amount: 1, ts: Math.floor(Date.now() / 1000) });
+    clearTimeout(this._clickTimer);
+    if (this._pendingClicks.length >= 50) {
+      this.flushClicks();
+      return;
+    }
+    this._clickTimer = setTimeout(() => this.flushClicks(), 600);
+  },
+  async flushClicks() {
+    clearTimeout(this._clickTimer);
+    this._clickTimer = null;
+    if (this._flushing) {
+      await this._flushing;
+    }
+    if (!this._pendingClicks.length) return;
+    const actions = this._pendingClicks.splice(0, 50);
+    this._flushing = (async () => {
+      try {
+        this.applyDelta(await API.cookieActBatch(actions));
+      } catch (e) {
+        this.showError(e.message || '操作失败');
+      }
+    })();
+    try {
+      await this._flushing;
+    } finally {
+      this._flushing = null;
+    }
+    if (this._pendingClicks.length) {
+      this._clickTimer = setTimeout(() => this.flushClicks(), 600);
+    }
+  },
+  applyDelta(delta) {
+    if (!delta || !this._data) return;
+    if (delta.settlement) {
+      this.refresh();
+      return;
+    }
+    ['profile', 'weekly', 'challenge', 'golden', 'sugar'].forEach(key => {
+      if (delta[key]) this._data[key] = Object.assign({}, this._data[key] || {}, delta[key]);
+    });
+    if (delta.buildings) this._data.buildings = delta.buildings;
+    if (delta.mini_games) this._data.mini_games = delta.mini_games;
+    this._data.now = delta.now;
+    this.clearError();
+    this.updateView();
+  },
   async handleAction(payload) {
     if (this._loading) return;
     this._loading = true;
     try {
+      await this.flushClicks();
       this._data = await API.cookieAct(payload);
       this.clearError();
       this.updateView();
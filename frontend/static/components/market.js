@@ -425,8 +425,12 @@
     },
 
     // ===== 浏览 / 购买 =====
-    _loadBrowse: function () {
+    // more=true 时按 next_cursor 追加下一页，否则按当前筛选从第一页重新加载
+    _loadBrowse: function (more) {
       var self=this;
+      if (more && !this._browseCursor) return;
+      if (!more) { this._browseItems=[]; this._browseCursor=null; }
+      var token=this._browseToken=(this._browseToken||0)+1;
       var f=this._filters, qs={
         sort: {price_asc:"price_asc",price_desc:"price_desc",wear_asc:"wear_asc",wear_desc:"wear_desc",newest:"newest",oldest:"oldest"}[f.order] || "newest"
       };
@@ -436,10 +440,13 @@
       if (f.exquisite==="PREM") qs.is_exquisite = "false";
       if (f.grade!=="ANY") qs.grade = f.grade;
       if (f.season && f.season !== "ALL") qs.season = f.season;
+      if (more) qs.cursor = this._browseCursor;
 
       API.marketBrowse(qs)
         .then(data=>{
-          var items=(data.items||[]).map(function(x){
+          if (token !== self._browseToken) return;
+          self._browseCursor = data.next_cursor || null;
+          var items=self._browseItems=self._browseItems.concat((data.items||[]).map(function(x){
             return {
               id: x.id || x.market_id || x.listing_id,
               inv_id: x.inv_id,
@@ -459,7 +466,7 @@
               season: x.season || x.season_id || "",
               model: x.model || x.visual?.model || ""
             };
-          });
+          }));
 
           var rows='';
           for (var i=0;i<items.length;i++){
@@ -487,7 +494,12 @@
           $id('mk-browse-list').innerHTML =
             '<table class="table">'+
             '<thead><tr><th>上架玩家</th><th>名称</th><th>赛季</th><th>类型</th><th>外观</th><th>稀有度</th><th>极品/优品</th><th>磨损</th><th>品质</th><th>编号</th><th>价格</th><th>操作</th></tr></thead>'+
-            '<tbody>'+rows+'</tbody></table>';
+            '<tbody>'+rows+'</tbody></table>'+
+            (self._browseCursor
+              ? '<div class="muted small">已显示 '+items.length+' / '+(data.total ?? items.length)+' 件　<button class="btn" id="mk-browse-more">加载更多</button></div>'
+              : '');
+          var moreBtn=$id('mk-browse-more');
+          if (moreBtn) moreBtn.onclick=function(){ moreBtn.disabled=true; self._loadBrowse(true); };
 
           $id('mk-browse-list').querySelectorAll('[data-buy]').forEach((btn)=>{
             const id=btn.getAttribute('data-buy');
@@ -501,7 +513,15 @@
             };
           });
         })
-        .catch(()=>{ $id('mk-browse-list').innerHTML='<div class="muted">加载失败</div>'; });
+        .catch(()=>{
+          if (token !== self._browseToken) return;
+          if (more) {
+            var btn=$id('mk-browse-more');
+            if (btn) { btn.disabled=false; btn.textContent='加载失败，重试'; }
+            return;
+          }
+          $id('mk-browse-list').innerHTML='<div class="muted">加载失败</div>';
+        });
     },
 
     // ===== 我的挂单 =====
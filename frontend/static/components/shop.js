@@ -218,10 +218,6 @@ const ShopPage = {
         const total = book.official_layers.reduce((acc, layer) => acc + (layer.quantity || 0), 0);
         html += ` · 官方挂单 ${total} 块`;
       }
-      if (price.buy_orders_filled?.length) {
-        const summary = price.buy_orders_filled.map(f => `#${f.order_id} ×${f.filled}`).join("，");
-        html += `<div class="muted small">撮合完成：${summary}</div>`;
-      }
       priceLine.innerHTML = html;
     };
 